@@ -2,11 +2,17 @@ import click
 
 from config import CONFIG
 from data.data_generator import DataGenerator
+from utils import init_llm_cache
 
 
 @click.group()
 def cli():
-    pass
+    init_llm_cache(
+        mode=CONFIG.llm_cache_mode,
+        path=CONFIG.llm_cache_path,
+        ttl=int(CONFIG.llm_cache_ttl),
+        max_entries=int(CONFIG.llm_cache_max_entries),
+    )
 
 
 class DataGenerationConfig(object):
@@ -15,6 +21,9 @@ class DataGenerationConfig(object):
         self.model = False
         self.temperature = 0
         self.max_token = 0
+        self.restart = False
+        self.batch_export = None
+        self.batch_import = None
         self.generator = None
 
 
@@ -23,17 +32,43 @@ data_gen_pass_config = click.make_pass_decorator(DataGenerationConfig, ensure=Tr
 
 @cli.group("generate")
 @click.option("--verbose", is_flag=True)
-@click.option("--out", type=click.File("w"), required=False)
+@click.option("--out", type=click.Path(dir_okay=False), required=False)
+@click.option("--restart", is_flag=True, help="overwrite the output, don't resume")
+@click.option(
+    "--batch-export",
+    type=click.Path(dir_okay=False),
+    help="write the prompts to a batch requests JSONL file instead of calling the llm",
+)
+@click.option(
+    "--batch-import",
+    type=click.Path(exists=True, dir_okay=False),
+    help="write the output from a batch responses JSONL file",
+)
 @click.option("--max_tokens", default=CONFIG.MAX_TOKENS)
 @click.option("--temperature", default=CONFIG.LLM_TEMPERATURE)
 @click.option("--model", default="gpt-4o")
 @data_gen_pass_config
-def generate(config, model, temperature, max_tokens, out, verbose):
+def generate(
+    config,
+    model,
+    temperature,
+    max_tokens,
+    out,
+    restart,
+    batch_export,
+    batch_import,
+    verbose,
+):
+    if batch_export and batch_import:
+        raise click.UsageError("--batch-export and --batch-import are exclusive")
     config.model = model
     config.temperature = temperature
     config.verbose = verbose
     config.max_token = max_tokens
     config.output_file = out
+    config.restart = restart
+    config.batch_export = batch_export
+    config.batch_import = batch_import
     config.generator = DataGenerator(
         model=config.model,
         max_token=config.max_token,
@@ -48,9 +83,21 @@ def generate(config, model, temperature, max_tokens, out, verbose):
 )
 @data_gen_pass_config
 def generate_pictures_descriptions(config, pictures_dir):
+    if config.batch_export:
+        return config.generator.export_pictures_descriptions_batch(
+            batch_file=config.batch_export, picture_dir=pictures_dir
+        )
+    if config.batch_import:
+        return config.generator.import_pictures_descriptions_batch(
+            batch_file=config.batch_import,
+            picture_dir=pictures_dir,
+            output_file=config.output_file or CONFIG.listing_pictures_descr_file,
+            restart=config.restart,
+        )
     config.generator.generate_pictures_descriptions(
         picture_dir=pictures_dir,
         output_file=config.output_file or CONFIG.listing_pictures_descr_file,
+        restart=config.restart,
     )
 
 
@@ -60,12 +107,206 @@ def generate_pictures_descriptions(config, pictures_dir):
 )
 @data_gen_pass_config
 def generate_listings(config, pictures_desc):
+    if config.batch_export:
+        return config.generator.export_listings_batch(
+            batch_file=config.batch_export, picture_desc_file=pictures_desc
+        )
+    if config.batch_import:
+        return config.generator.import_listings_batch(
+            batch_file=config.batch_import,
+            picture_desc_file=pictures_desc,
+            output_file=config.output_file or CONFIG.listing_file,
+            restart=config.restart,
+        )
     config.generator.generate_pictures_augmented_listings(
         picture_desc_file=pictures_desc,
         output_file=config.output_file or CONFIG.listing_file,
+        restart=config.restart,
     )
 
 
+@cli.group("bench")
+def bench():
+    import logging
+
+    logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+
+
+@bench.command("query_composition")
+@click.option("--limit", default=3)
+def bench_query_composition(limit):
+    from benchmarks import query_composition
+
+    query_composition.run(limit=limit)
+
+
+@bench.command("personalization")
+@click.option("--repeat", default=3)
+def bench_personalization(repeat):
+    from benchmarks import personalization
+
+    personalization.run(repeat=repeat)
+
+
+@bench.command("http_clients")
+@click.option("--requests", default=50)
+@click.option("--latency", default=0.01)
+def bench_http_clients(requests, latency):
+    from benchmarks import http_clients
+
+    http_clients.run(requests=requests, latency=latency)
+
+
+@bench.command("generation")
+@click.option("--pictures", default=100)
+@click.option("--latency", default=0.2)
+@click.option("--rate-limited", default=0.1, help="share of the requests rejected")
+def bench_generation(pictures, latency, rate_limited):
+    from benchmarks import generation
+
+    generation.run(pictures=pictures, latency=latency, rate_limited=rate_limited)
+
+
+@bench.command("image_encoding")
+@click.option("--pictures_dir", default=CONFIG.listing_pictures_dir)
+@click.option("--repeat", default=3)
+def bench_image_encoding(pictures_dir, repeat):
+    from benchmarks import image_encoding
+
+    image_encoding.run(picture_dir=pictures_dir, repeat=repeat)
+
+
+@bench.command("semantic_cache")
+def bench_semantic_cache():
+    from benchmarks import semantic_cache
+
+    semantic_cache.run()
+
+
+@cli.command("pipeline")
+@click.option("--pictures_dir", default=CONFIG.listing_pictures_dir)
+@click.option(
+    "--descriptions_out",
+    type=click.Path(dir_okay=False),
+    help="also write the pictures descriptions to this CSV file",
+)
+@click.option(
+    "--listings_out",
+    type=click.Path(dir_okay=False),
+    help="also write the listings to this CSV file",
+)
+@click.option("--reset", is_flag=True, help="empty the listings table first")
+@click.option("--model", default=CONFIG.LLM_MODEL)
+def pipeline(pictures_dir, descriptions_out, listings_out, reset, model):
+    import logging
+
+    from data.pipeline import run_listings_pipeline
+    from service_layer.vector_db_managers import get_vectordb_manager
+
+    logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+    db_manager = get_vectordb_manager(CONFIG.vector_db_engine)
+    db_manager.init(reset=reset, load_data=False)
+    run_listings_pipeline(
+        DataGenerator(model=model),
+        db_manager,
+        picture_dir=pictures_dir,
+        descriptions_file=descriptions_out,
+        listings_file=listings_out,
+        concurrency=int(CONFIG.llm_concurrency),
+    )
+
+
+@cli.command("watch")
+@click.option("--pictures_dir", default=CONFIG.listing_pictures_dir)
+@click.option(
+    "--backfill",
+    is_flag=True,
+    help="on the first run, also ingest the pictures already in the directory",
+)
+@click.option("--model", default=CONFIG.LLM_MODEL)
+def watch(pictures_dir, backfill, model):
+    import logging
+
+    from data.watcher import PictureWatcher, watch_pictures
+    from service_layer.vector_db_managers import get_vectordb_manager
+
+    logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+    db_manager = get_vectordb_manager(CONFIG.vector_db_engine)
+    db_manager.init(load_data=False)
+    watcher = PictureWatcher(
+        pictures_dir,
+        CONFIG.watch_state_file,
+        settle_time=float(CONFIG.watch_settle_time),
+    )
+    try:
+        watch_pictures(
+            DataGenerator(model=model),
+            db_manager,
+            watcher,
+            interval=float(CONFIG.watch_interval),
+            batch_size=int(CONFIG.watch_batch_size),
+            concurrency=int(CONFIG.llm_concurrency),
+            backfill=backfill,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command("recommend")
+@click.option(
+    "--in",
+    "profiles_file",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="CSV file of the profiles, with `id` and `text` columns",
+)
+@click.option("--out", "output_file", required=True, type=click.Path(dir_okay=False))
+@click.option("--limit", default=10, help="listings per profile")
+def recommend(profiles_file, output_file, limit):
+    import logging
+
+    from data.recommendations import recommend_profiles
+
+    logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+    recommend_profiles(
+        profiles_file,
+        output_file,
+        limit=limit,
+        chunk_size=int(CONFIG.recommend_chunk_size),
+        workers=int(CONFIG.recommend_workers),
+    )
+
+
+@cli.command("quantize")
+@click.option(
+    "--column",
+    "columns",
+    multiple=True,
+    default=["vector", "image_vector"],
+    help="vector column(s) to quantize",
+)
+@click.option(
+    "--subspaces",
+    type=int,
+    default=None,
+    help="bytes per vector (one per 16 dimensions by default), 0 to remove",
+)
+def quantize(columns, subspaces):
+    import logging
+
+    from service_layer.vector_db_managers import NumpyDBManager
+
+    logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+    if CONFIG.vector_db_engine != "numpy":
+        raise click.UsageError("Only supported with VECTOR_DB_ENGINE = numpy")
+    if not CONFIG.numpy_db_path:
+        raise click.UsageError("Only supported with a saved table (NUMPY_DB_PATH)")
+    db_manager = NumpyDBManager()
+    db_manager.init(load_data=False)
+    for column in columns:
+        db_manager.quantize(column, subspaces)
+
+
 @cli.command("start")
 @click.option("--mode", default="chat")
 def start(mode):
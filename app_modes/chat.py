@@ -1,32 +1,73 @@
 import abc
 import base64
+import functools
+import inspect
 import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BufferedReader
-from typing import Any, Dict, Tuple, Union
+from typing import Any, Dict, Iterator, List, Tuple, Union
 
 import gradio as gr
 import PIL
 import PIL.Image
-from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
-from langchain.chains.question_answering import load_qa_chain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.documents.base import Document
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_openai import ChatOpenAI
 from typing_extensions import Self
 
 from config import CONFIG
 from models.listings import Listing
-from service_layer.services import get_listing_by_id, get_relevant_listings
+from service_layer.filters import ListingFilters
+from service_layer.services import (
+    get_listing_by_id,
+    get_listing_neighborhoods,
+    get_relevant_listings,
+)
+from utils import (
+    BoundedThreadPool,
+    DeadlineExceededException,
+    JsonArrayStreamParser,
+    LatencyTracker,
+    compose_vectors,
+    embedd_text,
+    get_chat_model,
+    hedged_call,
+    parse_tag_vocabulary,
+    to_bool,
+)
 
 from . import register_app_mode
+from .preferences import extract_preferences
+from .prompts import TokenBudgetedPromptBuilder
 
 _logger = logging.getLogger(__name__)
 
 
+@functools.cache
+def get_worker_pool() -> BoundedThreadPool:
+    """pool running the blocking search/llm work of all the chat sessions"""
+    return BoundedThreadPool(
+        max_workers=int(CONFIG.chat_worker_pool_size),
+        name="homematch-chat",
+    )
+
+
+@functools.cache
+def get_llm_executor() -> ThreadPoolExecutor:
+    """threads running the (possibly hedged) personalization llm calls"""
+    return ThreadPoolExecutor(
+        max_workers=2 * int(CONFIG.chat_worker_pool_size),
+        thread_name_prefix="homematch-llm",
+    )
+
+
+# durations of the personalization llm calls, to hedge the slowest ones
+_llm_latencies = LatencyTracker()
+
+
 class ChatState:
     is_terminal: bool = False
 
@@ -142,6 +183,14 @@ The descriptions should be unique, appealing, and tailored to the preferences pr
  emphasizing in bullet points aspects of the property that align with the user's preferences.
 RETURN INSTRUCTIONS: a json object array. The attributes are id(the listing id), and description(your personalized description)"""
 
+    _map_llm_query = """
+Given the real estate listing in the CONTEXT section,
+generate a personalized description based on the human preferences in the QUESTIONS ANSWERS SUMMARY section
+    and the description of the listing.
+The description should be unique, appealing, and tailored to the preferences provided,
+ emphasizing in bullet points aspects of the property that align with the user's preferences.
+RETURN INSTRUCTIONS: only the personalized description"""
+
     _llm_query_prompt_template = """
 {query}
 ---QUESTIONS ANWERS SUMMARY
@@ -150,10 +199,15 @@ RETURN INSTRUCTIONS: a json object array. The attributes are id(the listing id),
 CONTEXT: {context}
     """
 
+    _error_message = "Sorry ! Unfortunately, I was unable to process your request due to some technical issue; I may need to get fixed up!"
+    _listings_separator = "<br/><hr/><br/>"
+
     def __init__(self) -> None:
         super().__init__()
         self._substates_number = len(self._substates)
         self.current_state_index = -1
+        # (text input, future) of the listings retrieval started in advance
+        self._prefetch: Tuple[str, Future] | None = None
 
     def run(self, history: ChatMessageHistory, user_input: Dict) -> Any:
         # if we are at the first run, ingore the input and just return the question
@@ -169,47 +223,280 @@ CONTEXT: {context}
                 self._llm(history),
                 "I hope this was helpful to you. Please feel free to retry!",
             ]
+        if self._text_answers_complete():
+            self._start_prefetch(history)
         return self._substates[self.current_state_index].question
 
+    def _text_answers_complete(self) -> bool:
+        return not any(
+            isinstance(state, TextInputQuestion)
+            for state in self._substates[self.current_state_index :]
+        )
+
+    def _start_prefetch(self, history: ChatMessageHistory) -> None:
+        """
+        Start retrieving the listings matching the text answers while the user
+        is still answering the remaining (non text) questions.
+        """
+        text_input = self._extract_user_input(history)[0]
+        if not text_input:
+            return
+        if self._prefetch and self._prefetch[0] == text_input:
+            return
+        self._cancel_prefetch()
+        future = get_worker_pool().submit(
+            self._search_listings, text_input, None, self._extract_answers(history)
+        )
+        self._prefetch = (text_input, future)
+
+    def _cancel_prefetch(self) -> None:
+        if self._prefetch:
+            self._prefetch[1].cancel()
+            self._prefetch = None
+
     def _llm(self, history: ChatMessageHistory) -> Any:
+        # streamed responses are not served by the llm cache
+        if (
+            to_bool(CONFIG.chat_stream_llm_response)
+            and CONFIG.llm_cache_mode != "replay"
+        ):
+            return self._stream_personalize(history)
+        return get_worker_pool().run(self._personalize, history)
+
+    def _personalize(self, history: ChatMessageHistory) -> Any:
         text_input, image = self._extract_user_input(history)
+        if CONFIG.chat_personalization_mode == "map":
+            relevant_listings = self._retrieve_listings(
+                text_input, image, self._extract_answers(history)
+            )
+            descriptions = self._map_personalize(history, relevant_listings)
+            return gr.HTML(
+                self._listings_separator.join(
+                    self._render_listing(listing, description)
+                    for listing, description in zip(relevant_listings, descriptions)
+                )
+            )
         relevant_listings, response = self._query_llm(history, text_input, image)
         return self._process_llm_response(response, relevant_listings)
 
+    def _stream_personalize(self, history: ChatMessageHistory) -> Iterator[str]:
+        """
+        Yield the rendered listings one by one, as soon as their personalized
+        description is complete in the llm token stream.
+        """
+        text_input, image = self._extract_user_input(history)
+        answers = self._extract_answers(history)
+        relevant_listings = get_worker_pool().run(
+            self._retrieve_listings, text_input, image, answers
+        )
+
+        if CONFIG.chat_personalization_mode == "map":
+            descriptions = self._map_personalize(history, relevant_listings)
+            for listing, description in zip(relevant_listings, descriptions):
+                yield self._render_listing(listing, description)
+            return
+
+        prompt = self._format_llm_prompt(history, relevant_listings)
+        parser = JsonArrayStreamParser()
+        listings_by_id = {
+            str(listing.metadata.get("id")): index
+            for index, listing in enumerate(relevant_listings)
+        }
+        # indices of the listings already rendered
+        rendered = set()
+        position = 0
+        deadline = time.monotonic() + float(CONFIG.chat_llm_deadline)
+        try:
+            llm = self._build_llm(timeout=float(CONFIG.chat_llm_deadline))
+            for chunk in llm.stream(prompt):
+                # the client timeout only bounds the wait between two chunks
+                if time.monotonic() > deadline:
+                    _logger.warning(
+                        "personalization llm stream: no complete answer after %ss",
+                        CONFIG.chat_llm_deadline,
+                    )
+                    break
+                for description_data in parser.feed(chunk.content):
+                    # matched by id, by position in the stream when the id is
+                    # missing or unknown
+                    index = listings_by_id.get(str(description_data.get("id")))
+                    if index is None:
+                        index = position
+                    position += 1
+                    if (
+                        index is None
+                        or index in rendered
+                        or index >= len(relevant_listings)
+                    ):
+                        continue
+                    yield self._render_listing(
+                        relevant_listings[index], description_data["description"]
+                    )
+                    rendered.add(index)
+        except Exception as e:
+            _logger.exception(e)
+        if not relevant_listings:
+            yield self._error_message
+        # degrade to the stored summary for the listings not described in time
+        for index, listing in enumerate(relevant_listings):
+            if index not in rendered:
+                yield self._render_listing(listing, listing.page_content)
+
+    def _retrieve_listings(self, text_input, image, answers=()) -> list[Document]:
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch and prefetch[0] != text_input:
+            prefetch[1].cancel()
+        elif prefetch and image is None:
+            try:
+                return prefetch[1].result()
+            except Exception as e:
+                _logger.warning("listings prefetch failed: %s", e)
+        # with an image, the search is refined with both inputs; the text
+        # embedding computed by the prefetch is then served from the cache
+        return self._search_listings(text_input, image, answers)
+
+    def _search_listings(self, text_input, image, answers=()) -> list[Document]:
+        return get_relevant_listings(
+            text=text_input,
+            text_vector=self._compose_query_vector(answers),
+            image=image,
+            columns=["id", "listing_summary"],
+            filters=self._extract_filters(answers),
+        )
+
+    def _extract_filters(self, answers: List[Tuple[str, str]]) -> ListingFilters | None:
+        """structured preferences of the answers, narrowing the search"""
+        if not answers or not to_bool(CONFIG.chat_preference_filters):
+            return None
+        filters = extract_preferences(
+            [answer for _, answer in answers],
+            neighborhoods=get_listing_neighborhoods(),
+            amenities=parse_tag_vocabulary(CONFIG.amenity_tags or ""),
+        )
+        _logger.debug("search filters: %s", filters)
+        return filters
+
+    def _compose_query_vector(self, answers: List[Tuple[str, str]]) -> List[float]:
+        """
+        Weighted combination of the embeddings of every answer.
+        The answers are embedded one by one through the embeddings cache, so
+        after a restart only the answers which changed are embedded again.
+        None when the answers are concatenated and embedded as a whole instead.
+        """
+        if not answers or CONFIG.chat_query_composition != "weighted":
+            return None
+        weights = self._answer_weights()
+        vectors = embedd_text([answer for _, answer in answers], use_cache=True)
+        return compose_vectors(
+            vectors, [weights.get(question, 1.0) for question, _ in answers]
+        )
+
+    def _answer_weights(self) -> Dict[str, float]:
+        """weight of every text question, set in the same order in the config"""
+        questions = [
+            state.question
+            for state in self._substates
+            if isinstance(state, TextInputQuestion)
+        ]
+        weights = CONFIG.chat_answer_weights
+        if isinstance(weights, str):
+            weights = [float(w) for w in weights.split(",") if w.strip()]
+        return dict(zip(questions, weights))
+
     def _query_llm(self, history, text_input, image):
-        relevant_listings = get_relevant_listings(
-            text=text_input, image=image, columns=["id", "listing_summary"]
+        relevant_listings = self._retrieve_listings(
+            text_input, image, self._extract_answers(history)
         )
-        llm_chain = self._build_llm_query_chain(history)
-        response = llm_chain.invoke(
-            {
-                "input_documents": relevant_listings,
-                "query": self._llm_query,
-            }
-        ).get("output_text")
+        prompt = self._format_llm_prompt(history, relevant_listings)
+        llm = self._build_llm()
+
+        def _invoke() -> str:
+            start = time.monotonic()
+            response = llm.invoke(prompt).content
+            _llm_latencies.record(time.monotonic() - start)
+            return response
+
+        hedge_after = None
+        if to_bool(CONFIG.chat_llm_hedging):
+            hedge_after = _llm_latencies.percentile(
+                95, default=float(CONFIG.chat_llm_hedge_after)
+            )
+        try:
+            response = hedged_call(
+                _invoke,
+                executor=get_llm_executor(),
+                deadline=float(CONFIG.chat_llm_deadline),
+                hedge_after=hedge_after,
+            )
+        except DeadlineExceededException as e:
+            _logger.warning("personalization llm call: %s", e)
+            response = None
         return relevant_listings, response
 
-    def _build_llm_query_chain(
-        self, history: ChatMessageHistory
-    ) -> BaseCombineDocumentsChain:
-        conversational_memory = ConversationBufferMemory(
-            chat_memory=history,
-            memory_key="questions_and_answers",
-            input_key="query",
+    def _map_personalize(
+        self, history: ChatMessageHistory, listings: list[Document]
+    ) -> Iterator[str]:
+        """
+        Generate the personalized description of every listing with its own
+        llm call, running concurrently, and yield them in the listings order.
+        A listing whose call fails or times out gets its stored summary instead.
+        """
+        prompts = [
+            self._format_llm_prompt(history, [listing], query=self._map_llm_query)
+            for listing in listings
+        ]
+        llm = self._build_llm(timeout=float(CONFIG.chat_map_timeout), max_retries=0)
+        with ThreadPoolExecutor(
+            max_workers=int(CONFIG.chat_map_concurrency),
+            thread_name_prefix="homematch-map",
+        ) as executor:
+            futures = [executor.submit(llm.invoke, prompt) for prompt in prompts]
+            for listing, future in zip(listings, futures):
+                try:
+                    yield future.result().content.strip()
+                except Exception as e:
+                    _logger.warning(
+                        "personalization failed for listing %s: %s",
+                        listing.metadata.get("id"),
+                        e,
+                    )
+                    yield listing.page_content
+
+    def _build_llm(self, **kwargs) -> ChatOpenAI:
+        return get_chat_model(
+            model=CONFIG.llm_model,
+            max_tokens=CONFIG.max_tokens,
+            temperature=1,
+            **kwargs,
         )
-        prompt = PromptTemplate(
+
+    def _format_llm_prompt(
+        self,
+        history: ChatMessageHistory,
+        documents: list[Document],
+        query: str | None = None,
+    ) -> str:
+        prompt_builder = TokenBudgetedPromptBuilder(
             template=self._llm_query_prompt_template,
-            input_variables=["query", "context", "questions_and_answers"],
+            budget=int(CONFIG.chat_prompt_token_budget),
+            model=CONFIG.llm_model,
+            min_listing_tokens=int(CONFIG.chat_prompt_min_listing_tokens),
         )
-        return load_qa_chain(
-            llm=ChatOpenAI(
-                name=CONFIG.llm_model, max_tokens=CONFIG.max_tokens, temperature=1
-            ),
-            prompt=prompt,
-            chain_type="stuff",
-            memory=conversational_memory,
+        return prompt_builder.build(
+            query=query or self._llm_query,
+            questions_and_answers=self._extract_answers(history),
+            documents=documents,
         )
 
+    def _extract_answers(self, history) -> List[Tuple[str, str]]:
+        """(question, answer) of every text question answered"""
+        messages = list(history.messages)
+        return [
+            (question.content, answer.content)
+            for question, answer in zip(messages, messages[1:])
+            if type(question) is AIMessage and type(answer) is HumanMessage
+        ]
+
     def _extract_user_input(self, history) -> Tuple[str | None, PIL.Image.Image | None]:
         human_messages = filter(lambda m: type(m) is HumanMessage, history.messages)
         text = "\n".join(map(lambda m: m.content, human_messages))
@@ -222,35 +509,46 @@ CONTEXT: {context}
     def _process_llm_response(
         self, llm_response: str, submitted_listings: list[Document]
     ) -> gr.HTML:
+        if llm_response is None:
+            # no answer in time from the llm, render the stored summaries
+            return gr.HTML(
+                self._listings_separator.join(
+                    self._render_listing(listing, listing.page_content)
+                    for listing in submitted_listings
+                )
+            )
         try:
             descriptions_data = JsonOutputParser().parse(llm_response)
         except Exception as e:
             _logger.exception(e)
-            return "Sorry ! Unfortunately, I was unable to process your request due to some technical issue; I may need to get fixed up!"
+            return self._error_message
+
+        res = [
+            self._render_listing(listing, description_data["description"])
+            for listing, description_data in zip(submitted_listings, descriptions_data)
+        ]
+        return gr.HTML(self._listings_separator.join(res))
 
-        res = []
+    def _render_listing(self, listing: Document, description: str) -> str:
         listing_fields = list(
             set(Listing.field_names()) - {"vector", "image_vector", "description"}
         )
-        for listing, description_data in zip(submitted_listings, descriptions_data):
-            listing_info = dict(
-                get_listing_by_id(
-                    id=listing.metadata.get("id"), columns=listing_fields
-                )[0].metadata
-            )
-            image_bytes = listing_info.pop("image")
-            res.append(
-                self._listing_rendering_template.format(
-                    description=description_data["description"],
-                    image_uri=f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode('utf-8')}",
-                    **listing_info,
-                )
-            )
-        return gr.HTML("<br/><hr/><br/>".join(res))
+        listing_info = dict(
+            get_listing_by_id(id=listing.metadata.get("id"), columns=listing_fields)[
+                0
+            ].metadata
+        )
+        image_bytes = listing_info.pop("image")
+        return self._listing_rendering_template.format(
+            description=description,
+            image_uri=f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode('utf-8')}",
+            **listing_info,
+        )
 
     def next(self) -> Union[Any, Self]:
         if self.current_state_index >= self._substates_number:
             self.current_state_index = -1
+            self._cancel_prefetch()
             return RestartState()
         return self
 
@@ -306,7 +604,21 @@ def run():
 
         res = chat_state_machine.run(message)
         for msg in [res] if isinstance(res, str) else res:
-            history.append((None, msg))
+            if not inspect.isgenerator(msg):
+                history.append((None, msg))
+                continue
+            # streamed answer: re-render the message every time a listing is ready
+            history.append((None, None))
+            listings = []
+            for listing in msg:
+                listings.append(listing)
+                history[-1] = (
+                    None,
+                    gr.HTML(UserPrefsInputState._listings_separator.join(listings)),
+                )
+                yield history, gr.MultimodalTextbox(
+                    value=None, interactive=False
+                ), gr.Button(visible=False)
 
         is_terminal_state = chat_state_machine.is_current_state_terminal
         restart_btn = gr.Button(visible=is_terminal_state)
@@ -315,7 +627,7 @@ def run():
             interactive=not is_terminal_state,
             visible=not is_terminal_state,
         )
-        return history, chat_input, restart_btn
+        yield history, chat_input, restart_btn
 
     def reset_chat(chatbot: gr.Chatbot, chat_input: gr.MultimodalTextbox):
         chat_state_machine.reset()
@@ -357,10 +669,17 @@ def run():
             inputs=[chatbot, chat_input],
             outputs=[chatbot, chat_input, restart_btn],
             scroll_to_output=True,
+            concurrency_limit=int(CONFIG.chat_concurrency_limit),
         )
 
         app.unload(fn=lambda: chat_state_machine.reset())
 
+    # requests beyond `max_size` are rejected by gradio, the others wait in
+    # the queue with their position displayed in the chat
+    app.queue(
+        default_concurrency_limit=int(CONFIG.chat_concurrency_limit),
+        max_size=int(CONFIG.chat_queue_max_size),
+    )
     app.launch()
 
 
@@ -0,0 +1,158 @@
+"""
+Local (rule based, no llm call) extraction of the structured preferences
+(price, bedrooms, bathrooms and size ranges, neighborhoods and amenities)
+from the chat answers, turned into search filters.
+"""
+
+import re
+from typing import Dict, Iterable, List, Tuple
+
+from service_layer.filters import ListingFilters
+
+_WORD_NUMBERS = {
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6,
+    "seven": 7,
+    "eight": 8,
+    "nine": 9,
+    "ten": 10,
+}
+_MULTIPLIERS = {"k": 1e3, "thousand": 1e3, "m": 1e6, "million": 1e6}
+
+_NUMBER = r"\d[\d,]*(?:\.\d+)?"
+_MULTIPLIER = r"(?:\s*(?:k|m|thousand|million)\b)?"
+_AMOUNT = rf"\$?\s*{_NUMBER}{_MULTIPLIER}"
+_MIN_WORDS = r"at least|min(?:imum)?|more than|over|above|from|starting at"
+_MAX_WORDS = r"at most|max(?:imum)?|under|below|less than|up to|no more than|within"
+_QUANTITY = (
+    rf"(?:(?P<qualifier>{_MIN_WORDS}|{_MAX_WORDS}|between)\s+)?"
+    rf"(?P<low>{_AMOUNT})"
+    rf"(?:\s*(?:-|to|and)\s*(?P<high>{_AMOUNT}))?"
+    r"\s*(?P<plus>\+)?\s*"
+    r"(?P<unit>{unit})"
+    r"(?:\s+or\s+(?P<suffix>more|bigger|larger|less|fewer|smaller))?"
+)
+_UNITS = {
+    "bedrooms": r"(?:bed(?:room)?s?|br|bd)\b",
+    "bathrooms": r"(?:bath(?:room)?s?|ba)\b",
+    "house_size": r"(?:sq\.?\s*f(?:ee)?t|sqft|square\s+f(?:ee|oo)t|sf)\b",
+    # the currency is optional, but the amount must not be of another unit
+    "price": r"(?:dollars|usd)\b|(?!\s*(?:sq|square|sf\b|bed|bath|br\b|bd\b|ba\b))",
+}
+_PATTERNS = {
+    column: re.compile(_QUANTITY.replace("{unit}", unit))
+    for column, unit in _UNITS.items()
+}
+# a plain value is an exact count of rooms, a minimum size and a maximum price
+_PLAIN_VALUE = {
+    "bedrooms": "exact",
+    "bathrooms": "exact",
+    "house_size": "min",
+    "price": "max",
+}
+_NEGATIONS = re.compile(
+    r"\b(?:no|not|without|don't need|do not need)\s+(?:\w+\s+){0,2}$"
+)
+
+
+def extract_preferences(
+    answers: Iterable[str],
+    neighborhoods: Iterable[str] = (),
+    amenities: Dict[str, str] | None = None,
+) -> ListingFilters:
+    """
+    :param neighborhoods: names of the known neighborhoods, matched as is.
+    :param amenities: amenities vocabulary (tag: prompt), a tag being matched
+                      on its name or on its prompt.
+    """
+    text = _normalize(" \n".join(answers))
+    filters = ListingFilters()
+    for column in _UNITS:
+        low, high = _extract_range(text, column)
+        setattr(filters, f"min_{column}", low)
+        setattr(filters, f"max_{column}", high)
+    filters.neighborhoods = [
+        neighborhood
+        for neighborhood in neighborhoods
+        if re.search(rf"\b{re.escape(neighborhood.lower())}\b", text)
+    ]
+    filters.amenities = [
+        tag
+        for tag, prompt in (amenities or {}).items()
+        if _mentions(text, [tag.replace("_", " "), _strip_article(prompt)])
+    ]
+    return filters
+
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace("’", "'")
+    return re.sub(
+        rf"\b({'|'.join(_WORD_NUMBERS)})\b",
+        lambda match: str(_WORD_NUMBERS[match.group(1)]),
+        text,
+    )
+
+
+def _extract_range(text: str, column: str) -> Tuple[float | None, float | None]:
+    low = high = None
+    for match in _PATTERNS[column].finditer(text):
+        if column == "price" and not _is_price(match):
+            continue
+        value = _parse_amount(match.group("low"))
+        if match.group("high"):
+            low, high = value, _parse_amount(match.group("high"))
+            continue
+        qualifier = match.group("qualifier") or ""
+        suffix = match.group("suffix") or ""
+        if (
+            re.fullmatch(_MIN_WORDS, qualifier)
+            or match.group("plus")
+            or suffix in ("more", "bigger", "larger")
+        ):
+            low = value
+        elif re.fullmatch(_MAX_WORDS, qualifier) or suffix:
+            high = value
+        elif _PLAIN_VALUE[column] == "exact":
+            low = high = value
+        elif _PLAIN_VALUE[column] == "min":
+            low = value
+        else:
+            high = value
+    if column in ("bedrooms", "bathrooms"):
+        low, high = [None if v is None else int(v) for v in (low, high)]
+    return low, high
+
+
+def _is_price(match: re.Match) -> bool:
+    """amounts are only prices with a currency, or with a thousands multiplier"""
+    amount = match.group("low")
+    return bool(
+        match.group("unit")
+        or amount.lstrip().startswith("$")
+        or re.search(r"(?:k|m|thousand|million)$", amount)
+    )
+
+
+def _parse_amount(amount: str) -> float:
+    number = re.search(_NUMBER, amount).group(0)
+    value = float(number.replace(",", ""))
+    multiplier = re.search(r"(k|m|thousand|million)$", amount.strip())
+    return value * _MULTIPLIERS[multiplier.group(1)] if multiplier else value
+
+
+def _strip_article(prompt: str) -> str:
+    return re.sub(r"^(?:a|an|the)\s+", "", prompt.strip().lower())
+
+
+def _mentions(text: str, phrases: List[str]) -> bool:
+    for phrase in filter(None, phrases):
+        # singular or plural
+        pattern = rf"\b{re.escape(phrase.lower().rstrip('s'))}s?\b"
+        for match in re.finditer(pattern, text):
+            if not _NEGATIONS.search(text[: match.start()]):
+                return True
+    return False
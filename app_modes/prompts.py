@@ -0,0 +1,133 @@
+import logging
+import re
+from typing import List, Tuple
+
+from langchain_core.documents.base import Document
+from langchain_core.prompts import PromptTemplate
+
+from utils import count_tokens, truncate_tokens
+
+_logger = logging.getLogger(__name__)
+
+
+class TokenBudgetedPromptBuilder(object):
+    """
+    Build the personalization prompt from the questions/answers and the
+    retrieved listings while keeping it under a token budget.
+
+    When the prompt is too long, the lowest value content is cut first:
+        1. whitespaces are collapsed everywhere
+        2. the listings are truncated, starting with the lowest ranked one,
+           down to `min_listing_tokens` each
+        3. the longest answers are truncated
+    The questions, the instructions and a part of every listing are always kept.
+    """
+
+    def __init__(
+        self,
+        template: str,
+        budget: int,
+        model: str | None = None,
+        min_listing_tokens: int = 100,
+    ) -> None:
+        self._prompt = PromptTemplate(
+            template=template,
+            input_variables=["query", "context", "questions_and_answers"],
+        )
+        self._budget = budget
+        self._model = model
+        self._min_listing_tokens = min_listing_tokens
+        self.last_prompt_tokens = 0
+
+    def build(
+        self,
+        query: str,
+        questions_and_answers: List[Tuple[str, str]],
+        documents: List[Document],
+    ) -> str:
+        questions = [self._compress(q) for q, _ in questions_and_answers]
+        answers = [self._compress(a) for _, a in questions_and_answers]
+        listings = [self._format_listing(d) for d in documents]
+
+        available = self._budget - self._count(self._format(query, [], [], []))
+        overflow = (
+            self._count(self._format_qa(questions, answers))
+            + self._count(self._format_context(listings))
+            - available
+        )
+        if overflow > 0:
+            listings, overflow = self._truncate_listings(listings, overflow)
+        if overflow > 0:
+            answers, overflow = self._truncate_answers(answers, overflow)
+
+        prompt = self._format(query, questions, answers, listings)
+        self.last_prompt_tokens = self._count(prompt)
+        _logger.info(
+            "personalization prompt: %s token(s) (budget %s)",
+            self.last_prompt_tokens,
+            self._budget,
+        )
+        if self.last_prompt_tokens > self._budget:
+            _logger.warning("personalization prompt over its token budget")
+        return prompt
+
+    def _truncate_listings(
+        self, listings: List[str], overflow: int
+    ) -> Tuple[List[str], int]:
+        listings = list(listings)
+        for index in reversed(range(len(listings))):
+            if overflow <= 0:
+                break
+            tokens = self._count(listings[index])
+            keep = max(self._min_listing_tokens, tokens - overflow)
+            if keep < tokens:
+                listings[index] = truncate_tokens(listings[index], keep, self._model)
+                overflow -= tokens - keep
+        return listings, overflow
+
+    def _truncate_answers(
+        self, answers: List[str], overflow: int
+    ) -> Tuple[List[str], int]:
+        answers = list(answers)
+        tokens = [self._count(answer) for answer in answers]
+        # lower the maximum answer length until the prompt fits
+        while overflow > 0 and any(tokens):
+            longest = max(tokens)
+            cap = max(longest - overflow, longest // 2)
+            for index, count in enumerate(tokens):
+                if count > cap:
+                    answers[index] = truncate_tokens(answers[index], cap, self._model)
+                    overflow -= count - cap
+                    tokens[index] = cap
+            if cap == 0:
+                break
+        return answers, overflow
+
+    def _format(self, query, questions, answers, listings) -> str:
+        return self._prompt.format(
+            query=query,
+            questions_and_answers=self._format_qa(questions, answers),
+            context=self._format_context(listings),
+        )
+
+    def _format_qa(self, questions: List[str], answers: List[str]) -> str:
+        return "\n".join(
+            f"AI: {question}\nHuman: {answer}"
+            for question, answer in zip(questions, answers)
+        )
+
+    def _format_listing(self, document: Document) -> str:
+        # the llm returns the descriptions with the ids of their listings
+        listing = self._compress(document.page_content)
+        id = document.metadata.get("id")
+        return listing if id is None else f"Listing id: {id}\n{listing}"
+
+    def _format_context(self, listings: List[str]) -> str:
+        return "\n\n".join(listings)
+
+    def _count(self, text: str) -> int:
+        return count_tokens(text, self._model)
+
+    @staticmethod
+    def _compress(text: str) -> str:
+        return re.sub(r"\s+", " ", text).strip()
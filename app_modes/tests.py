@@ -1,6 +1,15 @@
+import time
+from concurrent.futures import Future
 from unittest import mock
 
+import pytest
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.documents.base import Document
+
 from app_modes.chat import ChatStateMachine, RestartState, UserPrefsInputState
+from app_modes.preferences import extract_preferences
+from app_modes.prompts import TokenBudgetedPromptBuilder
+from service_layer.filters import ListingFilters
 
 
 @mock.patch.object(UserPrefsInputState, "_llm")
@@ -49,3 +58,273 @@ def test_chat_machine(mock_llm):
         "I hope this was helpful to you. Please feel free to retry!",
     ]
     assert type(state_machine.current_state) is RestartState
+
+
+@mock.patch("app_modes.chat.get_worker_pool")
+@mock.patch.object(UserPrefsInputState, "_render_listing")
+@mock.patch.object(UserPrefsInputState, "_build_llm")
+@mock.patch.object(UserPrefsInputState, "_retrieve_listings")
+def test_stream_personalize(
+    mock_retrieve_listings, mock_build_llm, mock_render_listing, mock_get_worker_pool
+):
+    mock_get_worker_pool.return_value.run.side_effect = lambda fn, *args: fn(*args)
+    mock_retrieve_listings.return_value = [
+        Document(page_content="listing 1", metadata={"id": "1"}),
+        Document(page_content="listing 2", metadata={"id": "2"}),
+    ]
+    mock_render_listing.side_effect = (
+        lambda listing, description: f"{listing.metadata['id']}: {description}"
+    )
+    tokens = [
+        '```json\n[{"id": "1", "desc',
+        'ription": "nice"},',
+        ' {"id": "2", ',
+        '"description": "great"}]```',
+    ]
+    mock_build_llm.return_value.stream.return_value = iter(
+        mock.Mock(content=token) for token in tokens
+    )
+
+    state = UserPrefsInputState()
+    history = ChatMessageHistory()
+    stream = state._stream_personalize(history)
+    assert next(stream) == "1: nice"
+    # the second listing is not rendered before its description is complete
+    assert mock_render_listing.call_count == 1
+    assert list(stream) == ["2: great"]
+
+    # the descriptions are matched by id, the listings not described are
+    # rendered with their stored summary
+    tokens = [
+        '[{"id": "2", "description": "great"},',
+        ' {"id": "3", "description": "unknown"}]',
+    ]
+    mock_build_llm.return_value.stream.return_value = iter(
+        mock.Mock(content=token) for token in tokens
+    )
+    assert list(state._stream_personalize(history)) == ["2: great", "1: listing 1"]
+
+    # the descriptions with ids matching no listing are matched by position
+    tokens = [
+        '[{"id": "a", "description": "nice"},',
+        ' {"id": "b", "description": "great"}]',
+    ]
+    mock_build_llm.return_value.stream.return_value = iter(
+        mock.Mock(content=token) for token in tokens
+    )
+    assert list(state._stream_personalize(history)) == ["1: nice", "2: great"]
+
+    # the stream is cut at the deadline
+    tokens = [
+        '[{"id": "1", "description": "nice"},',
+        ' {"id": "2", "description": "great"}]',
+    ]
+    mock_build_llm.return_value.stream.return_value = iter(
+        mock.Mock(content=token) for token in tokens
+    )
+    with mock.patch("app_modes.chat.time.monotonic") as mock_monotonic:
+        mock_monotonic.side_effect = [0, 0, 1e6]
+        assert list(state._stream_personalize(history)) == ["1: nice", "2: listing 2"]
+
+    # the listings are rendered with their stored summary when the llm fails
+    mock_build_llm.return_value.stream.side_effect = Exception("llm failure")
+    assert list(state._stream_personalize(history)) == ["1: listing 1", "2: listing 2"]
+
+
+@mock.patch("app_modes.chat.get_worker_pool")
+@mock.patch.object(UserPrefsInputState, "_search_listings")
+def test_listings_prefetch(mock_search_listings, mock_get_worker_pool):
+    prefetched = Future()
+    prefetched.set_result(["prefetched listing"])
+    mock_submit = mock_get_worker_pool.return_value.submit
+    mock_submit.return_value = prefetched
+    mock_search_listings.return_value = ["listing"]
+
+    state = UserPrefsInputState()
+    history = ChatMessageHistory()
+    state.run(history, None)
+    answers = ["2000 sqft", "a garden", "a pool", "subway", "quiet"]
+    for answer in answers[:-1]:
+        state.run(history, {"text": answer})
+    mock_submit.assert_not_called()
+
+    # the retrieval starts as soon as the last text answer is received
+    state.run(history, {"text": answers[-1]})
+    text_input = "\n".join(answers)
+    mock_submit.assert_called_once_with(
+        state._search_listings,
+        text_input,
+        None,
+        [(s.question, answer) for s, answer in zip(state._substates, answers)],
+    )
+
+    assert state._retrieve_listings(text_input, None) == ["prefetched listing"]
+    mock_search_listings.assert_not_called()
+
+    # the prefetched listings are discarded when the answers changed
+    stale_prefetch = mock.Mock()
+    state._prefetch = ("other answers", stale_prefetch)
+    assert state._retrieve_listings(text_input, None) == ["listing"]
+    stale_prefetch.cancel.assert_called_once()
+    mock_search_listings.assert_called_once_with(text_input, None, ())
+
+
+@mock.patch("app_modes.chat.CONFIG")
+@mock.patch("app_modes.chat.embedd_text")
+def test_compose_query_vector(mock_embedd_text, mock_config):
+    mock_config.chat_query_composition = "weighted"
+    mock_config.chat_answer_weights = "3,1,2"
+    mock_embedd_text.return_value = [[1.0, 0.0], [0.0, 1.0]]
+    state = UserPrefsInputState()
+    answers = [
+        ("How big do you want your house to be?", "2000 sqft"),
+        ("Which amenities would you like?", "a pool"),
+    ]
+
+    vector = state._compose_query_vector(answers)
+    mock_embedd_text.assert_called_once_with(["2000 sqft", "a pool"], use_cache=True)
+    assert vector == pytest.approx([0.8320503, 0.5547002])
+
+    mock_config.chat_query_composition = "concatenated"
+    assert state._compose_query_vector(answers) is None
+
+
+@mock.patch(
+    "app_modes.prompts.truncate_tokens",
+    side_effect=lambda text, max_tokens, model: " ".join(text.split()[:max_tokens]),
+)
+@mock.patch(
+    "app_modes.prompts.count_tokens", side_effect=lambda text, model: len(text.split())
+)
+def test_token_budgeted_prompt_builder(mock_count_tokens, mock_truncate_tokens):
+    questions_and_answers = [("Size?", "big  house"), ("Amenities?", "pool gym spa")]
+    documents = [
+        Document(page_content="first listing " + "word " * 20),
+        Document(page_content="second listing " + "word " * 20),
+    ]
+    builder = TokenBudgetedPromptBuilder(
+        template="{query}\n{questions_and_answers}\n{context}",
+        budget=100,
+        min_listing_tokens=5,
+    )
+    prompt = builder.build("QUERY", questions_and_answers, documents)
+    assert prompt.startswith("QUERY\nAI: Size?\nHuman: big house\n")
+    assert builder.last_prompt_tokens == 56
+
+    # the listings are given with their ids
+    prompt = builder.build(
+        "QUERY", [], [Document(page_content="a listing", metadata={"id": "1"})]
+    )
+    assert prompt.endswith("\nListing id: 1\na listing")
+
+    # the lowest ranked listing is truncated first
+    builder._budget = 40
+    prompt = builder.build("QUERY", questions_and_answers, documents)
+    first_listing = "first listing" + " word" * 20
+    assert prompt.endswith(f"{first_listing}\n\nsecond listing word word word word")
+    assert builder.last_prompt_tokens == 40
+
+    # then the answers
+    builder._budget = 20
+    prompt = builder.build("QUERY", questions_and_answers, documents)
+    assert "Human: pool\n" in prompt
+    assert builder.last_prompt_tokens <= 20
+
+
+@mock.patch("app_modes.chat.CONFIG")
+@mock.patch.object(UserPrefsInputState, "_format_llm_prompt")
+@mock.patch.object(UserPrefsInputState, "_build_llm")
+def test_map_personalize(mock_build_llm, mock_format_llm_prompt, mock_config):
+    mock_config.chat_map_concurrency = 2
+    mock_config.chat_map_timeout = 1
+
+    def format_llm_prompt(history, documents, query):
+        return documents[0].metadata["id"]
+
+    def invoke(prompt):
+        if prompt == "2":
+            raise TimeoutError()
+        time.sleep(0.1 if prompt == "1" else 0)
+        return mock.Mock(content=f" description {prompt} ")
+
+    mock_format_llm_prompt.side_effect = format_llm_prompt
+    mock_build_llm.return_value.invoke.side_effect = invoke
+    listings = [
+        Document(page_content=f"summary {i}", metadata={"id": str(i)})
+        for i in range(1, 4)
+    ]
+
+    state = UserPrefsInputState()
+    descriptions = list(state._map_personalize(ChatMessageHistory(), listings))
+    # retrieval order is kept and a failed call falls back to the stored summary
+    assert descriptions == ["description 1", "summary 2", "description 3"]
+    mock_build_llm.assert_called_once_with(timeout=1.0, max_retries=0)
+
+
+@mock.patch("app_modes.chat.CONFIG")
+@mock.patch.object(UserPrefsInputState, "_retrieve_listings")
+@mock.patch.object(UserPrefsInputState, "_format_llm_prompt")
+@mock.patch.object(UserPrefsInputState, "_build_llm")
+def test_query_llm_deadline(
+    mock_build_llm, mock_format_llm_prompt, mock_retrieve_listings, mock_config
+):
+    mock_config.chat_llm_deadline = 0.2
+    mock_config.chat_llm_hedging = False
+    listings = [Document(page_content="summary", metadata={"id": "1"})]
+    mock_retrieve_listings.return_value = listings
+
+    def slow_invoke(prompt):
+        time.sleep(1)
+        return mock.Mock(content="[]")
+
+    mock_build_llm.return_value.invoke.side_effect = slow_invoke
+    state = UserPrefsInputState()
+    start = time.monotonic()
+    assert state._query_llm(ChatMessageHistory(), "text", None) == (listings, None)
+    assert time.monotonic() - start < 0.5
+
+    with mock.patch.object(UserPrefsInputState, "_render_listing") as mock_render:
+        mock_render.side_effect = lambda listing, description: description
+        html = state._process_llm_response(None, listings)
+    assert "summary" in str(html.value)
+
+
+@pytest.mark.parametrize(
+    "answer, expected",
+    [
+        (
+            "at least 2000 sqft, 3 bedrooms",
+            ListingFilters(min_house_size=2000, min_bedrooms=3, max_bedrooms=3),
+        ),
+        (
+            "between $500k and $700k, 2+ baths",
+            ListingFilters(min_price=500_000, max_price=700_000, min_bathrooms=2),
+        ),
+        (
+            "under $1M, three bedrooms or more, 2k sqft",
+            ListingFilters(max_price=1_000_000, min_bedrooms=3, min_house_size=2000),
+        ),
+        (
+            "2,000-2,500 sq ft in green oaks",
+            ListingFilters(
+                min_house_size=2000, max_house_size=2500, neighborhoods=["Green Oaks"]
+            ),
+        ),
+        (
+            "a pool and hardwood floor, no home gym, 5 minutes from school",
+            ListingFilters(amenities=["pool", "hardwood_floors"]),
+        ),
+        ("something cozy", ListingFilters()),
+    ],
+)
+def test_extract_preferences(answer, expected):
+    amenities = {
+        "pool": "a swimming pool",
+        "gym": "a home gym",
+        "hardwood_floors": "hardwood floors",
+    }
+    filters = extract_preferences(
+        [answer], neighborhoods=["Green Oaks", "Maple Grove"], amenities=amenities
+    )
+    assert filters == expected
+    assert bool(filters) is (expected != ListingFilters())
@@ -0,0 +1,81 @@
+"""
+Listings generation with the sequential and the concurrent llm calls, against
+the local OpenAI stub server optionally rejecting some requests with a 429.
+"""
+
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from typing import Dict
+
+import pandas as pd
+
+from data.data_generator import DataGenerator
+from utils import get_chat_model
+
+from .openai_stub import OpenAIStubServer
+
+_logger = logging.getLogger(__name__)
+
+
+def _listings_reply(body: Dict) -> str:
+    prompt = body["messages"][-1]["content"]
+    rows = [
+        f'{number},"Green Oaks","$800,000",3,2,"2000 sqft","description","neighborhood"'
+        for number in re.findall(r"^(\d+)\|", prompt, flags=re.MULTILINE)
+    ]
+    return "```csv\nnumber,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description\n{}```".format(  # noqa: E501
+        "\n".join(rows)
+    )
+
+
+def run(
+    pictures: int = 100,
+    latency: float = 0.2,
+    rate_limited: float = 0.1,
+    concurrencies=(1, 4, 8),
+) -> Dict:
+    results = {}
+    status = lambda body: 429 if random.random() < rate_limited else 200  # noqa: E731
+    with OpenAIStubServer(
+        latency=latency, reply=_listings_reply, status=status
+    ) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        descriptions_file = os.path.join(tmp_dir, "descriptions.csv")
+        pd.DataFrame(
+            dict(
+                number=range(1, pictures + 1),
+                picture_file=[f"picture_{i}.jpg" for i in range(pictures)],
+                image_desc=["a bright living room"] * pictures,
+            )
+        ).to_csv(descriptions_file, index=False)
+
+        for concurrency in concurrencies:
+            generator = DataGenerator(request_cool_down=0, concurrency=concurrency)
+            # the retries are left to the generation engine
+            generator._llm = get_chat_model(
+                base_url=server.base_url, api_key="stub", max_retries=0
+            )
+            output_file = os.path.join(tmp_dir, f"listings_{concurrency}.csv")
+            server.reset_stats()
+            start = time.perf_counter()
+            generator.generate_pictures_augmented_listings(
+                picture_desc_file=descriptions_file, output_file=output_file
+            )
+            elapsed = time.perf_counter() - start
+            numbers = pd.read_csv(output_file)["number"].tolist()
+            results[concurrency] = dict(
+                elapsed=elapsed,
+                requests=server.requests,
+                ordered=numbers == list(range(1, pictures + 1)),
+            )
+            _logger.info(
+                "concurrency %s: %.2fs, %s request(s), output in order: %s",
+                concurrency,
+                elapsed,
+                server.requests,
+                results[concurrency]["ordered"],
+            )
+    return results
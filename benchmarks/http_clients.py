@@ -0,0 +1,51 @@
+"""
+Compare a new OpenAI client per call with the clients sharing the process
+wide http connections pool, against the local OpenAI stub server.
+"""
+
+import logging
+import time
+from typing import Callable, Dict
+
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from utils import get_chat_model, get_openai_embeddings
+
+from .openai_stub import OpenAIStubServer
+
+_logger = logging.getLogger(__name__)
+
+
+def _measure(server: OpenAIStubServer, call: Callable, requests: int) -> Dict:
+    server.reset_stats()
+    start = time.perf_counter()
+    for _ in range(requests):
+        call()
+    elapsed = time.perf_counter() - start
+    return dict(mean_latency=elapsed / requests, connections=server.connections)
+
+
+def run(requests: int = 50, latency: float = 0.01) -> Dict:
+    results = {}
+    with OpenAIStubServer(latency=latency) as server:
+        params = dict(base_url=server.base_url, api_key="stub")
+        embeddings_params = dict(check_embedding_ctx_length=False, **params)
+        scenarios = {
+            "chat, new client per call": lambda: ChatOpenAI(**params).invoke("hi"),
+            "chat, shared client": lambda: get_chat_model(**params).invoke("hi"),
+            "embeddings, new client per call": lambda: OpenAIEmbeddings(
+                **embeddings_params
+            ).embed_query("hi"),
+            "embeddings, shared client": lambda: get_openai_embeddings(
+                **embeddings_params
+            ).embed_query("hi"),
+        }
+        for name, call in scenarios.items():
+            results[name] = _measure(server, call, requests)
+            _logger.info(
+                "%s: %.2fms per request, %s connection(s) opened",
+                name,
+                results[name]["mean_latency"] * 1000,
+                results[name]["connections"],
+            )
+    return results
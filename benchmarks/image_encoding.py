@@ -0,0 +1,64 @@
+"""
+Encoding of the listing pictures into data URLs: full decoding, draft mode
+decoding, and the encoded pictures cache (cold then warm).
+"""
+
+import glob
+import logging
+import tempfile
+import time
+from mimetypes import guess_type
+from typing import Callable, Dict, List
+
+from config import CONFIG
+from utils.images import (
+    b64encode_image,
+    local_image_to_data_url,
+    open_image,
+    resize_image,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+def _full_decode(image_path: str) -> str:
+    mime_type, _ = guess_type(image_path)
+    image = resize_image(open_image(image_path))
+    return b64encode_image(image, format=mime_type.split("/")[-1])
+
+
+def _measure(pictures: List[str], encode: Callable[[str], str], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for picture in pictures:
+            encode(picture)
+    return (time.perf_counter() - start) / (repeat * len(pictures))
+
+
+def run(picture_dir: str = CONFIG.LISTING_PICTURES_DIR, repeat: int = 3) -> Dict:
+    pictures = sorted(
+        glob.glob(f"./{picture_dir}/*.jpg") + glob.glob(f"./{picture_dir}/*.jpeg")
+    )
+    if not pictures:
+        _logger.warning("no pictures in %s", picture_dir)
+        return {}
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        scenarios = {
+            "full decode": _full_decode,
+            "draft decode": lambda p: local_image_to_data_url(p, cache_dir=""),
+            "cache, cold": lambda p: local_image_to_data_url(p, cache_dir=cache_dir),
+            "cache, warm": lambda p: local_image_to_data_url(p, cache_dir=cache_dir),
+        }
+        for name, encode in scenarios.items():
+            # the cold cache is only cold on its first pass
+            results[name] = _measure(
+                pictures, encode, 1 if name == "cache, cold" else repeat
+            )
+            _logger.info(
+                "%s: %.2fms per picture (%s pictures)",
+                name,
+                results[name] * 1000,
+                len(pictures),
+            )
+    return results
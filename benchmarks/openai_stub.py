@@ -0,0 +1,178 @@
+"""
+Local OpenAI compatible server (chat completions and embeddings) answering
+after an injected latency, to benchmark and test the llm calls offline.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Union
+
+
+class OpenAIStubServer(object):
+    """
+    :param latency: seconds to wait before answering, or a callable computing
+                    them from the request body.
+    :param reply: content of the chat completions, or a callable computing it
+                  from the request body.
+    :param status: http status of the answers, or a callable computing it from
+                   the request body (429 to simulate the rate limiting).
+    """
+
+    def __init__(
+        self,
+        latency: Union[float, Callable[[Dict], float]] = 0.0,
+        reply: Union[str, Callable[[Dict], str]] = "stub answer",
+        status: Union[int, Callable[[Dict], int]] = 200,
+        embedding_size: int = 1536,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.reply = reply
+        self.status = status
+        self.embedding_size = embedding_size
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "OpenAIStubServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+
+    def __enter__(self) -> "OpenAIStubServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _count(self, attribute: str) -> None:
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _resolve(self, value, body: Dict):
+        return value(body) if callable(value) else value
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive connections
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                stub._count("connections")
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                stub._count("requests")
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                time.sleep(stub._resolve(stub.latency, body))
+                status = stub._resolve(stub.status, body)
+                if status != 200:
+                    error = {"message": f"stub error {status}", "type": "stub_error"}
+                    return self._send_json({"error": error}, status)
+                if self.path.endswith("/chat/completions"):
+                    content = stub._resolve(stub.reply, body)
+                    if body.get("stream"):
+                        return self._stream_completion(body, content)
+                    return self._send_json(self._completion(body, content))
+                if self.path.endswith("/embeddings"):
+                    return self._send_json(self._embeddings(body))
+                self.send_error(404)
+
+            def _completion(self, body: Dict, content: str) -> Dict:
+                completion_tokens = len(content.split())
+                return {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 1,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": completion_tokens + 1,
+                    },
+                }
+
+            def _stream_completion(self, body: Dict, content: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for word in content.split(" "):
+                    chunk = {
+                        "id": "chatcmpl-stub",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body.get("model", "stub"),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"content": f"{word} "},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def _embeddings(self, body: Dict) -> Dict:
+                inputs = body.get("input")
+                inputs = inputs if isinstance(inputs, list) else [inputs]
+                return {
+                    "object": "list",
+                    "model": body.get("model", "stub"),
+                    "data": [
+                        {
+                            "object": "embedding",
+                            "index": index,
+                            "embedding": [1.0 / stub.embedding_size]
+                            * stub.embedding_size,
+                        }
+                        for index, _ in enumerate(inputs)
+                    ],
+                    "usage": {"prompt_tokens": 1, "total_tokens": 1},
+                }
+
+            def _send_json(self, data: Dict, status: int = 200) -> None:
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
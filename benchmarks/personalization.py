@@ -0,0 +1,95 @@
+"""
+Compare the latency of the "stuff" personalization (one llm call for all the
+listings) with the "map" one (one concurrent llm call per listing), against a
+local fake llm whose latency grows with the length of its answer.
+"""
+
+import json
+import logging
+import re
+import time
+from typing import Dict, List
+from unittest import mock
+
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.documents.base import Document
+from langchain_core.messages import AIMessage
+
+from app_modes.chat import UserPrefsInputState
+
+_logger = logging.getLogger(__name__)
+
+
+class FakeLLM(object):
+    """answers after `latency` + `seconds_per_token` for every generated token"""
+
+    def __init__(
+        self,
+        latency: float = 0.3,
+        seconds_per_token: float = 0.002,
+        tokens_per_description: int = 150,
+    ) -> None:
+        self._latency = latency
+        self._seconds_per_token = seconds_per_token
+        self._tokens_per_description = tokens_per_description
+
+    def invoke(self, prompt: str) -> AIMessage:
+        listing_ids = re.findall(r"Listing id: (\w+)", prompt)
+        time.sleep(
+            self._latency
+            + self._seconds_per_token * self._tokens_per_description * len(listing_ids)
+        )
+        description = "personalized " * self._tokens_per_description
+        if "json object array" in prompt:
+            return AIMessage(
+                content=json.dumps(
+                    [dict(id=id, description=description) for id in listing_ids]
+                )
+            )
+        return AIMessage(content=description)
+
+
+def _listings(count: int) -> List[Document]:
+    return [
+        Document(
+            page_content=f"Listing id: {i}\nDescription: " + "nice house " * 100,
+            metadata={"id": str(i)},
+        )
+        for i in range(count)
+    ]
+
+
+def run(limits: List[int] = [3, 6, 10], repeat: int = 3) -> Dict:
+    history = ChatMessageHistory()
+    history.add_ai_message("How big do you want your house to be?")
+    history.add_user_message("3 bedrooms with a garden")
+
+    results = {}
+    for limit in limits:
+        listings = _listings(limit)
+        with mock.patch.object(
+            UserPrefsInputState, "_build_llm", return_value=FakeLLM()
+        ), mock.patch.object(
+            UserPrefsInputState, "_retrieve_listings", return_value=listings
+        ), mock.patch.object(
+            UserPrefsInputState,
+            "_render_listing",
+            side_effect=lambda listing, description: description,
+        ), mock.patch(
+            "app_modes.chat.CONFIG"
+        ) as config:
+            config.llm_model = "gpt-4o-mini"
+            config.chat_prompt_token_budget = 100_000
+            config.chat_prompt_min_listing_tokens = 100
+            config.chat_map_concurrency = limit
+            config.chat_map_timeout = 30
+            state = UserPrefsInputState()
+            for mode in ("stuff", "map"):
+                config.chat_personalization_mode = mode
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    state._personalize(history)
+                elapsed = (time.perf_counter() - start) / repeat
+                results[(mode, limit)] = elapsed
+                _logger.info("%s mode, %s listings: %.3fs", mode, limit, elapsed)
+    return results
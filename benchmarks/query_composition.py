@@ -0,0 +1,96 @@
+"""
+Compare the listings retrieved with the weighted composition of the answers
+embeddings (CHAT_QUERY_COMPOSITION=weighted) against the ones retrieved by
+embedding the concatenated answers.
+"""
+
+import logging
+from typing import Dict, List
+
+import numpy as np
+
+from app_modes.chat import TextInputQuestion, UserPrefsInputState
+from service_layer.services import get_relevant_listings
+from utils import compose_vectors, embedd_text, normalize
+
+_logger = logging.getLogger(__name__)
+
+SAMPLE_PROFILES = [
+    [
+        "Around 1500 sqft",
+        "A big kitchen, a quiet street and a garden",
+        "A gym and a pool",
+        "A subway station nearby",
+        "Rather urban",
+    ],
+    [
+        "A small 1 bedroom condo",
+        "Price, natural light and a balcony",
+        "A rooftop terrace",
+        "Bike paths",
+        "Downtown",
+    ],
+    [
+        "At least 4 bedrooms",
+        "A backyard for the kids, schools and safety",
+        "A two-car garage",
+        "Easy access to the highway",
+        "Suburban and calm",
+    ],
+]
+
+
+def _search(text: str, text_vector: List[float] | None, limit: int) -> Dict:
+    listings = get_relevant_listings(
+        text=text, text_vector=text_vector, columns=["id", "vector"], limit=limit
+    )
+    return {listing.metadata["id"]: listing.metadata["vector"] for listing in listings}
+
+
+def _coverage(listings_vectors: List, answers_vectors: np.ndarray) -> float:
+    """
+    similarity of the retrieved listings to the least satisfied answer:
+    how well every preference, not just the dominant one, is covered
+    """
+    similarities = normalize(listings_vectors) @ answers_vectors.T
+    return float(similarities.max(axis=0).min())
+
+
+def run(limit: int = 3, profiles: List[List[str]] = SAMPLE_PROFILES) -> Dict:
+    questions = [
+        state.question
+        for state in UserPrefsInputState._substates
+        if isinstance(state, TextInputQuestion)
+    ]
+    weights = UserPrefsInputState()._answer_weights()
+    overlaps, concatenated_coverage, weighted_coverage = [], [], []
+    for answers in profiles:
+        answers_vectors = normalize(embedd_text(answers, use_cache=True))
+        text = "\n".join(answers)
+        concatenated = _search(text, None, limit)
+        weighted = _search(
+            text,
+            compose_vectors(answers_vectors, [weights.get(q, 1.0) for q in questions]),
+            limit,
+        )
+        overlaps.append(len(concatenated.keys() & weighted.keys()) / limit)
+        concatenated_coverage.append(
+            _coverage(list(concatenated.values()), answers_vectors)
+        )
+        weighted_coverage.append(_coverage(list(weighted.values()), answers_vectors))
+
+    results = {
+        f"overlap@{limit}": float(np.mean(overlaps)),
+        "concatenated_min_answer_similarity": float(np.mean(concatenated_coverage)),
+        "weighted_min_answer_similarity": float(np.mean(weighted_coverage)),
+        # characters embedded again when a single answer changes after a restart
+        "concatenated_reembedded_chars": float(
+            np.mean([len("\n".join(answers)) for answers in profiles])
+        ),
+        "weighted_reembedded_chars": float(
+            np.mean([np.mean([len(a) for a in answers]) for answers in profiles])
+        ),
+    }
+    for key, value in results.items():
+        _logger.info("%s: %.3f", key, value)
+    return results
@@ -0,0 +1,104 @@
+"""
+Hit and false hit rates of the semantic query cache (SEMANTIC_CACHE_*) by
+threshold, on labelled pairs of preferences worded differently: a hit on a
+pair with the same meaning is expected, a hit on a pair with another meaning
+is a false hit.
+"""
+
+import logging
+import time
+from typing import Dict, List, Tuple
+
+from langchain_core.documents.base import Document
+
+from service_layer.cache import SemanticQueryCache
+from utils import embedd_text
+
+_logger = logging.getLogger(__name__)
+
+# (cached query, new query, same meaning)
+LABELLED_PAIRS = [
+    (
+        "A 3 bedroom house with a big garden in a quiet area",
+        "Quiet neighborhood, 3 bedrooms and a large backyard",
+        True,
+    ),
+    (
+        "A modern condo downtown close to the subway",
+        "Contemporary apartment in the city center near a metro station",
+        True,
+    ),
+    (
+        "A family home near good schools and parks",
+        "House for a family, close to schools and playgrounds",
+        True,
+    ),
+    (
+        "A small studio with a balcony, lots of natural light",
+        "Bright small studio apartment with a balcony",
+        True,
+    ),
+    (
+        "A 3 bedroom house with a big garden in a quiet area",
+        "A 3 bedroom condo downtown with no garden",
+        False,
+    ),
+    (
+        "A modern condo downtown close to the subway",
+        "A farmhouse in the countryside with land for horses",
+        False,
+    ),
+    (
+        "A family home near good schools and parks",
+        "A family home near good schools and parks, with a pool and a gym",
+        False,
+    ),
+    (
+        "A small studio with a balcony, lots of natural light",
+        "A large penthouse with a rooftop terrace",
+        False,
+    ),
+]
+
+
+def run(
+    thresholds: Tuple[float, ...] = (0.85, 0.9, 0.93, 0.95, 0.97),
+    pairs: List[Tuple[str, str, bool]] = LABELLED_PAIRS,
+) -> Dict[float, Dict[str, float]]:
+    vectors = embedd_text(
+        [text for cached, new, _ in pairs for text in (cached, new)], use_cache=True
+    )
+    results = {}
+    for threshold in thresholds:
+        # every pair in its own search context, the new query of a pair can
+        # only be served by the cached query of the pair
+        cache = SemanticQueryCache(max_entries=len(pairs), threshold=threshold)
+        for index, (cached, _, _) in enumerate(pairs):
+            document = Document(page_content=cached, metadata={"id": str(index)})
+            cache.put(vectors[2 * index], index, 0, [document], 0.0)
+        hits = false_hits = 0
+        lookup_seconds = 0.0
+        for index, (_, _, same_meaning) in enumerate(pairs):
+            start = time.perf_counter()
+            entry = cache.lookup(vectors[2 * index + 1], index, 0)
+            lookup_seconds += time.perf_counter() - start
+            hits += entry is not None and same_meaning
+            false_hits += entry is not None and not same_meaning
+        same_pairs = sum(same for _, _, same in pairs)
+        results[threshold] = {
+            "hit_rate": hits / same_pairs if same_pairs else 0.0,
+            "false_hit_rate": (
+                false_hits / (len(pairs) - same_pairs)
+                if len(pairs) > same_pairs
+                else 0.0
+            ),
+            "lookup_ms": 1000 * lookup_seconds / len(pairs),
+        }
+        _logger.info(
+            "threshold %.2f: hit rate %.2f, false hit rate %.2f, lookup %.3fms",
+            threshold,
+            results[threshold]["hit_rate"],
+            results[threshold]["false_hit_rate"],
+            results[threshold]["lookup_ms"],
+        )
+    return results
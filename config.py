@@ -17,14 +17,113 @@ class config(object):
         self.llm_model = "gpt-4o-mini"
         self.llm_temperature = 0
         self.llm_request_cooldown_time = 5
+        # data generation: parallel llm calls within the quotas (0: no limit,
+        # the requests quota defaults to one request per cool down time)
+        self.llm_concurrency = 1
+        self.llm_requests_per_minute = 0
+        self.llm_tokens_per_minute = 0
+        self.llm_max_retries = 5
+        # listings generation requests are packed up to MAX_TOKENS of expected
+        # output and LLM_CONTEXT_TOKENS of prompt + output, the output per listing
+        # being LLM_LISTING_OUTPUT_TOKENS until measured on the responses
+        self.llm_listing_output_tokens = 350
+        self.llm_context_tokens = 128_000
+        # follow-up requests for the listings missing or invalid in a response
+        self.llm_row_retries = 2
         self.listing_pictures_dir = "./listing_pictures"
         self.listing_pictures_descr_file = (
             "./listing_pictures/pictures_descriptions.csv"
         )
         self.listing_file = "./picture_augmented_listings.csv"
+        # encoded pictures sent to the llm, empty to disable the cache
+        self.image_cache_dir = "./image_cache"
+        # describe only one of the near-identical pictures (perceptual hashes
+        # within the max distance, in bits), hashed by workers processes (0: 1 per core)
+        self.pictures_dedup = True
+        self.pictures_dedup_max_distance = 4
+        self.pictures_dedup_workers = 0
 
+        # off | on | replay (serve only cached responses, never call the llm)
+        self.llm_cache_mode = "off"
+        self.llm_cache_path = "./llm_cache/responses.sqlite"
+        self.llm_cache_ttl = 30 * 24 * 3600
+        self.llm_cache_max_entries = 100_000
+
+        # http connections pool shared by the openai clients
+        self.http_max_connections = 20
+        self.http_max_keepalive_connections = 10
+        self.http_keepalive_expiry = 30
+        self.http_timeout = 60
+        self.http_connect_timeout = 5
+        self.http2 = False
+
+        # zero-shot CLIP tagging of the listings pictures at ingestion,
+        # `tag:prompt` pairs, a picture being tagged when it matches the prompt
+        # better than a plain house picture with a probability >= the threshold
+        self.amenity_tags = (
+            "pool:a swimming pool,gym:a home gym,garage:a garage,"
+            "hardwood_floors:hardwood floors,fireplace:a fireplace"
+        )
+        self.amenity_tag_prompt = "a photo of a house with {}"
+        self.amenity_tag_threshold = 0.5
+
+        # "lancedb" or "numpy" (in process arrays, saved under NUMPY_DB_PATH
+        # when set, in memory only otherwise)
         self.vector_db_engine = "lancedb"
         self.vector_db_uri = "./homematch"
+        self.numpy_db_path = ""
+        # quantized vector columns (`app.py quantize`): the best candidates found
+        # with the codes, RERANK_FACTOR times the search limit, are ranked again
+        # with their full vectors
+        self.numpy_db_rerank_factor = 10
+        # search results cached in memory until the listings table changes,
+        # 0 entries disables the cache
+        self.search_cache_max_entries = 256
+        self.search_cache_max_mb = 64
+        # text searches served with the results of a previous search whose query
+        # vector is at least SEMANTIC_CACHE_THRESHOLD similar, 0 entries disables
+        # it; the cached listings are ranked again for the new query with RERANK,
+        # and VERIFY_RATE of the hits are checked against the actual search
+        self.semantic_cache_max_entries = 0
+        self.semantic_cache_threshold = 0.95
+        self.semantic_cache_rerank = True
+        self.semantic_cache_verify_rate = 0
+
+        # `app.py watch`: seconds between the scans of the pictures directory,
+        # and seconds a new picture must stay unchanged before being ingested
+        self.watch_interval = 2
+        self.watch_settle_time = 1
+        self.watch_batch_size = 50
+        self.watch_state_file = "./homematch/watched_pictures.json"
+
+        # `app.py recommend`: profiles searched together, by every process
+        # (0 processes: one per core)
+        self.recommend_chunk_size = 256
+        self.recommend_workers = 0
+
+        self.chat_concurrency_limit = 1
+        self.chat_queue_max_size = 32
+        self.chat_worker_pool_size = 4
+        self.chat_stream_llm_response = True
+        # "weighted": combine the embeddings of every answer, "concatenated":
+        # embed all the answers as a single text
+        self.chat_query_composition = "weighted"
+        self.chat_answer_weights = "1,1,1,1,1"
+        # filter the listings with the sizes, rooms, prices, neighborhoods and
+        # amenities found in the answers before the vector search
+        self.chat_preference_filters = True
+        self.chat_prompt_token_budget = 4000
+        self.chat_prompt_min_listing_tokens = 100
+        # "stuff": one llm call for all the listings, "map": one call per listing
+        self.chat_personalization_mode = "stuff"
+        self.chat_map_concurrency = 3
+        self.chat_map_timeout = 30
+        # seconds before giving up on the llm and showing the stored summaries
+        self.chat_llm_deadline = 60
+        # send a duplicate llm request when the first one is slower than the
+        # p95 of the latest ones (or CHAT_LLM_HEDGE_AFTER seconds at start)
+        self.chat_llm_hedging = False
+        self.chat_llm_hedge_after = 10
 
         for key, value in dotenv_values().items():
             setattr(self, key.lower(), value)
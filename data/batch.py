@@ -0,0 +1,63 @@
+"""
+Read and write the JSONL files of the OpenAI batch API, so the generation
+prompts can be submitted as a batch job and its results imported offline.
+"""
+
+import json
+import logging
+from typing import Dict, Iterable
+
+_logger = logging.getLogger(__name__)
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+def batch_request(
+    custom_id: str, prompt: str, model: str, max_tokens: int, temperature: float
+) -> Dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": CHAT_COMPLETIONS_URL,
+        "body": {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [{"role": "user", "content": prompt}],
+        },
+    }
+
+
+def write_batch_requests(batch_file: str, requests: Iterable[Dict]) -> int:
+    count = 0
+    with open(batch_file, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+            count += 1
+    _logger.info("%s request(s) written to %s", count, batch_file)
+    return count
+
+
+def read_batch_responses(batch_file: str) -> Dict[str, str]:
+    """
+    Return the completion content of every successful response by custom id,
+    the failed requests are logged and left out.
+    """
+    contents = {}
+    with open(batch_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                _logger.warning(
+                    "batch request %s failed: %s",
+                    result.get("custom_id"),
+                    result.get("error") or response.get("body"),
+                )
+                continue
+            choices = response["body"]["choices"]
+            contents[result["custom_id"]] = choices[0]["message"]["content"]
+    _logger.info("%s response(s) read from %s", len(contents), batch_file)
+    return contents
@@ -1,18 +1,37 @@
+import contextlib
+import functools
 import glob
 import itertools
+import json
+import logging
+import math
 import os
-from io import StringIO
-from typing import Dict, List
+import threading
+from typing import Dict, Iterable, Iterator, List, Set
 
 import pandas as pd
 from langchain.chains.conversation.base import ConversationChain
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from ratelimit import limits, sleep_and_retry
 
 from config import CONFIG
+from utils.clients import get_chat_model
 from utils.images import local_image_to_data_url
-from utils.lists import split_in_chunks
+from utils.tokens import count_tokens
+from utils.utils import to_bool
+
+from .batch import batch_request, read_batch_responses, write_batch_requests
+from .dedup import group_duplicate_pictures
+from .engine import AsyncGenerationEngine, GenerationStats
+from .parsing import ParsedListings, parse_listings_csv
+
+_logger = logging.getLogger(__name__)
+
+# rough cost of a picture in the prompt, for the tokens per minute quota
+IMAGE_TOKENS = 765
+# listings per request before the token budget driven chunking, for reporting
+FIXED_CHUNK_SIZE = 5
+# headroom over the measured output tokens per listing, the listings vary in size
+OUTPUT_TOKENS_MARGIN = 1.25
 
 
 class DataGenerator(object):
@@ -20,105 +39,564 @@ class DataGenerator(object):
     class NonExistentFileException(Exception):
         pass
 
+    class ManifestMismatchException(Exception):
+        pass
+
     def __init__(
         self,
         model=CONFIG.LLM_MODEL,
         max_token=CONFIG.MAX_TOKENS,
         temperature=CONFIG.LLM_TEMPERATURE,
         request_cool_down=int(CONFIG.LLM_REQUEST_COOLDOWN_TIME),
+        concurrency=int(CONFIG.LLM_CONCURRENCY),
+        requests_per_minute=float(CONFIG.LLM_REQUESTS_PER_MINUTE),
+        tokens_per_minute=float(CONFIG.LLM_TOKENS_PER_MINUTE),
+        max_retries=int(CONFIG.LLM_MAX_RETRIES),
+        listing_output_tokens=int(CONFIG.LLM_LISTING_OUTPUT_TOKENS),
+        context_tokens=int(CONFIG.LLM_CONTEXT_TOKENS),
+        row_retries=int(CONFIG.LLM_ROW_RETRIES),
+        dedup_pictures=to_bool(CONFIG.PICTURES_DEDUP),
+        dedup_max_distance=int(CONFIG.PICTURES_DEDUP_MAX_DISTANCE),
+        dedup_workers=int(CONFIG.PICTURES_DEDUP_WORKERS),
         verbose=False,
     ) -> None:
         self.llm_model = model
-        self._max_token = max_token
+        self._max_token = int(max_token)
         self._temperature = temperature
         self._request_cool_down = request_cool_down
+        self._concurrency = concurrency
+        # without an explicit quota, keep the cool down between two requests
+        self._requests_per_minute = requests_per_minute or (
+            60 / request_cool_down if request_cool_down else 0
+        )
+        # one request at a time, spaced by the cool down
+        self._requests_burst = 0 if requests_per_minute else 1
+        self._tokens_per_minute = tokens_per_minute
+        self._max_retries = max_retries
+        self._listing_output_tokens = listing_output_tokens
+        self._context_tokens = context_tokens
+        self._row_retries = row_retries
+        self._dedup_pictures = dedup_pictures
+        self._dedup_max_distance = dedup_max_distance
+        self._dedup_workers = dedup_workers
+        self.stats = GenerationStats()
+        self._stats_lock = threading.Lock()
         self._verbose = verbose
-        self._llm = ChatOpenAI(
-            model=model, max_tokens=max_token, temperature=temperature
+        # the rate limit retries are made by the generation engine
+        self._llm = get_chat_model(
+            model=model, max_tokens=max_token, temperature=temperature, max_retries=0
         )
 
     def generate_pictures_descriptions(
         self,
         picture_dir=CONFIG.LISTING_PICTURES_DIR,
         output_file=CONFIG.LISTING_PICTURES_DESCR_FILE,
+        restart: bool = False,
+    ) -> None:
+        """
+        Describe every picture of `picture_dir`, the descriptions are appended
+        to `output_file` as they are generated. When `output_file` is a path
+        holding the results of an interrupted run with the same settings, only
+        the pictures not described yet are processed, unless `restart` is set.
+        """
+        existing = self._start_job(
+            output_file,
+            "pictures_descriptions",
+            dict(picture_dir=str(picture_dir)),
+            restart,
+        )
+        processed = set(existing["picture_file"]) if existing is not None else set()
+        first_number = int(existing["number"].max()) + 1 if processed else 1
+        picture_collection = [
+            picture_file
+            for picture_file in self._list_pictures(picture_dir)
+            if picture_file not in processed
+        ]
+        if processed:
+            _logger.info(
+                "resuming: %s picture(s) already described, %s to go",
+                len(processed),
+                len(picture_collection),
+            )
+
+        # only one picture per group of near-identical ones is described
+        groups = self._group_pictures(picture_collection)
+        representatives = [p for p in picture_collection if groups[p] == p]
+
+        descriptions = self._engine().imap(
+            self._describe_picture,
+            representatives,
+            estimate_tokens=self._estimate_picture_tokens,
+        )
+        representatives_descriptions = {}
+        with contextlib.closing(descriptions):
+            for index, image_file in enumerate(picture_collection):
+                representative = groups[image_file]
+                # a representative comes before the other pictures of its group
+                if representative == image_file:
+                    representatives_descriptions[image_file] = next(descriptions)
+                picture_desc = dict(
+                    number=first_number + index,
+                    picture_file=image_file,
+                    image_desc=representatives_descriptions[representative],
+                )
+                self._append_rows(
+                    output_file,
+                    pd.DataFrame(data=[picture_desc]),
+                    header=existing is None and index == 0,
+                )
+
+    def _describe_picture(self, picture_file: str) -> str:
+        return self._get_llm_picture_description(picture_file).replace("**", "")
+
+    def _estimate_picture_tokens(self, picture_file: str) -> int:
+        return (
+            IMAGE_TOKENS
+            + count_tokens(self._PICTURE_DESCRIPTION_PROMPT)
+            + self._max_token
+        )
+
+    def _group_pictures(self, pictures: List[str]) -> Dict[str, str]:
+        if not self._dedup_pictures:
+            return {picture: picture for picture in pictures}
+        groups = group_duplicate_pictures(
+            pictures,
+            max_distance=self._dedup_max_distance,
+            workers=self._dedup_workers,
+        )
+        duplicates = sum(1 for p, r in groups.items() if p != r)
+        self._record_stats(duplicate_pictures=duplicates)
+        _logger.info(
+            "%s duplicate picture(s) out of %s, %s llm call(s) saved",
+            duplicates,
+            len(pictures),
+            duplicates,
+        )
+        return groups
+
+    def export_pictures_descriptions_batch(
+        self, batch_file: str, picture_dir=CONFIG.LISTING_PICTURES_DIR
+    ) -> int:
+        """write the pictures descriptions prompts as a batch requests file"""
+        return write_batch_requests(
+            batch_file,
+            (
+                self._batch_request(
+                    f"description:{number}:{picture_file}",
+                    self._picture_description_prompt(picture_file),
+                )
+                for number, picture_file in enumerate(
+                    self._list_pictures(picture_dir), start=1
+                )
+            ),
+        )
+
+    def import_pictures_descriptions_batch(
+        self,
+        batch_file: str,
+        picture_dir=CONFIG.LISTING_PICTURES_DIR,
+        output_file=CONFIG.LISTING_PICTURES_DESCR_FILE,
+        restart: bool = False,
     ) -> None:
+        """
+        Write the pictures descriptions of a batch responses file. The job is
+        the one of `generate_pictures_descriptions`, which can resume it to
+        describe the pictures missing from the responses.
+        """
+        existing = self._start_job(
+            output_file,
+            "pictures_descriptions",
+            dict(picture_dir=str(picture_dir)),
+            restart,
+        )
+        processed = set(existing["number"]) if existing is not None else set()
         data = []
-        picture_collection = itertools.chain(
-            glob.glob(f"./{picture_dir}/*.jpg"), glob.glob(f"./{picture_dir}/*.jpeg")
-        )
-
-        @sleep_and_retry
-        @limits(calls=1, period=self._request_cool_down)
-        def get_picture_desc(index, image_file):
-            return dict(
-                number=index,
-                picture_file=image_file,
-                image_desc=self._get_llm_picture_description(image_file).replace(
-                    "**", ""
-                ),
+        for custom_id, content in read_batch_responses(batch_file).items():
+            _, number, picture_file = custom_id.split(":", 2)
+            if int(number) not in processed:
+                data.append(
+                    dict(
+                        number=int(number),
+                        picture_file=picture_file,
+                        image_desc=content.replace("**", ""),
+                    )
+                )
+        if data:
+            self._append_rows(
+                output_file,
+                pd.DataFrame(data=sorted(data, key=lambda row: row["number"])),
+                header=existing is None,
             )
 
-        for index, image_file in enumerate(picture_collection):
-            data.append(get_picture_desc(index + 1, image_file))
-        df = pd.DataFrame(data=data)
-        df.to_csv(output_file, index=False)
+    def _batch_request(self, custom_id: str, prompt: str) -> Dict:
+        return batch_request(
+            custom_id,
+            prompt,
+            model=self.llm_model,
+            max_tokens=self._max_token,
+            temperature=self._temperature,
+        )
 
-    def _get_llm_picture_description(self, picture_file):
-        prompt = PromptTemplate.from_template(
-            """{image}
+    _PICTURE_DESCRIPTION_PROMPT = """{image}
 Please describe the living room in the picture in terms of
 Living Area, Kitchen, Flooring, Entrance, Additional Features, Lighting, Windows view, ceiling.
 If a feature is missing ignore it.
 if the room as a particular feature other than enumerated please describe it too.
 Provide just the description as response"""
+
+    def _start_job(
+        self, output_file, job: str, inputs: Dict, restart: bool
+    ) -> pd.DataFrame | None:
+        """
+        Check the manifest of the job writing to `output_file` and return the
+        rows already written by a previous run, None when starting from scratch.
+        The outputs which are not paths (opened files, buffers) are never resumed.
+        """
+        if not isinstance(output_file, (str, os.PathLike)):
+            return None
+        manifest_file = f"{output_file}.manifest.json"
+        manifest = json.loads(
+            json.dumps(
+                dict(
+                    job=job,
+                    model=self.llm_model,
+                    max_token=self._max_token,
+                    temperature=self._temperature,
+                    **inputs,
+                )
+            )
+        )
+        has_output = os.path.isfile(output_file) and os.path.getsize(output_file)
+        if has_output and not restart:
+            # an output without a manifest comes from unknown settings
+            previous_manifest = None
+            if os.path.isfile(manifest_file):
+                with open(manifest_file) as f:
+                    previous_manifest = json.load(f)
+            if previous_manifest != manifest:
+                raise self.__class__.ManifestMismatchException(
+                    f"{output_file} was generated with other settings "
+                    f"({previous_manifest}), restart the job to overwrite it"
+                )
+        if restart and os.path.isfile(output_file):
+            os.remove(output_file)
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
+        if has_output and not restart:
+            return pd.read_csv(output_file)
+        return None
+
+    @staticmethod
+    def _append_rows(output_file, df: pd.DataFrame, header: bool) -> None:
+        if isinstance(output_file, (str, os.PathLike)):
+            with open(output_file, "a", newline="") as f:
+                df.to_csv(f, index=False, header=header)
+        else:
+            df.to_csv(output_file, index=False, header=header)
+
+    def _engine(self) -> AsyncGenerationEngine:
+        return AsyncGenerationEngine(
+            concurrency=self._concurrency,
+            requests_per_minute=self._requests_per_minute,
+            tokens_per_minute=self._tokens_per_minute,
+            max_retries=self._max_retries,
+            requests_burst=self._requests_burst,
+            stats=self.stats,
+        )
+
+    @staticmethod
+    def _list_pictures(picture_dir) -> List[str]:
+        return list(
+            itertools.chain(
+                sorted(glob.glob(f"./{picture_dir}/*.jpg")),
+                sorted(glob.glob(f"./{picture_dir}/*.jpeg")),
+            )
         )
+
+    def _get_llm_picture_description(self, picture_file):
         chain = ConversationChain(
             llm=self._llm,
             verbose=self._verbose,
         )
-        return chain.run(prompt.format(image=local_image_to_data_url(picture_file)))
+        return chain.run(self._picture_description_prompt(picture_file))
+
+    def _picture_description_prompt(self, picture_file) -> str:
+        prompt = PromptTemplate.from_template(self._PICTURE_DESCRIPTION_PROMPT)
+        return prompt.format(image=local_image_to_data_url(picture_file))
 
     def generate_pictures_augmented_listings(
         self,
         picture_desc_file: str = CONFIG.LISTING_PICTURES_DESCR_FILE,
         output_file: str = CONFIG.LISTING_FILE,
+        restart: bool = False,
+    ) -> None:
+        """
+        Generate a listing for every picture description, the listings are
+        appended to `output_file` as they are generated and an interrupted
+        run is resumed like in `generate_pictures_descriptions`.
+        """
+
+        picture_description_df = self._read_pictures_descriptions(picture_desc_file)
+        existing = self._start_job(
+            output_file,
+            "listings",
+            dict(picture_desc_file=str(picture_desc_file)),
+            restart,
+        )
+        processed: Set = set(existing["number"]) if existing is not None else set()
+        descriptions = [
+            description
+            for description in picture_description_df.to_dict("records")
+            if description["number"] not in processed
+        ]
+        if processed:
+            _logger.info(
+                "resuming: %s listing(s) already generated, %s to go",
+                len(processed),
+                len(descriptions),
+            )
+
+        self._write_listings(
+            self._generate_listings_chunks(descriptions),
+            picture_description_df,
+            output_file,
+            existing,
+        )
+        _logger.info("listings generation stats: %s", self.stats)
+
+    def _generate_listings_chunks(
+        self, descriptions: List[Dict]
+    ) -> Iterator[List[Dict]]:
+        """
+        Listings of the descriptions, by request. Until the output size of a
+        listing is measured, a first request is sent alone and the remaining
+        descriptions are packed with its measure.
+        """
+        engine = self._engine()
+        generate_listings = functools.partial(self._generate_listings, engine=engine)
+        if descriptions and not self.stats.parsed_rows:
+            # only the first chunk is packed with the default output size
+            first = next(self._pack_descriptions(descriptions))
+            _logger.info("measuring the listings output on %s listing(s)", len(first))
+            yield engine.call(
+                generate_listings, first, self._estimate_listings_tokens(first)
+            )
+            descriptions = descriptions[len(first) :]
+        yield from engine.imap(
+            generate_listings,
+            self._chunk_descriptions(descriptions),
+            estimate_tokens=self._estimate_listings_tokens,
+        )
+
+    def _generate_listings(
+        self, descriptions: List[Dict], engine: AsyncGenerationEngine
+    ) -> List[Dict]:
+        """
+        Validated listings of the descriptions, sorted by number. The first
+        request is made by the `engine` calling this method, the follow-ups for
+        the missing or invalid rows are made through it too.
+        """
+        listings, pending = [], descriptions
+        for attempt in range(self._row_retries + 1):
+            if not attempt:
+                response = self._generate_listings_with_llm(pending)
+            else:
+                # only the listings missing or invalid are requested again
+                self._record_stats(row_retries=1)
+                try:
+                    response = engine.call(
+                        self._generate_listings_with_llm,
+                        pending,
+                        self._estimate_listings_tokens(pending),
+                    )
+                except Exception as e:
+                    # the listings already parsed are kept
+                    _logger.warning("listings follow-up request failed: %s", e)
+                    break
+            parsed = self._process_response(
+                response, numbers=[d["number"] for d in pending]
+            )
+            listings.extend(parsed.rows)
+            pending = [d for d in pending if d["number"] not in parsed.numbers]
+            if not pending:
+                break
+        if pending:
+            _logger.warning(
+                "no valid listing generated for the number(s) %s",
+                [d["number"] for d in pending],
+            )
+        return sorted(listings, key=lambda listing: listing["number"])
+
+    def _estimate_listings_tokens(self, descriptions: List[Dict]) -> int:
+        return (
+            sum(count_tokens(d["image_desc"], self.llm_model) for d in descriptions)
+            + self._max_token
+        )
+
+    def export_listings_batch(
+        self, batch_file: str, picture_desc_file=CONFIG.LISTING_PICTURES_DESCR_FILE
+    ) -> int:
+        """write the listings generation prompts as a batch requests file"""
+        descriptions = self._read_pictures_descriptions(picture_desc_file).to_dict(
+            "records"
+        )
+        return write_batch_requests(
+            batch_file,
+            (
+                self._batch_request(
+                    "listings:" + ",".join(str(d["number"]) for d in chunk),
+                    self._listings_prompt(chunk),
+                )
+                for chunk in self._chunk_descriptions(descriptions)
+            ),
+        )
+
+    def import_listings_batch(
+        self,
+        batch_file: str,
+        picture_desc_file=CONFIG.LISTING_PICTURES_DESCR_FILE,
+        output_file=CONFIG.LISTING_FILE,
+        restart: bool = False,
     ) -> None:
+        """
+        Write the listings of a batch responses file. The job is the one of
+        `generate_pictures_augmented_listings`, which can resume it to generate
+        the listings missing from the responses.
+        """
+        picture_description_df = self._read_pictures_descriptions(picture_desc_file)
+        existing = self._start_job(
+            output_file,
+            "listings",
+            dict(picture_desc_file=str(picture_desc_file)),
+            restart,
+        )
+        processed = set(existing["number"]) if existing is not None else set()
+        responses = sorted(
+            read_batch_responses(batch_file).items(),
+            key=lambda item: int(item[0].split(":")[1].split(",")[0]),
+        )
+        self._write_listings(
+            (
+                [
+                    listing
+                    for listing in self._process_response(content).rows
+                    if listing["number"] not in processed
+                ]
+                for _, content in responses
+            ),
+            picture_description_df,
+            output_file,
+            existing,
+        )
 
+    def _read_pictures_descriptions(self, picture_desc_file) -> pd.DataFrame:
         if not os.path.isfile(picture_desc_file):
             raise self.__class__.NonExistentFileException(
                 f"Pictures desctiption files is none existant ({picture_desc_file})"
             )
-
         columns = ["number", "picture_file", "image_desc"]
-        picture_description_df = pd.read_csv(picture_desc_file)[columns]
-        descriptions = picture_description_df.to_dict("records")
-
-        def _process_response(llm_response):
-            csv_buffer = StringIO(llm_response.replace("```csv", "").replace("```", ""))
-            df = pd.read_csv(csv_buffer)
-            # df.to_csv(f"{uuid.uuid4()}.csv")
-            return df.to_dict("records")
-
-        @sleep_and_retry
-        @limits(calls=1, period=self._request_cool_down)
-        def _llm_query(descriptions) -> List[Dict]:
-            response = self._generate_listings_with_llm(descriptions)
-            return _process_response(response)
-
-        listing_data = []
-        for description_chunks in split_in_chunks(descriptions, 5):
-            listing_data.extend(_llm_query(description_chunks))
-
-        listing_df = pd.DataFrame(listing_data)
-        # joining the listings df to the files
-        picture_description_df.drop(columns=["image_desc"], axis=1, inplace=True)
-        listing_df = listing_df.join(
-            picture_description_df.set_index("number"), on="number"
-        )
-        listing_df.set_index("number")
-        listing_df.to_csv(output_file, index=False)
+        return pd.read_csv(picture_desc_file)[columns]
+
+    def _listing_output_tokens_estimate(self) -> float:
+        """
+        Output tokens per listing: the average of the responses parsed so far,
+        with some headroom, `listing_output_tokens` before any response.
+        """
+        if not self.stats.parsed_rows:
+            return self._listing_output_tokens
+        average = self.stats.output_tokens / self.stats.parsed_rows
+        return average * OUTPUT_TOKENS_MARGIN
+
+    def _max_listings_per_request(self) -> int:
+        return max(1, int(self._max_token // self._listing_output_tokens_estimate()))
+
+    def _chunk_descriptions(self, descriptions: List[Dict]) -> List[List[Dict]]:
+        chunks = list(self._pack_descriptions(descriptions))
+        fixed_chunks = math.ceil(len(descriptions) / FIXED_CHUNK_SIZE)
+        _logger.info(
+            "%s listing(s) in %s request(s), %s saved over chunks of %s",
+            len(descriptions),
+            len(chunks),
+            fixed_chunks - len(chunks),
+            FIXED_CHUNK_SIZE,
+        )
+        return chunks
+
+    def _pack_descriptions(self, descriptions: List[Dict]) -> Iterator[List[Dict]]:
+        """
+        Pack the descriptions in as few listings generation requests as possible:
+        the expected output of a request (see `_listing_output_tokens_estimate`)
+        must fit in `max_token` and its prompt plus `max_token` in the context window.
+        """
+        prompt_tokens = count_tokens(self._listings_prompt([]), self.llm_model)
+        max_listings = self._max_listings_per_request()
+        max_prompt_tokens = self._context_tokens - self._max_token
+
+        chunk, chunk_tokens = [], prompt_tokens
+        for description in descriptions:
+            tokens = count_tokens(
+                f"{description['number']}| {description['image_desc']}\n--------\n",
+                self.llm_model,
+            )
+            if chunk and (
+                len(chunk) >= max_listings or chunk_tokens + tokens > max_prompt_tokens
+            ):
+                yield chunk
+                chunk, chunk_tokens = [], prompt_tokens
+            chunk.append(description)
+            chunk_tokens += tokens
+        if chunk:
+            yield chunk
+
+    def _write_listings(
+        self,
+        listings_chunks: Iterable[List[Dict]],
+        picture_description_df: pd.DataFrame,
+        output_file,
+        existing: pd.DataFrame | None,
+    ) -> None:
+        # joining the listings to the pictures files
+        picture_files_df = picture_description_df.drop(
+            columns=["image_desc"], axis=1
+        ).set_index("number")
+        output_columns = list(existing.columns) if existing is not None else None
+        for chunk_listings in listings_chunks:
+            if not chunk_listings:
+                continue
+            listing_df = pd.DataFrame(chunk_listings).join(
+                picture_files_df, on="number"
+            )
+            header = output_columns is None
+            if header:
+                output_columns = list(listing_df.columns)
+            self._append_rows(
+                output_file, listing_df.reindex(columns=output_columns), header=header
+            )
+
+    def _process_response(
+        self, llm_response: str, numbers: List[int] | None = None
+    ) -> ParsedListings:
+        parsed = parse_listings_csv(llm_response, numbers)
+        self._record_stats(
+            parsed_rows=len(parsed.rows),
+            output_tokens=count_tokens(llm_response, self.llm_model),
+            invalid_rows=len(parsed.invalid_rows),
+            wasted_tokens=sum(
+                count_tokens(row, self.llm_model) for row in parsed.invalid_rows
+            ),
+        )
+        return parsed
+
+    def _record_stats(self, **counts: int) -> None:
+        with self._stats_lock:
+            for name, count in counts.items():
+                setattr(self.stats, name, getattr(self.stats, name) + count)
 
     def _generate_listings_with_llm(self, descriptions):
+        chain = ConversationChain(llm=self._llm, verbose=self._verbose)
+        return chain.run(self._listings_prompt(descriptions))
+
+    def _listings_prompt(self, descriptions) -> str:
         prompt = PromptTemplate(
             input_variables=["descriptions"],
             template="""
@@ -147,14 +625,11 @@ EXAMPLE:
 OUTPUT FORMAT: return the result in a csv format with the headers number,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description;
 the content of every columns must be quoted except bedrooms and bathrooms.""",
         )
-        chain = ConversationChain(llm=self._llm, verbose=self._verbose)
-        return chain.run(
-            prompt.format(
-                descriptions="\n--------\n".join(
-                    [
-                        f"{d['number']}| {d['image_desc'].replace('**','')}"
-                        for d in descriptions
-                    ]
-                ),
-            )
+        return prompt.format(
+            descriptions="\n--------\n".join(
+                [
+                    f"{d['number']}| {d['image_desc'].replace('**','')}"
+                    for d in descriptions
+                ]
+            ),
         )
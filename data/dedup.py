@@ -0,0 +1,51 @@
+"""
+Grouping of the near-identical listing pictures, so only one picture per
+group is described by the llm.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+from utils.images import dhash, open_image
+
+_logger = logging.getLogger(__name__)
+
+
+def picture_hash(picture_file: str) -> int | None:
+    try:
+        with open_image(picture_file) as image:
+            return dhash(image)
+    except Exception as e:
+        _logger.warning("could not hash %s: %s", picture_file, e)
+        return None
+
+
+def group_duplicate_pictures(
+    pictures: List[str], max_distance: int = 4, workers: int = 0
+) -> Dict[str, str]:
+    """
+    Map every picture to the representative of its group: the first picture
+    whose perceptual hash is within `max_distance` bits of its own.
+    The hashes are computed by `workers` processes (0 for one per core).
+    """
+    if len(pictures) < 2:
+        return {picture: picture for picture in pictures}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        hashes = list(
+            executor.map(picture_hash, pictures, chunksize=max(1, len(pictures) // 64))
+        )
+
+    representatives, groups = [], {}
+    for picture, hash_ in zip(pictures, hashes):
+        groups[picture] = picture
+        if hash_ is None:
+            continue
+        for representative, representative_hash in representatives:
+            if (hash_ ^ representative_hash).bit_count() <= max_distance:
+                groups[picture] = representative
+                break
+        else:
+            representatives.append((picture, hash_))
+    return groups
@@ -0,0 +1,219 @@
+import asyncio
+import inspect
+import logging
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List
+
+import openai
+
+_logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled continuously at `rate_per_minute`, usable from
+    coroutines (`acquire`) and from threads (`acquire_blocking`).
+    A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None) -> None:
+        self._rate = rate_per_minute / 60
+        self._capacity = capacity or rate_per_minute
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        await asyncio.sleep(self._reserve(amount))
+
+    def acquire_blocking(self, amount: float = 1) -> None:
+        time.sleep(self._reserve(amount))
+
+    def _reserve(self, amount: float) -> float:
+        """take `amount` tokens, possibly in advance, and return the wait time"""
+        if not self._rate:
+            return 0
+        # a request bigger than the bucket would wait forever
+        amount = min(amount, self._capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._capacity, self._tokens + (now - self._updated_at) * self._rate
+            )
+            self._updated_at = now
+            self._tokens -= amount
+            return max(0, -self._tokens / self._rate)
+
+
+@dataclass
+class GenerationStats:
+    requests: int = 0
+    retries: int = 0
+    estimated_tokens: int = 0
+    # listings rows rejected by the validation, and follow-up requests
+    invalid_rows: int = 0
+    wasted_tokens: int = 0
+    row_retries: int = 0
+    # listings rows parsed from the responses, and the tokens of the responses
+    parsed_rows: int = 0
+    output_tokens: int = 0
+    # pictures not described, their description is the one of a near-identical
+    duplicate_pictures: int = 0
+
+
+class AsyncGenerationEngine(object):
+    """
+    Run llm generation calls concurrently while respecting the requests and
+    tokens per minute quotas, retrying with an exponential backoff the calls
+    rejected with a 429 (rate limit) error.
+
+    :param concurrency: maximum number of calls running at the same time.
+    :param requests_per_minute: 0 for no limit.
+    :param requests_burst: requests sent at once when the quota allows it,
+                           a minute worth of requests by default.
+    :param tokens_per_minute: 0 for no limit.
+    :param max_retries: retries of a rate limited call before giving up.
+    :param backoff: seconds before the first retry, doubled on every retry.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 1,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 5,
+        requests_burst: int = 0,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        stats: GenerationStats | None = None,
+    ) -> None:
+        self._concurrency = max(1, concurrency)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self.stats = stats if stats is not None else GenerationStats()
+        self._stats_lock = threading.Lock()
+        # the quotas are shared by all the calls made through the engine
+        self._requests_bucket = TokenBucket(requests_per_minute, requests_burst)
+        self._tokens_bucket = TokenBucket(tokens_per_minute)
+
+    def call(self, fn: Callable[[Any], Any], item: Any, tokens: int = 0) -> Any:
+        """
+        Blocking `fn(item)` within the quotas and with the rate limit retries,
+        for the callers running their own threads.
+        """
+        for attempt in range(self._max_retries + 1):
+            self._requests_bucket.acquire_blocking(1)
+            self._tokens_bucket.acquire_blocking(tokens)
+            self._record_request(tokens)
+            try:
+                return fn(item)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt))
+
+    def map(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Any],
+        estimate_tokens: Callable[[Any], int] = lambda item: 0,
+    ) -> List[Any]:
+        return list(self.imap(fn, items, estimate_tokens))
+
+    def imap(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Any],
+        estimate_tokens: Callable[[Any], int] = lambda item: 0,
+    ) -> Iterator[Any]:
+        """
+        Yield `fn(item)` for every item, in the items order, as soon as the
+        result and the ones of all the previous items are available.
+        `fn` can be a coroutine function or a blocking function (run in a thread).
+        """
+        items = list(items)
+        results = queue.Queue()
+        loop = asyncio.new_event_loop()
+        main_task = loop.create_task(self._run_all(fn, items, estimate_tokens, results))
+
+        def _run_loop():
+            try:
+                loop.run_until_complete(main_task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.run_until_complete(loop.shutdown_default_executor())
+
+        thread = threading.Thread(target=_run_loop, daemon=True)
+        thread.start()
+
+        ready, next_index = {}, 0
+        try:
+            while next_index < len(items):
+                index, result, error = results.get()
+                if error is not None:
+                    raise error
+                ready[index] = result
+                while next_index in ready:
+                    yield ready.pop(next_index)
+                    next_index += 1
+        finally:
+            if not main_task.done():
+                loop.call_soon_threadsafe(main_task.cancel)
+            thread.join()
+            loop.close()
+
+    async def _run_all(self, fn, items, estimate_tokens, results: queue.Queue):
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def _run(index, item):
+            try:
+                async with semaphore:
+                    result = await self._call_with_retries(
+                        fn, item, estimate_tokens(item)
+                    )
+                results.put((index, result, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                results.put((index, None, e))
+
+        await asyncio.gather(*[_run(index, item) for index, item in enumerate(items)])
+
+    async def _call_with_retries(self, fn, item, tokens: int) -> Any:
+        for attempt in range(self._max_retries + 1):
+            await self._requests_bucket.acquire(1)
+            await self._tokens_bucket.acquire(tokens)
+            self._record_request(tokens)
+            try:
+                if inspect.iscoroutinefunction(fn):
+                    return await fn(item)
+                return await asyncio.to_thread(fn, item)
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """backoff before retrying a rate limited call, re-raise any other error"""
+        if not self._is_rate_limit_error(error) or attempt == self._max_retries:
+            raise error
+        delay = min(self._max_backoff, self._backoff * 2**attempt)
+        delay *= 1 + random.random() / 2
+        _logger.warning("rate limited, retrying in %.1fs: %s", delay, error)
+        with self._stats_lock:
+            self.stats.retries += 1
+        return delay
+
+    def _record_request(self, tokens: int) -> None:
+        with self._stats_lock:
+            self.stats.requests += 1
+            self.stats.estimated_tokens += tokens
+
+    @staticmethod
+    def _is_rate_limit_error(error: Exception) -> bool:
+        return (
+            isinstance(error, openai.RateLimitError)
+            or getattr(error, "status_code", None) == 429
+        )
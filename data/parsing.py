@@ -0,0 +1,108 @@
+"""
+Tolerant parsing of the listings CSV generated by the llm: every row is
+checked on its own, so one malformed row doesn't discard the whole reply.
+"""
+
+import csv
+import logging
+from dataclasses import dataclass, field
+from io import StringIO
+from typing import Dict, Iterable, List, Set
+
+from pydantic import ValidationError
+
+from models.listings import Listing
+
+_logger = logging.getLogger(__name__)
+
+LISTING_COLUMNS = [
+    "neighborhood",
+    "price",
+    "bedrooms",
+    "bathrooms",
+    "house_size",
+    "description",
+    "neighborhood_description",
+]
+
+
+@dataclass
+class ParsedListings:
+    rows: List[Dict] = field(default_factory=list)
+    # raw text of the rows rejected
+    invalid_rows: List[str] = field(default_factory=list)
+
+    @property
+    def numbers(self) -> Set[int]:
+        return {row["number"] for row in self.rows}
+
+
+def parse_listings_csv(
+    llm_response: str, expected_numbers: Iterable[int] | None = None
+) -> ParsedListings:
+    """
+    Parse the listings CSV of an llm reply row by row, keeping the rows with
+    a valid number (one of `expected_numbers` when given, not seen before)
+    and values that validate as a `Listing`.
+    """
+    expected_numbers = set(expected_numbers) if expected_numbers is not None else None
+    text = llm_response.replace("```csv", "").replace("```", "").strip()
+    parsed = ParsedListings()
+    reader = csv.reader(StringIO(text), skipinitialspace=True)
+    header = None
+    for values in _tolerant_rows(reader):
+        raw = ",".join(values)
+        if header is None:
+            # ignore the text before the header
+            if "number" in [value.strip().lower() for value in values]:
+                header = [value.strip().lower() for value in values]
+            continue
+        if not any(value.strip() for value in values):
+            continue
+        row = _validate_row(header, values, expected_numbers, parsed.numbers)
+        if row is None:
+            parsed.invalid_rows.append(raw)
+        else:
+            parsed.rows.append(row)
+    if parsed.invalid_rows:
+        _logger.warning(
+            "%s invalid listing row(s) in the llm response", len(parsed.invalid_rows)
+        )
+    return parsed
+
+
+def _tolerant_rows(reader) -> Iterable[List[str]]:
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            _logger.warning("skipping malformed csv line: %s", e)
+
+
+def _validate_row(
+    header: List[str],
+    values: List[str],
+    expected_numbers: Set[int] | None,
+    seen_numbers: Set[int],
+) -> Dict | None:
+    if len(values) != len(header):
+        return None
+    row = dict(zip(header, (value.strip() for value in values)))
+    try:
+        number = int(row["number"])
+    except ValueError:
+        return None
+    if number in seen_numbers or (
+        expected_numbers is not None and number not in expected_numbers
+    ):
+        return None
+    if not all(row.get(column) for column in LISTING_COLUMNS):
+        return None
+    try:
+        Listing.model_validate({column: row[column] for column in LISTING_COLUMNS})
+    except (ValidationError, ValueError):
+        return None
+    row["number"] = number
+    return row
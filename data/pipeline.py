@@ -0,0 +1,273 @@
+"""
+Streaming listings pipeline: the pictures flow through the description,
+listing generation (validated rows) and embedding/ingestion stages, every
+stage running concurrently and connected to the next one by a bounded queue.
+"""
+
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List
+
+import pandas as pd
+
+from models.listings import picture_listing_id
+
+from .data_generator import DataGenerator
+
+_logger = logging.getLogger(__name__)
+
+# end of the stream marker
+_END = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    items_in: int = 0
+    items_out: int = 0
+    errors: int = 0
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """items output per second"""
+        return self.items_out / self.elapsed if self.elapsed else 0.0
+
+
+class Stage(object):
+    """
+    :param fn: called with a batch of up to `batch_size` items, returns the
+               items passed to the next stage.
+    :param workers: number of threads running `fn`.
+    :param linger: seconds to wait for more items to fill a batch.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[List[Any]], Iterable[Any]],
+        workers: int = 1,
+        batch_size: int = 1,
+        linger: float = 0.5,
+    ) -> None:
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+
+
+class StreamingPipeline(object):
+    def __init__(self, stages: List[Stage], queue_size: int = 32) -> None:
+        self._stages = stages
+        self._queue_size = queue_size
+
+    def run(self, items: Iterable[Any]) -> List[StageStats]:
+        queues = [queue.Queue(self._queue_size) for _ in self._stages]
+        # the output of the last stage is dropped
+        outboxes = queues[1:] + [None]
+        stats = [StageStats(stage.name) for stage in self._stages]
+        lock = threading.Lock()
+        remaining_workers = [stage.workers for stage in self._stages]
+
+        def _feed():
+            for item in items:
+                queues[0].put(item)
+            queues[0].put(_END)
+
+        def _work(index: int):
+            stage, inbox, outbox = self._stages[index], queues[index], outboxes[index]
+            done = False
+            while not done:
+                batch, done = self._next_batch(inbox, stage)
+                if not batch:
+                    continue
+                with lock:
+                    if stats[index].started_at is None:
+                        stats[index].started_at = time.perf_counter()
+                    stats[index].items_in += len(batch)
+                try:
+                    outputs = list(stage.fn(batch))
+                except Exception as e:
+                    _logger.exception("%s stage failed on a batch: %s", stage.name, e)
+                    with lock:
+                        stats[index].errors += len(batch)
+                    continue
+                with lock:
+                    stats[index].items_out += len(outputs)
+                if outbox is not None:
+                    for output in outputs:
+                        outbox.put(output)
+            with lock:
+                remaining_workers[index] -= 1
+                last_worker = not remaining_workers[index]
+                if last_worker:
+                    stats[index].finished_at = time.perf_counter()
+            if last_worker and outbox is not None:
+                outbox.put(_END)
+
+        threads = [threading.Thread(target=_feed, daemon=True)] + [
+            threading.Thread(target=_work, args=(index,), daemon=True)
+            for index, stage in enumerate(self._stages)
+            for _ in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for stage_stats in stats:
+            _logger.info(
+                "%s: %s in, %s out, %s error(s), %.1fs, %.2f item(s)/s",
+                stage_stats.name,
+                stage_stats.items_in,
+                stage_stats.items_out,
+                stage_stats.errors,
+                stage_stats.elapsed,
+                stage_stats.throughput,
+            )
+        return stats
+
+    @staticmethod
+    def _next_batch(inbox: queue.Queue, stage: Stage):
+        """return the next batch and whether the stream ended"""
+        item = inbox.get()
+        if item is _END:
+            # left for the other workers of the stage
+            inbox.put(_END)
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + stage.linger
+        while len(batch) < stage.batch_size:
+            try:
+                item = inbox.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _END:
+                inbox.put(_END)
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+
+class CsvSideOutput(object):
+    """thread safe CSV writer, doing nothing without a file"""
+
+    def __init__(self, output_file: str | None) -> None:
+        self._output_file = output_file
+        self._lock = threading.Lock()
+        self._header = True
+        if output_file and os.path.exists(output_file):
+            os.remove(output_file)
+
+    def write(self, rows: List[Dict]) -> None:
+        if not self._output_file or not rows:
+            return
+        with self._lock:
+            pd.DataFrame(rows).to_csv(
+                self._output_file, mode="a", index=False, header=self._header
+            )
+            self._header = False
+
+
+def run_listings_pipeline(
+    generator: DataGenerator,
+    db_manager,
+    picture_dir: str | None = None,
+    descriptions_file: str | None = None,
+    listings_file: str | None = None,
+    concurrency: int = 1,
+    embed_batch_size: int = 10,
+    queue_size: int = 32,
+    pictures: List[str] | None = None,
+    on_ingested: Callable[[List[Dict]], None] | None = None,
+) -> List[StageStats]:
+    """
+    Describe the pictures of `picture_dir` (or the `pictures` files), generate
+    their listings and add them to the listings table of `db_manager`, the CSV
+    files being optional side outputs. The llm calls of all the stages share
+    the quotas of the generator.
+
+    :param on_ingested: called with every batch of listings added to the table.
+    """
+    if pictures is None:
+        pictures = generator._list_pictures(picture_dir)
+    numbers = {picture: number for number, picture in enumerate(pictures, start=1)}
+    groups = generator._group_pictures(pictures)
+    duplicates: Dict[str, List[str]] = {}
+    for picture, representative in groups.items():
+        if picture != representative:
+            duplicates.setdefault(representative, []).append(picture)
+
+    engine = generator._engine()
+    descriptions_output = CsvSideOutput(descriptions_file)
+    listings_output = CsvSideOutput(listings_file)
+
+    def describe(batch: List[str]) -> List[Dict]:
+        rows = []
+        for picture_file in batch:
+            description = engine.call(
+                generator._describe_picture,
+                picture_file,
+                generator._estimate_picture_tokens(picture_file),
+            )
+            # the near-identical pictures reuse the description
+            for picture in [picture_file] + duplicates.get(picture_file, []):
+                rows.append(
+                    dict(
+                        number=numbers[picture],
+                        picture_file=picture,
+                        image_desc=description,
+                    )
+                )
+        descriptions_output.write(rows)
+        return rows
+
+    def generate_listings(batch: List[Dict]) -> List[Dict]:
+        picture_files = {d["number"]: d["picture_file"] for d in batch}
+        listings = engine.call(
+            functools.partial(generator._generate_listings, engine=engine),
+            batch,
+            generator._estimate_listings_tokens(batch),
+        )
+        for listing in listings:
+            listing["picture_file"] = picture_files[listing["number"]]
+            listing["id"] = picture_listing_id(listing["picture_file"])
+        listings_output.write(listings)
+        return listings
+
+    def ingest(batch: List[Dict]) -> List[Dict]:
+        # the listings of a previous run are replaced
+        db_manager._append_listings(batch, replace=True)
+        if on_ingested:
+            on_ingested(batch)
+        return batch
+
+    pipeline = StreamingPipeline(
+        [
+            Stage("describe", describe, workers=concurrency),
+            Stage(
+                "generate listings",
+                generate_listings,
+                workers=concurrency,
+                batch_size=generator._max_listings_per_request(),
+            ),
+            Stage("embed and ingest", ingest, batch_size=embed_batch_size),
+        ],
+        queue_size=queue_size,
+    )
+    stats = pipeline.run(p for p in pictures if groups[p] == p)
+    _logger.info("generation stats: %s", generator.stats)
+    return stats
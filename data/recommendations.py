@@ -0,0 +1,136 @@
+"""
+Offline recommendations: the listings best matching every saved user profile
+(`id` and `text` preferences columns of a CSV file), searched by chunks of
+profiles with `ListingsService.search_batch` on a pool of processes and written
+to a parquet file. The texts are embedded in the main process, the worker
+processes only search.
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import CONFIG
+from utils import embedd_text, parse_tag_vocabulary, to_bool
+
+_logger = logging.getLogger(__name__)
+
+RECOMMENDATIONS_SCHEMA = pa.schema(
+    [
+        ("profile_id", pa.string()),
+        ("rank", pa.int32()),
+        ("listing_id", pa.string()),
+    ]
+)
+
+
+def recommend_chunk(profiles: List[Dict], limit: int) -> Dict[str, List]:
+    """recommendations (RECOMMENDATIONS_SCHEMA columns) of a chunk of profiles"""
+    # every worker process has its own service
+    from service_layer.services import ListingsService, SearchQuery
+
+    service = ListingsService()
+    filters = [None] * len(profiles)
+    if to_bool(CONFIG.chat_preference_filters):
+        from app_modes.preferences import extract_preferences
+
+        neighborhoods = service.neighborhoods()
+        amenities = parse_tag_vocabulary(CONFIG.amenity_tags or "")
+        filters = [
+            extract_preferences([profile["text"]], neighborhoods, amenities)
+            for profile in profiles
+        ]
+    results = service.search_batch(
+        [
+            SearchQuery(
+                text=profile["text"],
+                text_vector=profile.get("vector"),
+                filters=profile_filters,
+            )
+            for profile, profile_filters in zip(profiles, filters)
+        ],
+        columns=["id"],
+        limit=limit,
+    )
+    columns = {name: [] for name in RECOMMENDATIONS_SCHEMA.names}
+    for profile, documents in zip(profiles, results):
+        for rank, document in enumerate(documents, start=1):
+            columns["profile_id"].append(str(profile["id"]))
+            columns["rank"].append(rank)
+            columns["listing_id"].append(document.metadata["id"])
+    return columns
+
+
+def recommend_profiles(
+    profiles_file: str,
+    output_file: str,
+    limit: int = 10,
+    chunk_size: int = 256,
+    workers: int = 0,
+) -> int:
+    """
+    :param workers: number of processes, 0 for one per core.
+    :return: number of profiles
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and CONFIG.vector_db_engine == "numpy" and not CONFIG.numpy_db_path:
+        # every process would load and embed all the listings again
+        _logger.warning("No NUMPY_DB_PATH: the profiles are searched in this process")
+        workers = 1
+    start = time.perf_counter()
+    profiles = recommendations = 0
+
+    def _chunks() -> Iterator[List[Dict]]:
+        nonlocal profiles
+        for chunk in pd.read_csv(
+            profiles_file, usecols=["id", "text"], dtype=str, chunksize=chunk_size
+        ):
+            chunk = chunk.dropna(subset=["text"])
+            profiles += len(chunk)
+            records = chunk.to_dict("records")
+            if not records:
+                continue
+            vectors = embedd_text([record["text"] for record in records])
+            yield [
+                dict(record, vector=vector) for record, vector in zip(records, vectors)
+            ]
+
+    with pq.ParquetWriter(output_file, RECOMMENDATIONS_SCHEMA) as writer:
+        for columns in _map_chunks(_chunks(), limit, workers):
+            writer.write_table(pa.table(columns, schema=RECOMMENDATIONS_SCHEMA))
+            recommendations += len(columns["profile_id"])
+
+    elapsed = time.perf_counter() - start
+    _logger.info(
+        "%d profiles, %d recommendations in %.1fs (%.1f profiles/s)",
+        profiles,
+        recommendations,
+        elapsed,
+        profiles / elapsed if elapsed else 0.0,
+    )
+    return profiles
+
+
+def _map_chunks(
+    chunks: Iterable[List[Dict]], limit: int, workers: int
+) -> Iterator[Dict[str, List]]:
+    """recommendations of the chunks, in order, up to 2 chunks per worker ahead"""
+    if workers == 1:
+        for chunk in chunks:
+            yield recommend_chunk(chunk, limit)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(recommend_chunk, chunk, limit))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
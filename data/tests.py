@@ -1,9 +1,39 @@
+import asyncio
 import io
+import json
+import random
+import os
+import time
 from unittest import mock
 
+import pandas as pd
 import pytest
+from langchain_core.documents.base import Document
+from PIL import Image
 
 from data.data_generator import DataGenerator
+from data.dedup import group_duplicate_pictures
+from data.engine import AsyncGenerationEngine, TokenBucket
+from data.parsing import parse_listings_csv
+from data.pipeline import (
+    Stage,
+    StreamingPipeline,
+    picture_listing_id,
+    run_listings_pipeline,
+)
+from data.recommendations import recommend_profiles
+from data.watcher import PictureWatcher, watch_pictures
+from utils.tokens import count_tokens
+
+
+LISTINGS_CSV_HEADER = (
+    "number,neighborhood,price,bedrooms,bathrooms,house_size,"
+    "description,neighborhood_description"
+)
+
+
+def listing_csv_row(number, neighborhood="Green Oaks", bedrooms="3"):
+    return f"{number},{neighborhood},800000,{bedrooms},2,2000,description,about"
 
 
 class TestDataGenerator:
@@ -25,7 +55,7 @@ class TestDataGenerator:
             mock_llm_picture_description.side_effect = (
                 lambda picture_file: f"description for {picture_file}"
             )
-            generator = DataGenerator(request_cool_down=0)
+            generator = DataGenerator(request_cool_down=0, dedup_pictures=False)
 
             output_file = io.StringIO()
             generator.generate_pictures_descriptions(
@@ -56,7 +86,7 @@ class TestDataGenerator:
                 csv_header = "number,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description"
                 csv_values = "\n".join(
                     [
-                        f"{picture_descr['number']},neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description"
+                        f"{picture_descr['number']},neighborhood,800000,3,2,2000,description,neighborhood_description"
                         for picture_descr in picture_descriptions
                     ]
                 )
@@ -133,12 +163,693 @@ class TestDataGenerator:
             mock_generate_listings_with_llm.assert_has_calls([call1, call2])
         assert output_file.getvalue().splitlines() == [
             "number,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,picture_file",
-            "1,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img1.jpg",
-            "2,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img2.jpg",
-            "3,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img3.jpeg",
-            "4,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img4.jpeg",
-            "5,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img5.jpeg",
-            "6,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img6.jpeg",
-            "7,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img7.jpeg",
-            "8,neighborhood,price,bedrooms,bathrooms,house_size,description,neighborhood_description,path/to/img8.jpeg",
+            "1,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img1.jpg",
+            "2,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img2.jpg",
+            "3,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img3.jpeg",
+            "4,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img4.jpeg",
+            "5,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img5.jpeg",
+            "6,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img6.jpeg",
+            "7,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img7.jpeg",
+            "8,neighborhood,800000,3,2,2000,description,neighborhood_description,path/to/img8.jpeg",
+        ]
+
+    @mock.patch("data.data_generator.glob.glob")
+    def test_resume_pictures_descriptions(self, mock_glob, tmp_path):
+        mock_glob.side_effect = lambda pattern: (
+            [f"img{i}.jpg" for i in (1, 2, 3, 4)] if pattern.endswith("*.jpg") else []
+        )
+        output_file = str(tmp_path / "descriptions.csv")
+
+        def failing_description(picture_file):
+            if picture_file == "img3.jpg":
+                raise ValueError("llm failure")
+            return f"description for {picture_file}"
+
+        with mock.patch.object(
+            DataGenerator, "_get_llm_picture_description"
+        ) as mock_llm_picture_description:
+            mock_llm_picture_description.side_effect = failing_description
+            with pytest.raises(ValueError):
+                DataGenerator(
+                    request_cool_down=0, dedup_pictures=False
+                ).generate_pictures_descriptions(
+                    picture_dir="picture_dir", output_file=output_file
+                )
+            assert len(pd.read_csv(output_file)) == 2
+
+            mock_llm_picture_description.reset_mock()
+            mock_llm_picture_description.side_effect = (
+                lambda picture_file: f"description for {picture_file}"
+            )
+            DataGenerator(
+                request_cool_down=0, dedup_pictures=False
+            ).generate_pictures_descriptions(
+                picture_dir="picture_dir", output_file=output_file
+            )
+            assert [c.args[0] for c in mock_llm_picture_description.call_args_list] == [
+                "img3.jpg",
+                "img4.jpg",
+            ]
+            df = pd.read_csv(output_file)
+            assert df["number"].tolist() == [1, 2, 3, 4]
+            assert df["picture_file"].tolist() == [f"img{i}.jpg" for i in (1, 2, 3, 4)]
+
+            with pytest.raises(DataGenerator.ManifestMismatchException):
+                DataGenerator(
+                    model="another-model", request_cool_down=0, dedup_pictures=False
+                ).generate_pictures_descriptions(
+                    picture_dir="picture_dir", output_file=output_file
+                )
+
+            DataGenerator(
+                model="another-model", request_cool_down=0, dedup_pictures=False
+            ).generate_pictures_descriptions(
+                picture_dir="picture_dir", output_file=output_file, restart=True
+            )
+            assert len(pd.read_csv(output_file)) == 4
+            assert mock_llm_picture_description.call_count == 6
+
+            # an output without a manifest is not resumed
+            os.remove(f"{output_file}.manifest.json")
+            with pytest.raises(DataGenerator.ManifestMismatchException):
+                DataGenerator(
+                    model="another-model", request_cool_down=0, dedup_pictures=False
+                ).generate_pictures_descriptions(
+                    picture_dir="picture_dir", output_file=output_file
+                )
+
+    def test_listings_batch_export_and_import(self, tmp_path):
+        picture_desc_file = tmp_path / "descriptions.csv"
+        pd.DataFrame(
+            dict(
+                number=range(1, 8),
+                picture_file=[f"img{i}.jpg" for i in range(1, 8)],
+                image_desc=[f"description {i}" for i in range(1, 8)],
+            )
+        ).to_csv(picture_desc_file, index=False)
+        generator = DataGenerator(model="model", request_cool_down=0)
+
+        requests_file = tmp_path / "requests.jsonl"
+        assert generator.export_listings_batch(requests_file, picture_desc_file) == 2
+        requests = [json.loads(line) for line in requests_file.read_text().splitlines()]
+        assert [r["custom_id"] for r in requests] == [
+            "listings:1,2,3,4,5",
+            "listings:6,7",
+        ]
+        assert requests[0]["url"] == "/v1/chat/completions"
+        assert requests[0]["body"]["model"] == "model"
+        assert "5| description 5" in requests[0]["body"]["messages"][0]["content"]
+
+        def response(custom_id, status_code=200):
+            numbers = custom_id.split(":")[1].split(",")
+            content = "```csv\n{}\n{}```".format(
+                LISTINGS_CSV_HEADER,
+                "\n".join(listing_csv_row(n, f"neighborhood {n}") for n in numbers),
+            )
+            return {
+                "custom_id": custom_id,
+                "response": {
+                    "status_code": status_code,
+                    "body": {"choices": [{"message": {"content": content}}]},
+                },
+                "error": None,
+            }
+
+        responses_file = tmp_path / "responses.jsonl"
+        responses_file.write_text(
+            "\n".join(
+                json.dumps(r)
+                for r in [
+                    response("listings:6,7"),
+                    response("listings:1,2,3,4,5"),
+                    response("listings:8", status_code=500),
+                ]
+            )
+        )
+        output_file = tmp_path / "listings.csv"
+        generator.import_listings_batch(
+            responses_file, picture_desc_file, output_file=output_file
+        )
+        assert output_file.read_text().splitlines() == [
+            f"{LISTINGS_CSV_HEADER},picture_file",
+            *[
+                f"{listing_csv_row(i, f'neighborhood {i}')},img{i}.jpg"
+                for i in range(1, 8)
+            ],
+        ]
+
+    def test_listings_batch_import_resumed_live(self, tmp_path):
+        picture_desc_file = tmp_path / "descriptions.csv"
+        pd.DataFrame(
+            dict(
+                number=range(1, 5),
+                picture_file=[f"img{i}.jpg" for i in range(1, 5)],
+                image_desc=[f"description {i}" for i in range(1, 5)],
+            )
+        ).to_csv(picture_desc_file, index=False)
+        generator = DataGenerator(model="model", request_cool_down=0)
+
+        # the responses of the listings 3 and 4 are missing
+        content = "\n".join(
+            [LISTINGS_CSV_HEADER, listing_csv_row(1), listing_csv_row(2)]
+        )
+        responses_file = tmp_path / "responses.jsonl"
+        responses_file.write_text(
+            json.dumps(
+                {
+                    "custom_id": "listings:1,2",
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"content": content}}]},
+                    },
+                    "error": None,
+                }
+            )
+        )
+        output_file = tmp_path / "listings.csv"
+        generator.import_listings_batch(
+            responses_file, picture_desc_file, output_file=output_file
+        )
+
+        response = "\n".join(
+            [LISTINGS_CSV_HEADER, listing_csv_row(3), listing_csv_row(4)]
+        )
+        with mock.patch.object(
+            DataGenerator, "_generate_listings_with_llm", return_value=response
+        ) as mock_generate_listings_with_llm:
+            generator.generate_pictures_augmented_listings(
+                picture_desc_file=picture_desc_file, output_file=output_file
+            )
+        mock_generate_listings_with_llm.assert_called_once()
+        assert [
+            d["number"] for d in mock_generate_listings_with_llm.call_args.args[0]
+        ] == [3, 4]
+        assert pd.read_csv(output_file)["number"].tolist() == [1, 2, 3, 4]
+
+    def test_chunk_descriptions_under_token_budget(self):
+        generator = DataGenerator(
+            request_cool_down=0, max_token=1000, listing_output_tokens=100
+        )
+        descriptions = [dict(number=i, image_desc="short") for i in range(1, 26)]
+        chunks = generator._chunk_descriptions(descriptions)
+        assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+        assert sum(chunks, []) == descriptions
+
+        # ~100 tokens per description, room for 2 of them in the context window
+        prompt_tokens = count_tokens(
+            generator._listings_prompt([]), generator.llm_model
+        )
+        generator = DataGenerator(
+            request_cool_down=0,
+            max_token=1000,
+            listing_output_tokens=100,
+            context_tokens=prompt_tokens + 1000 + 250,
+        )
+        descriptions = [dict(number=i, image_desc="word " * 100) for i in range(5)]
+        chunks = generator._chunk_descriptions(descriptions)
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+    def test_chunk_descriptions_with_measured_output(self, tmp_path):
+        picture_desc_file = tmp_path / "descriptions.csv"
+        pd.DataFrame(
+            dict(
+                number=range(1, 13),
+                picture_file=[f"img{i}.jpg" for i in range(1, 13)],
+                image_desc=["description"] * 12,
+            )
+        ).to_csv(picture_desc_file, index=False)
+
+        def generate_listings(descriptions):
+            return "\n".join(
+                [LISTINGS_CSV_HEADER]
+                + [listing_csv_row(d["number"]) for d in descriptions]
+            )
+
+        # 2 listings per request before the output size is measured
+        generator = DataGenerator(
+            request_cool_down=0, max_token=1000, listing_output_tokens=500
+        )
+        with mock.patch.object(
+            DataGenerator, "_generate_listings_with_llm", side_effect=generate_listings
+        ) as mock_generate_listings_with_llm, mock.patch.object(
+            DataGenerator,
+            "_chunk_descriptions",
+            autospec=True,
+            side_effect=DataGenerator._chunk_descriptions,
+        ) as mock_chunk_descriptions:
+            generator.generate_pictures_augmented_listings(
+                picture_desc_file=picture_desc_file,
+                output_file=tmp_path / "listings.csv",
+            )
+        assert [
+            len(c.args[0]) for c in mock_generate_listings_with_llm.call_args_list
+        ] == [2, 10]
+        # the descriptions left after the first request are packed once
+        assert [len(c.args[1]) for c in mock_chunk_descriptions.call_args_list] == [10]
+        assert generator.stats.parsed_rows == 12
+        assert generator._listing_output_tokens_estimate() < 100
+
+        # the request tokens are counted with the encoding of the model
+        with mock.patch(
+            "data.data_generator.count_tokens", return_value=1
+        ) as mock_count:
+            assert generator._estimate_listings_tokens([{"image_desc": "a"}]) == 1001
+        mock_count.assert_called_once_with("a", generator.llm_model)
+
+    def test_invalid_listings_are_requested_again(self, tmp_path):
+        picture_desc_file = tmp_path / "descriptions.csv"
+        pd.DataFrame(
+            dict(
+                number=[1, 2, 3],
+                picture_file=["img1.jpg", "img2.jpg", "img3.jpg"],
+                image_desc=["description"] * 3,
+            )
+        ).to_csv(picture_desc_file, index=False)
+        responses = [
+            # 2 is invalid, 3 is missing
+            "\n".join(
+                [
+                    LISTINGS_CSV_HEADER,
+                    listing_csv_row(1),
+                    listing_csv_row(2, bedrooms="three"),
+                ]
+            ),
+            "\n".join([LISTINGS_CSV_HEADER, listing_csv_row(2), listing_csv_row(3)]),
+        ]
+        generator = DataGenerator(request_cool_down=0, row_retries=2)
+        output_file = tmp_path / "listings.csv"
+        with mock.patch.object(
+            DataGenerator, "_generate_listings_with_llm", side_effect=responses
+        ) as mock_generate_listings_with_llm:
+            generator.generate_pictures_augmented_listings(
+                picture_desc_file=picture_desc_file, output_file=output_file
+            )
+
+        assert [
+            [d["number"] for d in c.args[0]]
+            for c in mock_generate_listings_with_llm.call_args_list
+        ] == [[1, 2, 3], [2, 3]]
+        assert pd.read_csv(output_file)["number"].tolist() == [1, 2, 3]
+        assert generator.stats.row_retries == 1
+        assert generator.stats.invalid_rows == 1
+        assert generator.stats.wasted_tokens > 0
+
+    def test_rate_limited_follow_up_keeps_the_parsed_listings(self, tmp_path):
+        class RateLimited(Exception):
+            status_code = 429
+
+        picture_desc_file = tmp_path / "descriptions.csv"
+        pd.DataFrame(
+            dict(
+                number=[1, 2],
+                picture_file=["img1.jpg", "img2.jpg"],
+                image_desc=["description"] * 2,
+            )
+        ).to_csv(picture_desc_file, index=False)
+        responses = [
+            # 2 is missing, its follow-up is rate limited
+            "\n".join([LISTINGS_CSV_HEADER, listing_csv_row(1)]),
+            RateLimited(),
+            RateLimited(),
         ]
+        generator = DataGenerator(request_cool_down=0, row_retries=2, max_retries=1)
+        output_file = tmp_path / "listings.csv"
+        with mock.patch.object(
+            DataGenerator, "_generate_listings_with_llm", side_effect=responses
+        ), mock.patch("data.engine.time.sleep"):
+            generator.generate_pictures_augmented_listings(
+                picture_desc_file=picture_desc_file, output_file=output_file
+            )
+
+        assert pd.read_csv(output_file)["number"].tolist() == [1]
+        # the follow-up went through the engine and its retries
+        assert generator.stats.requests == 3
+        assert generator.stats.retries == 1
+        assert generator.stats.row_retries == 1
+
+    @mock.patch("data.data_generator.group_duplicate_pictures")
+    @mock.patch("data.data_generator.glob.glob")
+    def test_duplicate_pictures_described_once(self, mock_glob, mock_group):
+        mock_glob.side_effect = lambda pattern: (
+            ["a.jpg", "b.jpg", "c.jpg", "d.jpg"] if pattern.endswith("*.jpg") else []
+        )
+        mock_group.return_value = {
+            "a.jpg": "a.jpg",
+            "b.jpg": "b.jpg",
+            "c.jpg": "a.jpg",
+            "d.jpg": "b.jpg",
+        }
+        generator = DataGenerator(request_cool_down=0, dedup_pictures=True)
+        output_file = io.StringIO()
+        with mock.patch.object(
+            DataGenerator,
+            "_get_llm_picture_description",
+            side_effect=lambda picture_file: f"description for {picture_file}",
+        ) as mock_llm_picture_description:
+            generator.generate_pictures_descriptions(
+                picture_dir="picture_dir", output_file=output_file
+            )
+
+        assert mock_llm_picture_description.call_count == 2
+        assert generator.stats.duplicate_pictures == 2
+        assert output_file.getvalue().splitlines() == [
+            "number,picture_file,image_desc",
+            "1,a.jpg,description for a.jpg",
+            "2,b.jpg,description for b.jpg",
+            "3,c.jpg,description for a.jpg",
+            "4,d.jpg,description for b.jpg",
+        ]
+
+
+def test_parse_listings_csv():
+    response = "\n".join(
+        [
+            "Here are the listings:",
+            "```csv",
+            LISTINGS_CSV_HEADER,
+            listing_csv_row(1),
+            '2,"Green Oaks,800000,3,2,2000',  # broken quote, swallows the next rows
+            listing_csv_row(3),
+            "```",
+        ]
+    )
+    parsed = parse_listings_csv(response, expected_numbers=[1, 2, 3])
+    assert parsed.numbers == {1}
+    assert parsed.rows[0]["price"] == "800000"
+
+    response = "\n".join(
+        [
+            LISTINGS_CSV_HEADER,
+            listing_csv_row(1),
+            listing_csv_row(1),  # duplicate
+            listing_csv_row(4),  # not requested
+            "5,Green Oaks,800000,3",  # missing columns
+            listing_csv_row(6, bedrooms=""),  # missing value
+            listing_csv_row(7),
+        ]
+    )
+    parsed = parse_listings_csv(response, expected_numbers=[1, 5, 6, 7])
+    assert [row["number"] for row in parsed.rows] == [1, 7]
+    assert len(parsed.invalid_rows) == 4
+
+
+def _blocks_picture(seed: int) -> Image.Image:
+    # 9x8 blocks, every block 25 levels lighter or darker than its left one
+    rng = random.Random(seed)
+    values = []
+    for _ in range(8):
+        value = 128
+        for _ in range(9):
+            values.append(value)
+            step = rng.choice([-25, 25])
+            value += step if 20 <= value + step <= 235 else -step
+    picture = Image.new("L", (9, 8))
+    picture.putdata(values)
+    return picture.resize((720, 480), Image.NEAREST).convert("RGB")
+
+
+def test_group_duplicate_pictures(tmp_path):
+    _blocks_picture(1).save(tmp_path / "a.jpg")
+    _blocks_picture(1).resize((360, 240)).save(tmp_path / "a_small.jpg", quality=60)
+    _blocks_picture(2).save(tmp_path / "b.jpg")
+    pictures = [
+        str(tmp_path / name)
+        for name in ("a.jpg", "b.jpg", "a_small.jpg", "missing.jpg")
+    ]
+
+    groups = group_duplicate_pictures(pictures, max_distance=4, workers=2)
+    assert groups == {
+        pictures[0]: pictures[0],
+        pictures[1]: pictures[1],
+        pictures[2]: pictures[0],
+        pictures[3]: pictures[3],
+    }
+
+
+def test_generation_engine_keeps_order_and_retries_rate_limited_calls():
+    class RateLimited(Exception):
+        status_code = 429
+
+    attempts = {}
+
+    def generate(item):
+        attempts[item] = attempts.get(item, 0) + 1
+        if item % 3 == 0 and attempts[item] == 1:
+            raise RateLimited()
+        # the first items are the slowest to finish
+        time.sleep((10 - item) / 1000)
+        return item * 2
+
+    engine = AsyncGenerationEngine(concurrency=4, backoff=0.001)
+    assert engine.map(generate, range(10)) == [i * 2 for i in range(10)]
+    assert engine.stats.requests == 14
+    assert engine.stats.retries == 4
+
+    def fail(item):
+        raise ValueError("not rate limited")
+
+    engine = AsyncGenerationEngine(concurrency=2, backoff=0.001)
+    with pytest.raises(ValueError):
+        engine.map(fail, range(3))
+    assert engine.stats.retries == 0
+
+
+def test_token_bucket():
+    async def acquire_all(bucket, amounts):
+        start = time.monotonic()
+        for amount in amounts:
+            await bucket.acquire(amount)
+        return time.monotonic() - start
+
+    # 60 per minute: 1 token per second, the first 2 are available at once
+    assert asyncio.run(acquire_all(TokenBucket(60, capacity=2), [1, 1])) < 0.5
+    assert asyncio.run(acquire_all(TokenBucket(60, capacity=2), [1, 1, 1])) >= 0.9
+    # no limit
+    assert asyncio.run(acquire_all(TokenBucket(0), [1000] * 10)) < 0.1
+
+
+def test_request_cool_down_quota():
+    generator = DataGenerator(request_cool_down=2, requests_per_minute=0)
+    bucket = generator._engine()._requests_bucket
+    # one request every 2 seconds, without a burst at start
+    assert bucket._reserve(1) == 0
+    assert bucket._reserve(1) > 1.9
+
+
+def test_streaming_pipeline():
+    batches = []
+
+    def double(batch):
+        return [item * 2 for item in batch]
+
+    def fail_on_14(batch):
+        if 14 in batch:
+            raise ValueError("failing batch")
+        return batch
+
+    def collect(batch):
+        batches.append(batch)
+        return batch
+
+    stats = StreamingPipeline(
+        [
+            Stage("double", double, workers=4),
+            Stage("fail", fail_on_14, workers=2),
+            Stage("collect", collect, batch_size=5, linger=0.05),
+        ],
+        queue_size=2,
+    ).run(range(20))
+
+    assert sorted(sum(batches, [])) == [i * 2 for i in range(20) if i != 7]
+    assert all(len(batch) <= 5 for batch in batches)
+    assert [(s.items_in, s.items_out, s.errors) for s in stats] == [
+        (20, 20, 0),
+        (20, 19, 1),
+        (19, 19, 0),
+    ]
+
+
+@mock.patch("data.data_generator.group_duplicate_pictures")
+@mock.patch("data.data_generator.glob.glob")
+def test_run_listings_pipeline(mock_glob, mock_group, tmp_path):
+    mock_glob.side_effect = lambda pattern: (
+        ["a.jpg", "b.jpg", "c.jpg"] if pattern.endswith("*.jpg") else []
+    )
+    mock_group.return_value = {"a.jpg": "a.jpg", "b.jpg": "b.jpg", "c.jpg": "a.jpg"}
+    db_manager = mock.Mock()
+    db_manager._append_listings.side_effect = lambda records, replace: len(records)
+
+    def generate_listings(descriptions):
+        return "\n".join(
+            [LISTINGS_CSV_HEADER]
+            + [listing_csv_row(d["number"], d["image_desc"]) for d in descriptions]
+        )
+
+    generator = DataGenerator(request_cool_down=0)
+    with mock.patch.object(
+        DataGenerator,
+        "_get_llm_picture_description",
+        side_effect=lambda picture_file: f"view {picture_file}",
+    ), mock.patch.object(
+        DataGenerator, "_generate_listings_with_llm", side_effect=generate_listings
+    ):
+        stats = run_listings_pipeline(
+            generator,
+            db_manager,
+            picture_dir="picture_dir",
+            listings_file=str(tmp_path / "listings.csv"),
+            concurrency=2,
+        )
+
+    ingested = sum((c.args[0] for c in db_manager._append_listings.call_args_list), [])
+    # the listings are replaced on every run
+    assert all(c.kwargs["replace"] for c in db_manager._append_listings.call_args_list)
+    assert sorted(
+        (listing["number"], listing["picture_file"], listing["neighborhood"])
+        for listing in ingested
+    ) == [
+        (1, "a.jpg", "view a.jpg"),
+        (2, "b.jpg", "view b.jpg"),
+        (3, "c.jpg", "view a.jpg"),
+    ]
+    assert len(pd.read_csv(tmp_path / "listings.csv")) == 3
+    assert [s.items_out for s in stats] == [3, 3, 3]
+
+
+def test_picture_watcher(tmp_path):
+    picture_dir, state_file = tmp_path / "pictures", str(tmp_path / "state.json")
+    picture_dir.mkdir()
+    (picture_dir / "a.jpg").write_bytes(b"a")
+    watcher = PictureWatcher(str(picture_dir), state_file, settle_time=0)
+    assert not watcher.has_state
+
+    # reported once unchanged between two scans
+    assert watcher.poll() == ([], [])
+    assert watcher.poll() == ([str(picture_dir / "a.jpg")], [])
+    watcher.mark_processed([str(picture_dir / "a.jpg")])
+    assert watcher.poll() == ([], [])
+
+    (picture_dir / "a.jpg").write_bytes(b"changed")
+    (picture_dir / "b.jpg").write_bytes(b"b")
+    (picture_dir / "notes.txt").write_text("not a picture")
+    watcher.poll()
+    assert watcher.poll()[0] == [str(picture_dir / "a.jpg"), str(picture_dir / "b.jpg")]
+    watcher.mark_processed([str(picture_dir / "a.jpg")])
+    watcher.mark_failed([str(picture_dir / "b.jpg")])
+    assert watcher.poll() == ([], [])
+
+    (picture_dir / "a.jpg").unlink()
+    restarted = PictureWatcher(str(picture_dir), state_file, settle_time=0)
+    assert restarted.has_state
+    assert restarted.poll() == ([], [str(picture_dir / "a.jpg")])
+
+    # changed while being processed: reported again
+    (picture_dir / "b.jpg").write_bytes(b"b changed")
+    restarted.poll()
+    assert restarted.poll()[0] == [str(picture_dir / "b.jpg")]
+    (picture_dir / "b.jpg").write_bytes(b"b changed again")
+    restarted.mark_processed([str(picture_dir / "b.jpg")])
+    restarted.poll()
+    assert restarted.poll()[0] == [str(picture_dir / "b.jpg")]
+
+
+@mock.patch("data.watcher.run_listings_pipeline")
+def test_watch_pictures(mock_pipeline, tmp_path):
+    picture_dir = tmp_path / "pictures"
+    picture_dir.mkdir()
+    (picture_dir / "old.jpg").write_bytes(b"old")
+    new_picture = str(picture_dir / "new.jpg")
+
+    def run_pipeline(generator, db_manager, pictures, on_ingested, **kwargs):
+        on_ingested([{"picture_file": picture} for picture in pictures])
+
+    mock_pipeline.side_effect = run_pipeline
+    db_manager = mock.Mock()
+    watcher = PictureWatcher(
+        str(picture_dir), str(tmp_path / "state.json"), settle_time=0
+    )
+    watch_pictures(None, db_manager, watcher, interval=0, max_polls=1)
+    # the pictures already there are skipped
+    mock_pipeline.assert_not_called()
+
+    (picture_dir / "new.jpg").write_bytes(b"new")
+    watch_pictures(None, db_manager, watcher, interval=0, max_polls=2)
+    assert mock_pipeline.call_args.kwargs["pictures"] == [new_picture]
+    assert watcher.is_processed(new_picture)
+
+    # the listing of a changed picture is kept when the pipeline fails
+    (picture_dir / "new.jpg").write_bytes(b"changed")
+    mock_pipeline.side_effect = RuntimeError("pipeline failure")
+    with pytest.raises(RuntimeError):
+        watch_pictures(None, db_manager, watcher, interval=0, max_polls=2)
+    db_manager._delete_listings.assert_not_called()
+    mock_pipeline.side_effect = run_pipeline
+
+    (picture_dir / "new.jpg").unlink()
+    watch_pictures(None, db_manager, watcher, interval=0, max_polls=1)
+    db_manager._delete_listings.assert_called_with([picture_listing_id(new_picture)])
+    assert watcher.poll() == ([], [])
+
+
+@mock.patch("data.watcher.run_listings_pipeline")
+def test_watch_pictures_backfill(mock_pipeline, tmp_path):
+    picture_dir = tmp_path / "pictures"
+    picture_dir.mkdir()
+    for name in ["listed.jpg", "unlisted.jpg"]:
+        (picture_dir / name).write_bytes(name.encode())
+    db_manager = mock.Mock()
+    # the listing loaded from the listings file
+    db_manager._distinct_values.return_value = [
+        picture_listing_id(str(picture_dir / "listed.jpg"))
+    ]
+    watcher = PictureWatcher(
+        str(picture_dir), str(tmp_path / "state.json"), settle_time=0
+    )
+    watch_pictures(None, db_manager, watcher, interval=0, backfill=True, max_polls=2)
+    assert mock_pipeline.call_args.kwargs["pictures"] == [
+        str(picture_dir / "unlisted.jpg")
+    ]
+
+
+@mock.patch("data.recommendations.embedd_text")
+@mock.patch("data.recommendations.CONFIG")
+@mock.patch("service_layer.services.ListingsService")
+def test_recommend_profiles(mock_service, mock_config, mock_embedd_text, tmp_path):
+    mock_config.chat_preference_filters = False
+    # an in-memory table: searched in this process
+    mock_config.vector_db_engine = "numpy"
+    mock_config.numpy_db_path = ""
+    mock_embedd_text.side_effect = lambda texts: [[len(text)] for text in texts]
+    mock_service.return_value.search_batch.side_effect = lambda queries, **kwargs: [
+        [
+            Document(
+                page_content="",
+                metadata={"id": f"{query.text}-{query.text_vector[0]}-{rank}"},
+            )
+            for rank in range(kwargs["limit"])
+        ]
+        for query in queries
+    ]
+    profiles_file = tmp_path / "profiles.csv"
+    profiles_file.write_text("id,text\n1,a condo\n2,\n3,a house\n4,a loft\n")
+    output_file = tmp_path / "results.parquet"
+
+    profiles = recommend_profiles(
+        str(profiles_file), str(output_file), limit=2, chunk_size=2, workers=2
+    )
+    assert profiles == 3
+    # one search per chunk
+    assert mock_service.return_value.search_batch.call_count == 2
+    results = pd.read_parquet(output_file)
+    assert results.to_dict("list") == {
+        "profile_id": ["1", "1", "3", "3", "4", "4"],
+        "rank": [1, 2, 1, 2, 1, 2],
+        "listing_id": [
+            "a condo-7-0",
+            "a condo-7-1",
+            "a house-7-0",
+            "a house-7-1",
+            "a loft-6-0",
+            "a loft-6-1",
+        ],
+    }
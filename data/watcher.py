@@ -0,0 +1,179 @@
+"""
+Ingestion of the listing pictures added to (or changed in, or removed from)
+the pictures directory while the app is running.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Tuple
+
+from .data_generator import DataGenerator
+from .pipeline import picture_listing_id, run_listings_pipeline
+
+_logger = logging.getLogger(__name__)
+
+PICTURE_EXTENSIONS = (".jpg", ".jpeg")
+
+# modification time (ns) and size of a picture file
+Signature = Tuple[int, int]
+
+
+class PictureWatcher(object):
+    """
+    Detect the new, changed and removed pictures of `picture_dir` by polling
+    the files modification times and sizes, the processed ones being recorded
+    in `state_file`. A picture is only reported once its signature stayed the
+    same for `settle_time` seconds, so a file being copied isn't read half written.
+    """
+
+    def __init__(
+        self, picture_dir: str, state_file: str, settle_time: float = 1.0
+    ) -> None:
+        self._picture_dir = picture_dir
+        self._state_file = state_file
+        self._settle_time = settle_time
+        self._processed: Dict[str, Signature] = {}
+        self._pending: Dict[str, Tuple[Signature, float]] = {}
+        # not retried until they change again
+        self._failed: Dict[str, Signature] = {}
+        self.has_state = os.path.isfile(state_file)
+        if self.has_state:
+            with open(state_file) as f:
+                self._processed = {
+                    path: tuple(signature) for path, signature in json.load(f).items()
+                }
+
+    def scan(self) -> Dict[str, Signature]:
+        pictures = {}
+        with os.scandir(self._picture_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(PICTURE_EXTENSIONS):
+                    stat = entry.stat()
+                    pictures[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return pictures
+
+    def poll(self) -> Tuple[List[str], List[str]]:
+        """return the settled new or changed pictures, and the removed ones"""
+        now = time.monotonic()
+        pictures = self.scan()
+        ready = []
+        for path, signature in sorted(pictures.items()):
+            if signature in (self._processed.get(path), self._failed.get(path)):
+                self._pending.pop(path, None)
+                continue
+            pending = self._pending.get(path)
+            if pending is None or pending[0] != signature:
+                self._pending[path] = (signature, now)
+            elif now - pending[1] >= self._settle_time:
+                ready.append(path)
+        for path in list(self._pending):
+            if path not in pictures:
+                del self._pending[path]
+        removed = [path for path in self._processed if path not in pictures]
+        return ready, removed
+
+    def mark_processed(self, pictures: List[str]) -> None:
+        for path, signature in self._signatures(pictures).items():
+            self._processed[path] = signature
+        self._save()
+
+    def mark_failed(self, pictures: List[str]) -> None:
+        self._failed.update(self._signatures(pictures))
+
+    def _signatures(self, pictures: List[str]) -> Dict[str, Signature]:
+        """
+        signatures of `pictures`, those of the settled ones being the polled
+        ones: a picture changed while being processed is reported again
+        """
+        signatures = {}
+        for path in pictures:
+            pending = self._pending.pop(path, None)
+            if pending is not None:
+                signatures[path] = pending[0]
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signatures[path] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def is_processed(self, picture: str) -> bool:
+        return picture in self._processed and picture not in self._pending
+
+    def forget(self, pictures: List[str]) -> None:
+        for path in pictures:
+            self._processed.pop(path, None)
+        self._save()
+
+    def _save(self) -> None:
+        if os.path.dirname(self._state_file):
+            os.makedirs(os.path.dirname(self._state_file), exist_ok=True)
+        tmp_file = f"{self._state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._processed, f)
+        os.replace(tmp_file, self._state_file)
+        self.has_state = True
+
+
+def watch_pictures(
+    generator: DataGenerator,
+    db_manager,
+    watcher: PictureWatcher,
+    interval: float = 2.0,
+    batch_size: int = 50,
+    concurrency: int = 1,
+    backfill: bool = False,
+    max_polls: int | None = None,
+) -> None:
+    """
+    Add the listings of the new pictures to the listings table as they arrive,
+    replace the ones of the changed pictures and delete the ones of the removed
+    pictures. Without a previous state, the pictures already in the directory
+    are considered processed unless `backfill` is set, in which case only the
+    pictures without a listing in the table are ingested.
+    """
+    if not watcher.has_state and not backfill:
+        watcher.mark_processed(list(watcher.scan()))
+        _logger.info("watching for new pictures, the existing ones are skipped")
+    elif not watcher.has_state:
+        # the listings loaded from the listings file have their picture ids too
+        ids = set(db_manager._distinct_values("id"))
+        listed = [p for p in watcher.scan() if picture_listing_id(p) in ids]
+        watcher.mark_processed(listed)
+        _logger.info("backfill: %s picture(s) already listed are skipped", len(listed))
+
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        polls += 1
+        ready, removed = watcher.poll()
+        if removed:
+            db_manager._delete_listings([picture_listing_id(p) for p in removed])
+            watcher.forget(removed)
+            _logger.info("%s picture(s) removed", len(removed))
+        for start in range(0, len(ready), batch_size):
+            batch = ready[start : start + batch_size]
+            _logger.info("ingesting %s new or changed picture(s)", len(batch))
+            # the listings of the changed pictures are replaced by the pipeline,
+            # only once their new listing is generated and embedded
+            run_listings_pipeline(
+                generator,
+                db_manager,
+                pictures=batch,
+                concurrency=concurrency,
+                on_ingested=lambda listings: watcher.mark_processed(
+                    [listing["picture_file"] for listing in listings]
+                ),
+            )
+            failed = [p for p in batch if not watcher.is_processed(p)]
+            if failed:
+                watcher.mark_failed(failed)
+                _logger.warning(
+                    "%s picture(s) not ingested, skipped until they change: %s",
+                    len(failed),
+                    failed,
+                )
+        if max_polls is None or polls < max_polls:
+            time.sleep(interval)
@@ -1,5 +1,6 @@
+import os
 import uuid
-from typing import Dict
+from typing import Dict, List
 
 from lancedb.embeddings import get_registry
 from lancedb.pydantic import LanceModel, Vector
@@ -30,6 +31,8 @@ class Listing(LanceModel):
     description: str
     neighborhood_description: str
     listing_summary: str = None
+    # tags of the amenities seen on the picture (see AMENITY_TAGS)
+    amenities: List[str] = Field(default_factory=list)
 
     @field_validator("house_size", mode="before")
     def parse_house_size(cls, value):
@@ -49,6 +52,11 @@ class Listing(LanceModel):
             self.listing_summary = get_listing_summary(self)
 
 
+def picture_listing_id(picture_file: str) -> str:
+    """id of the listing generated from a picture, stable across the runs"""
+    return uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(picture_file)).hex
+
+
 def get_listing_summary(data: Dict | Listing) -> str:
     if isinstance(data, Listing):
         fields = [
@@ -149,4 +149,5 @@ Neighborhood Description: Sunset Heights is a vibrant neighborhood known for its
                 "and a community pool. The area offers convenient access to shopping, cafes, and schools, "
                 "making it an ideal place for families and professionals alike."
             ),
+            "Amenities": [],
         }
@@ -0,0 +1,218 @@
+import copy
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents.base import Document
+
+from utils import normalize
+
+
+@dataclass
+class SearchCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # search time of the hits when they were computed
+    saved_seconds: float = 0.0
+    invalidations: int = 0
+    entries: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SearchResultCache(object):
+    """
+    In memory LRU cache of the search results, bounded by a number of entries
+    and by the (estimated) size of the documents. The results are tied to a
+    version of the data: the whole cache is dropped when the version changes.
+
+    :param max_entries: 0 disables the cache.
+    :param max_size: maximum size in bytes, 0 for no limit.
+    """
+
+    def __init__(self, max_entries: int = 256, max_size: int = 0) -> None:
+        self._max_entries = max_entries
+        self._max_size = max_size
+        # key: (documents, size, search seconds)
+        self._entries: OrderedDict[Hashable, Tuple[List[Document], int, float]] = (
+            OrderedDict()
+        )
+        self._version = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = SearchCacheStats()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0
+
+    def get(self, key: Hashable, version: Any) -> List[Document] | None:
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            self.stats.saved_seconds += entry[2]
+        # the callers are free to modify the documents they get
+        return copy.deepcopy(entry[0])
+
+    def put(
+        self, key: Hashable, version: Any, documents: List[Document], seconds: float
+    ) -> None:
+        size = self._estimate_size(documents)
+        if self._max_size and size > self._max_size:
+            return
+        with self._lock:
+            self._check_version(version)
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (copy.deepcopy(documents), size, seconds)
+            self._size += size
+            while len(self._entries) > self._max_entries or (
+                self._max_size and self._size > self._max_size
+            ):
+                self._size -= self._entries.popitem(last=False)[1][1]
+            self.stats.entries, self.stats.size = len(self._entries), self._size
+
+    def _check_version(self, version: Any) -> None:
+        if version == self._version:
+            return
+        if self._entries:
+            self.stats.invalidations += 1
+        self._entries.clear()
+        self._size = 0
+        self._version = version
+        self.stats.entries, self.stats.size = 0, 0
+
+    @staticmethod
+    def _estimate_size(documents: List[Document]) -> int:
+        return sum(
+            len(document.page_content) + len(repr(document.metadata))
+            for document in documents
+        )
+
+
+@dataclass
+class SemanticCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # search time of the hits when they were computed, minus the re-ranking
+    saved_seconds: float = 0.0
+    # hits checked against the actual search, and the ones returning other listings
+    verified_hits: int = 0
+    false_hits: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def false_hit_rate(self) -> float:
+        return self.false_hits / self.verified_hits if self.verified_hits else 0.0
+
+
+class SemanticCacheEntry(NamedTuple):
+    ids: List[str]
+    documents: List[Document]
+    seconds: float
+    similarity: float
+
+
+class SemanticQueryCache(object):
+    """
+    Cache of the latest searches matched on the similarity of their query
+    vectors, for the queries worded differently but meaning the same: a query
+    whose cosine similarity to a cached one (with the same search context:
+    filters, columns, limit...) is at least `threshold` gets its results.
+    The query vectors are kept normalized in a matrix, looked up with one
+    matrix-vector product, the oldest one being replaced when it is full.
+
+    :param max_entries: 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int = 256, threshold: float = 0.95) -> None:
+        self._max_entries = max_entries
+        self._threshold = threshold
+        self._vectors: np.ndarray | None = None
+        self._contexts = np.zeros(max_entries, dtype=np.int64)
+        self._entries: List[SemanticCacheEntry | None] = [None] * max_entries
+        self._count = 0
+        self._next = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.stats = SemanticCacheStats()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0
+
+    def lookup(
+        self, vector: Sequence[float], context: Hashable, version: Any
+    ) -> SemanticCacheEntry | None:
+        query = normalize(vector)
+        with self._lock:
+            self._check_version(version)
+            entry = None
+            if self._count and self._vectors.shape[1] == len(query):
+                similarities = self._vectors[: self._count] @ query
+                similarities[self._contexts[: self._count] != hash(context)] = -1
+                index = int(np.argmax(similarities))
+                if similarities[index] >= self._threshold:
+                    entry = self._entries[index]._replace(
+                        similarity=float(similarities[index])
+                    )
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+        return entry._replace(documents=copy.deepcopy(entry.documents))
+
+    def put(
+        self,
+        vector: Sequence[float],
+        context: Hashable,
+        version: Any,
+        documents: List[Document],
+        seconds: float,
+    ) -> None:
+        query = normalize(vector)
+        ids = [document.metadata.get("id") for document in documents]
+        with self._lock:
+            self._check_version(version)
+            if self._vectors is None or self._vectors.shape[1] != len(query):
+                self._vectors = np.zeros(
+                    (self._max_entries, len(query)), dtype=np.float32
+                )
+                self._count = self._next = 0
+            self._vectors[self._next] = query
+            self._contexts[self._next] = hash(context)
+            self._entries[self._next] = SemanticCacheEntry(
+                ids, copy.deepcopy(documents), seconds, 1.0
+            )
+            self._next = (self._next + 1) % self._max_entries
+            self._count = min(self._count + 1, self._max_entries)
+
+    def record_saving(self, seconds: float) -> None:
+        with self._lock:
+            self.stats.saved_seconds += max(0.0, seconds)
+
+    def record_verification(self, false_hit: bool) -> None:
+        with self._lock:
+            self.stats.verified_hits += 1
+            self.stats.false_hits += int(false_hit)
+
+    def _check_version(self, version: Any) -> None:
+        if version != self._version:
+            self._count = self._next = 0
+            self._entries = [None] * self._max_entries
+            self._version = version
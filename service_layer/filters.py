@@ -0,0 +1,31 @@
+from dataclasses import dataclass, field, fields
+from typing import List
+
+# numeric listings columns filtered with a min_<column>/max_<column> range
+RANGE_COLUMNS = ("price", "bedrooms", "bathrooms", "house_size")
+
+
+@dataclass
+class ListingFilters:
+    """
+    Structured constraints on the listings, applied before the vector search.
+    The bounds are inclusive and None when not constrained.
+    """
+
+    min_price: float | None = None
+    max_price: float | None = None
+    min_bedrooms: int | None = None
+    max_bedrooms: int | None = None
+    min_bathrooms: int | None = None
+    max_bathrooms: int | None = None
+    min_house_size: float | None = None
+    max_house_size: float | None = None
+    # any of these neighborhoods
+    neighborhoods: List[str] = field(default_factory=list)
+    # all of these amenities tags
+    amenities: List[str] = field(default_factory=list)
+    # only these listings
+    ids: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, f.name) not in (None, []) for f in fields(self))
@@ -0,0 +1,577 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from utils.vectors import normalize
+
+from .filters import RANGE_COLUMNS, ListingFilters
+from .quantization import DEFAULT_SUBSPACE_DIMS, ProductQuantizer
+
+VECTOR_COLUMNS = ("vector", "image_vector")
+_INTEGER_COLUMNS = ("bedrooms", "bathrooms")
+_MANIFEST = "table.json"
+# the table is rewritten in one segment past these numbers of segments and
+# share of deleted rows
+_MAX_SEGMENTS = 32
+_MAX_DELETED_SHARE = 0.25
+
+
+class Segments(object):
+    """
+    Matrix stored in consecutive blocks of rows (the memory-mapped segment
+    files of a saved table), indexed like a single matrix.
+    """
+
+    def __init__(self, blocks: List[np.ndarray]) -> None:
+        self.blocks = blocks
+        self._ends = np.cumsum([len(block) for block in blocks])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return int(self._ends[-1]), self.blocks[0].shape[1]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.blocks[0].dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        array = (
+            np.asarray(self.blocks[0])
+            if len(self.blocks) == 1
+            else np.concatenate(self.blocks)
+        )
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, indices) -> np.ndarray:
+        """rows of an index, or of an array of indices (any shape)"""
+        if np.isscalar(indices):
+            block = int(np.searchsorted(self._ends, indices, side="right"))
+            return self.blocks[block][indices - self._start(block)]
+        indices = np.asarray(indices)
+        flat = indices.ravel()
+        blocks = np.searchsorted(self._ends, flat, side="right")
+        rows = np.empty((len(flat), self.shape[1]), dtype=self.dtype)
+        for block in np.unique(blocks):
+            selected = blocks == block
+            rows[selected] = self.blocks[block][flat[selected] - self._start(block)]
+        return rows.reshape(indices.shape + (self.shape[1],))
+
+    def dot(self, queries: np.ndarray) -> np.ndarray:
+        """inner products of the queries with all the rows"""
+        return np.concatenate([queries @ block.T for block in self.blocks], axis=1)
+
+    def _start(self, block: int) -> int:
+        return int(self._ends[block - 1]) if block else 0
+
+
+class Snapshot(NamedTuple):
+    """arrays of a version of the table"""
+
+    columns: Dict[str, np.ndarray]
+    vectors: Dict[str, Segments]
+    # quantizer and codes of the quantized vector columns
+    codes: Dict[str, Tuple[ProductQuantizer, np.ndarray]]
+    # rows deleted since the table was last rewritten
+    deleted: np.ndarray
+
+
+class NumpyTable(object):
+    """
+    Listings table held in NumPy arrays: a normalized float32 matrix per vector
+    column (the cosine similarity being a dot product) and an array per other
+    column, numeric (float64) for the range filtered columns.
+
+    With a `path`, the rows of every addition are saved to a new segment of
+    .npy files, the vectors memory-mapped from them, and the deletions to a
+    mask of the deleted rows. The table is rewritten in one segment when it
+    has too many segments or deleted rows.
+    The arrays are replaced, never modified, so the searches run on a consistent
+    snapshot without locking.
+
+    A vector column can also be product quantized (see `quantize`): its compact
+    codes are kept in memory and scanned first, then the `rerank_factor` * limit
+    best candidates are ranked with their full precision vectors, read from the
+    files of a saved table.
+    """
+
+    def __init__(self, path: str | None = None, rerank_factor: int = 10) -> None:
+        self._path = path
+        self._rerank_factor = rerank_factor
+        self._lock = threading.Lock()
+        self._columns: Dict[str, np.ndarray] = {}
+        self._vectors: Dict[str, Segments] = {}
+        self._codes: Dict[str, Tuple[ProductQuantizer, np.ndarray]] = {}
+        self._deleted = np.zeros(0, dtype=bool)
+        self.version = 0
+        # number of the saved files, changed on every save
+        self._generation = 0
+        # (generation, rows, columns) of the saved segments
+        self._segments: List[List] = []
+        # stat of the manifest last read or written
+        self._manifest_stat = None
+        if path and os.path.isfile(os.path.join(path, _MANIFEST)):
+            self._load()
+
+    def refresh(self) -> None:
+        """reload the table when it was saved by another process"""
+        if not self._path:
+            return
+        with self._lock:
+            if self._stat_manifest() == self._manifest_stat:
+                return
+            try:
+                self._load()
+            except FileNotFoundError:
+                # the files were replaced in the meantime, reloaded on the next call
+                self._manifest_stat = None
+
+    def count_rows(self) -> int:
+        return int(len(self._deleted) - self._deleted.sum())
+
+    def add(self, records: List[Dict]) -> None:
+        if not records:
+            return
+        with self._lock:
+            count = len(self._deleted)
+            names = {key for record in records for key in record} | set(self._columns)
+            columns = {
+                name: np.concatenate(
+                    [
+                        self._columns.get(name, self._new_column(name, [None] * count)),
+                        self._new_column(name, [r.get(name) for r in records]),
+                    ]
+                )
+                for name in names - set(VECTOR_COLUMNS)
+            }
+            vectors = dict(self._vectors)
+            for name in VECTOR_COLUMNS:
+                rows = [record.get(name) for record in records]
+                segments = self._vectors.get(name)
+                dims = segments.shape[1] if segments is not None else None
+                dims = dims or next((len(row) for row in rows if row is not None), 0)
+                if not dims:
+                    continue
+                blocks = segments.blocks if segments is not None else []
+                if segments is None and count:
+                    blocks = [np.zeros((count, dims), dtype=np.float32)]
+                # the listings without a vector never match
+                new_rows = np.zeros((len(rows), dims), dtype=np.float32)
+                for index, row in enumerate(rows):
+                    if row is not None:
+                        new_rows[index] = row
+                vectors[name] = Segments([*blocks, normalize(new_rows)])
+            codes = {
+                name: (
+                    quantizer,
+                    np.concatenate([codes, quantizer.encode(vectors[name].blocks[-1])]),
+                )
+                for name, (quantizer, codes) in self._codes.items()
+            }
+            deleted = np.concatenate([self._deleted, np.zeros(len(records), bool)])
+            self._replace(columns, vectors, codes, deleted, added=count)
+
+    def delete(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            ids = set(ids)
+            deleted = self._deleted | np.fromiter(
+                (id in ids for id in self._columns.get("id", ())),
+                dtype=bool,
+                count=len(self._deleted),
+            )
+            if deleted.sum() == self._deleted.sum():
+                return
+            self._replace(self._columns, self._vectors, self._codes, deleted)
+
+    def quantize(
+        self, column: str, subspaces: int | None = None, clusters: int = 256
+    ) -> None:
+        """
+        Train a product quantizer on the `column` vectors and encode them, the
+        vectors added later being encoded with the same quantizer.
+        The table is rewritten in one segment.
+
+        :param subspaces: bytes per vector, one per DEFAULT_SUBSPACE_DIMS
+                          dimensions by default, 0 to remove the quantization.
+        """
+        with self._lock:
+            codes = dict(self._codes)
+            codes.pop(column, None)
+            if subspaces != 0:
+                matrix = np.asarray(self._vectors[column])
+                quantizer = ProductQuantizer.train(
+                    matrix,
+                    subspaces or max(1, matrix.shape[1] // DEFAULT_SUBSPACE_DIMS),
+                    clusters,
+                )
+                codes[column] = (quantizer, quantizer.encode(matrix))
+            # same data: the version is kept
+            self._replace(
+                self._columns,
+                self._vectors,
+                codes,
+                self._deleted,
+                compact=True,
+                version=self.version,
+            )
+
+    def snapshot(self) -> Snapshot:
+        return Snapshot(self._columns, self._vectors, self._codes, self._deleted)
+
+    def distinct(self, column: str) -> List[Any]:
+        if column not in self._columns:
+            return []
+        values = self._columns[column][~self._deleted]
+        return list({_to_python(value) for value in values if value is not None})
+
+    def search(
+        self,
+        column: str,
+        queries: Sequence,
+        limit: int,
+        filters: List[ListingFilters] = (),
+        columns: List[str] | None = None,
+        exact: bool = False,
+    ) -> List[List[Dict]]:
+        """
+        Rows of the `limit` most similar listings to every query vector, among
+        the ones matching all the `filters`. The queries are scored at once,
+        with a matrix product, and only the top `limit` scores are sorted.
+
+        :param exact: score all the vectors of a quantized column.
+        """
+        snapshot = self.snapshot()
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        matrix = snapshot.vectors.get(column)
+        candidates = np.flatnonzero(self._mask(snapshot, filters))
+        limit = min(limit, len(candidates))
+        if matrix is None or not limit:
+            return [[] for _ in queries]
+        shortlist = limit * self._rerank_factor
+        if column in snapshot.codes and not exact and len(candidates) > shortlist:
+            quantizer, codes = snapshot.codes[column]
+            scores = quantizer.scores(queries, codes[candidates])
+            # (queries, shortlist) rows, ranked again with their full vectors
+            candidates = candidates[_top(scores, shortlist)]
+            rows, inverse = np.unique(candidates, return_inverse=True)
+            vectors = matrix[rows][inverse.reshape(candidates.shape)]
+            scores = np.einsum("qd,qsd->qs", queries, vectors)
+            indices = np.take_along_axis(candidates, _top(scores, limit), axis=1)
+        else:
+            if len(candidates) < len(matrix):
+                scores = queries @ matrix[candidates].T
+            else:
+                scores = matrix.dot(queries)
+            indices = candidates[_top(scores, limit)]
+        return [self._rows(snapshot, row_indices, columns) for row_indices in indices]
+
+    def rows(
+        self,
+        limit: int,
+        filters: List[ListingFilters] = (),
+        columns: List[str] | None = None,
+    ) -> List[Dict]:
+        snapshot = self.snapshot()
+        indices = np.flatnonzero(self._mask(snapshot, filters))[:limit]
+        return self._rows(snapshot, indices, columns)
+
+    def _mask(self, snapshot: Snapshot, filters: List[ListingFilters]) -> np.ndarray:
+        columns = snapshot.columns
+        count = len(snapshot.deleted)
+        mask = ~snapshot.deleted
+
+        def _matching(column: str, predicate) -> np.ndarray:
+            if column not in columns:
+                return np.zeros(count, dtype=bool)
+            return np.fromiter(map(predicate, columns[column]), dtype=bool, count=count)
+
+        for listing_filters in filters:
+            for column in RANGE_COLUMNS:
+                low = getattr(listing_filters, f"min_{column}")
+                high = getattr(listing_filters, f"max_{column}")
+                # the missing values (nan) are out of any range
+                if low is not None:
+                    mask &= columns[column] >= low if column in columns else False
+                if high is not None:
+                    mask &= columns[column] <= high if column in columns else False
+            if listing_filters.neighborhoods:
+                neighborhoods = set(listing_filters.neighborhoods)
+                mask &= _matching("neighborhood", lambda v: v in neighborhoods)
+            if listing_filters.amenities:
+                amenities = set(listing_filters.amenities)
+                mask &= _matching("amenities", lambda v: amenities <= set(v or ()))
+            if listing_filters.ids:
+                ids = set(listing_filters.ids)
+                mask &= _matching("id", lambda v: v in ids)
+        return mask
+
+    @staticmethod
+    def _rows(
+        snapshot: Snapshot, indices: Iterable[int], columns: List[str] | None
+    ) -> List[Dict]:
+        metadata, vectors, _, _ = snapshot
+        names = columns or list(metadata) + list(vectors)
+        rows = []
+        for index in indices:
+            row = {}
+            for name in names:
+                if name in vectors:
+                    row[name] = vectors[name][index].tolist()
+                elif name in metadata:
+                    row[name] = _to_python(metadata[name][index], name)
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _new_column(name: str, values: List[Any]) -> np.ndarray:
+        if name in RANGE_COLUMNS:
+            return np.array(
+                [np.nan if value is None else value for value in values],
+                dtype=np.float64,
+            )
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+    def _replace(
+        self,
+        columns: Dict[str, np.ndarray],
+        vectors: Dict[str, Segments],
+        codes: Dict[str, Tuple[ProductQuantizer, np.ndarray]],
+        deleted: np.ndarray,
+        added: int | None = None,
+        compact: bool = False,
+        version: int | None = None,
+    ) -> None:
+        """
+        :param added: index of the first added row, None for a deletion.
+        :param compact: drop the deleted rows and rewrite the table in one
+                        segment, also done past _MAX_SEGMENTS segments and
+                        _MAX_DELETED_SHARE deleted rows.
+        :param version: the new version, the next one by default.
+        """
+        segments = len(self._segments) + (added is not None)
+        segments = max([segments, *(len(v.blocks) for v in vectors.values())])
+        compact = compact or segments > _MAX_SEGMENTS
+        compact = compact or deleted.sum() > _MAX_DELETED_SHARE * len(deleted)
+        keep = None
+        if compact:
+            keep, added = ~deleted, 0
+            columns = {name: column[keep] for name, column in columns.items()}
+            codes = {
+                name: (quantizer, codes[keep])
+                for name, (quantizer, codes) in codes.items()
+            }
+            deleted = np.zeros(int(keep.sum()), dtype=bool)
+        version = self.version + 1 if version is None else version
+        if self._path:
+            vectors = self._save(columns, vectors, codes, deleted, version, added, keep)
+        elif keep is not None:
+            vectors = {
+                name: Segments([np.asarray(matrix)[keep]])
+                for name, matrix in vectors.items()
+            }
+        self._columns, self._vectors, self._codes = columns, vectors, codes
+        self._deleted = deleted
+        self.version = version
+
+    def _save(
+        self,
+        columns: Dict[str, np.ndarray],
+        vectors: Dict[str, Segments],
+        codes: Dict[str, Tuple[ProductQuantizer, np.ndarray]],
+        deleted: np.ndarray,
+        version: int,
+        added: int | None,
+        keep: np.ndarray | None,
+    ) -> Dict[str, Segments]:
+        """
+        Write the rows from the index `added` to a new segment (all the rows
+        `keep` from 0, replacing the previous segments), and the deleted rows.
+        The manifest is written last, pointing to the files of the save: the
+        files of an interrupted save are never read, and the files no longer
+        used are removed once it is replaced.
+
+        :return: the vectors, memory-mapped from the segments files
+        """
+        os.makedirs(self._path, exist_ok=True)
+        generation = self._generation + 1
+        segments = [] if added == 0 else list(self._segments)
+        if added is not None:
+            for name, column in columns.items():
+                self._write_array(name, generation, column[added:])
+            for name, (quantizer, name_codes) in codes.items():
+                # the quantizers only change with the first segment
+                if not added:
+                    self._write_array(
+                        f"{name}.codebooks", generation, quantizer.codebooks
+                    )
+                self._write_array(f"{name}.codes", generation, name_codes[added:])
+            for name, matrix in vectors.items():
+                if keep is None:
+                    # the added rows are the last block
+                    self._write_array(name, generation, matrix.blocks[-1])
+                else:
+                    self._write_vectors(name, generation, matrix, keep)
+            names = [*columns, *vectors, *(f"{name}.codes" for name in codes)]
+            segments.append([generation, len(deleted) - added, names])
+        if deleted.any():
+            self._write_array("deleted", generation, deleted)
+        manifest = dict(
+            version=version,
+            generation=generation,
+            segments=segments,
+            columns=list(columns),
+            vectors=list(vectors),
+            quantized=list(codes),
+            deleted=generation if deleted.any() else None,
+        )
+        with open(os.path.join(self._path, f"{_MANIFEST}.tmp"), "w") as f:
+            json.dump(manifest, f)
+        os.replace(
+            os.path.join(self._path, f"{_MANIFEST}.tmp"),
+            os.path.join(self._path, _MANIFEST),
+        )
+        self._manifest_stat = self._stat_manifest()
+        self._generation, self._segments = generation, segments
+        used = {str(segment[0]) for segment in segments} | {str(manifest["deleted"])}
+        for file in os.listdir(self._path):
+            if file.endswith(".npy") and file.rsplit(".", 2)[-2] not in used:
+                os.remove(os.path.join(self._path, file))
+        # the full precision vectors are left on disk
+        return self._map_vectors(list(vectors), segments)
+
+    def _load(self) -> None:
+        manifest_stat = self._stat_manifest()
+        with open(os.path.join(self._path, _MANIFEST)) as f:
+            manifest = json.load(f)
+        segments = manifest["segments"]
+        # the segments already loaded are kept
+        kept = 0
+        while kept < min(len(segments), len(self._segments)):
+            if segments[kept] != self._segments[kept]:
+                break
+            kept += 1
+        start = sum(rows for _, rows, _ in segments[:kept])
+
+        def _concatenate(name: str, loaded: Dict[str, np.ndarray], **kwargs):
+            arrays, loading = [], segments
+            if name in loaded:
+                arrays, loading = [loaded[name][:start]], segments[kept:]
+            for segment, rows, names in loading:
+                if name in names:
+                    arrays.append(self._load_array(name, segment, **kwargs))
+                else:
+                    # the segments saved before the column
+                    arrays.append(self._new_column(name, [None] * rows))
+            return np.concatenate(arrays)
+
+        columns = {
+            name: _concatenate(name, self._columns, allow_pickle=True)
+            for name in manifest["columns"]
+        }
+        codes = {}
+        for name in manifest["quantized"]:
+            quantizer = ProductQuantizer(
+                self._load_array(f"{name}.codebooks", segments[0][0])
+            )
+            loaded = {name: self._codes[name][1]} if name in self._codes else {}
+            codes[name] = (quantizer, _concatenate(f"{name}.codes", loaded))
+        count = sum(rows for _, rows, _ in segments)
+        deleted = np.zeros(count, dtype=bool)
+        if manifest["deleted"] is not None:
+            deleted = self._load_array("deleted", manifest["deleted"])
+        vectors = self._map_vectors(manifest["vectors"], segments)
+        # replaced once all the arrays are read
+        self._columns, self._vectors, self._codes = columns, vectors, codes
+        self._deleted = deleted
+        self._generation, self._segments = manifest["generation"], segments
+        self.version = manifest["version"]
+        self._manifest_stat = manifest_stat
+
+    def _stat_manifest(self) -> Tuple[int, int] | None:
+        # the manifest is replaced on every save: a new inode
+        try:
+            stat = os.stat(os.path.join(self._path, _MANIFEST))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _array_file(self, name: str, segment: int) -> str:
+        return os.path.join(self._path, f"{name}.{segment}.npy")
+
+    def _write_array(self, name: str, segment: int, array: np.ndarray) -> None:
+        with open(self._array_file(name, segment), "wb") as f:
+            np.save(f, array, allow_pickle=array.dtype == object)
+
+    def _write_vectors(
+        self, name: str, segment: int, matrix: Segments, keep: np.ndarray
+    ) -> None:
+        """write the `keep` rows of the matrix, one block at a time"""
+        output = np.lib.format.open_memmap(
+            self._array_file(name, segment),
+            mode="w+",
+            dtype=np.float32,
+            shape=(int(keep.sum()), matrix.shape[1]),
+        )
+        start = end = 0
+        for block in matrix.blocks:
+            rows = np.asarray(block)[keep[start : start + len(block)]]
+            output[end : end + len(rows)] = rows
+            start, end = start + len(block), end + len(rows)
+        output.flush()
+        del output
+
+    def _load_array(self, name: str, segment: int, **kwargs) -> np.ndarray:
+        return np.load(self._array_file(name, segment), **kwargs)
+
+    def _map_vectors(
+        self, names: List[str], segments: List[List]
+    ) -> Dict[str, Segments]:
+        vectors = {}
+        for name in names:
+            blocks = [
+                (
+                    self._load_array(name, segment, mmap_mode="r")
+                    if name in segment_names
+                    else rows
+                )
+                for segment, rows, segment_names in segments
+            ]
+            # the listings of the segments saved before the column have no vector
+            dims = next(
+                block.shape[1] for block in blocks if not isinstance(block, int)
+            )
+            vectors[name] = Segments(
+                [
+                    (
+                        np.zeros((block, dims), dtype=np.float32)
+                        if isinstance(block, int)
+                        else block
+                    )
+                    for block in blocks
+                ]
+            )
+        return vectors
+
+
+def _top(scores: np.ndarray, limit: int) -> np.ndarray:
+    """column indices of the `limit` highest scores of every row, sorted"""
+    top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def _to_python(value: Any, column: str | None = None) -> Any:
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if column in _INTEGER_COLUMNS and isinstance(value, float):
+        return int(value)
+    return value
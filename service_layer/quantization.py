@@ -0,0 +1,165 @@
+import logging
+from typing import Dict
+
+import numpy as np
+
+from utils.vectors import normalize
+
+_logger = logging.getLogger(__name__)
+
+# default size of the subspaces: 16 float32 (64 bytes) encoded in 1 byte
+DEFAULT_SUBSPACE_DIMS = 16
+_ENCODING_CHUNK = 65536
+
+
+class ProductQuantizer(object):
+    """
+    Product quantization of vectors for approximate inner products: a vector is
+    split in `subspaces` chunks, every chunk encoded (one byte) by the nearest
+    of the `clusters` centroids learned on its subspace with k-means.
+    The inner product of a query with an encoded vector is the sum of the inner
+    products of the query chunks with the centroids of the code, looked up in a
+    (subspaces, clusters) table computed once per query.
+
+    :param codebooks: centroids, (subspaces, clusters, dims / subspaces).
+    """
+
+    def __init__(self, codebooks: np.ndarray) -> None:
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+
+    @property
+    def subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @property
+    def dims(self) -> int:
+        return self.codebooks.shape[0] * self.codebooks.shape[2]
+
+    @property
+    def code_size(self) -> int:
+        """bytes per encoded vector"""
+        return self.subspaces
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        subspaces: int,
+        clusters: int = 256,
+        iterations: int = 20,
+        max_samples: int = 100_000,
+        seed: int = 0,
+    ) -> "ProductQuantizer":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not 0 < clusters <= 256:
+            raise ValueError(f"Got {clusters} clusters, the codes are bytes (<= 256)")
+        if not subspaces or vectors.shape[1] % subspaces:
+            raise ValueError(
+                f"Got {subspaces} subspaces for vectors of {vectors.shape[1]} dims"
+            )
+        rng = np.random.default_rng(seed)
+        if len(vectors) > max_samples:
+            vectors = vectors[np.sort(rng.choice(len(vectors), max_samples, False))]
+        clusters = min(clusters, len(vectors))
+        chunks = vectors.reshape(len(vectors), subspaces, -1)
+        codebooks = np.stack(
+            [
+                cls._kmeans(chunks[:, index], clusters, iterations, rng)
+                for index in range(subspaces)
+            ]
+        )
+        return cls(codebooks)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), _ENCODING_CHUNK):
+            chunks = vectors[start : start + _ENCODING_CHUNK].reshape(
+                -1, self.subspaces, self.codebooks.shape[2]
+            )
+            for index, centroids in enumerate(self.codebooks):
+                codes[start : start + len(chunks), index] = self._nearest(
+                    chunks[:, index], centroids
+                )
+        return codes
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """approximate inner products of the queries with the encoded vectors"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(
+            len(queries), self.subspaces, -1
+        )
+        # (subspaces, queries, clusters)
+        tables = np.einsum("qsd,skd->sqk", queries, self.codebooks)
+        # the lookups are faster on contiguous codes of a subspace
+        codes = np.ascontiguousarray(codes.T)
+        scores = np.zeros((len(queries), codes.shape[1]), dtype=np.float32)
+        for index in range(self.subspaces):
+            scores += np.take(tables[index], codes[index], axis=1)
+        return scores
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # argmin of |v - c|² = |v|² - 2 v.c + |c|², |v|² being the same for all c
+        return np.argmax(2 * vectors @ centroids.T - (centroids**2).sum(axis=1), axis=1)
+
+    @classmethod
+    def _kmeans(
+        cls,
+        vectors: np.ndarray,
+        clusters: int,
+        iterations: int,
+        rng: np.random.Generator,
+    ) -> np.ndarray:
+        centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = cls._nearest(vectors, centroids)
+            counts = np.bincount(assignments, minlength=clusters)
+            # the empty clusters keep their centroid
+            filled = counts > 0
+            order = np.argsort(assignments, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+            sums = np.add.reduceat(vectors[order], starts, axis=0)
+            centroids[filled] = sums / counts[filled, np.newaxis]
+        return centroids
+
+
+def evaluate_quantization(
+    table, column: str, k: int = 10, queries: int = 100, seed: int = 0
+) -> Dict[str, float]:
+    """
+    Memory per listing of the `column` vectors (full and kept in memory) and
+    recall@k of the `table` searches, against the exact search, for queries
+    near random listings.
+    """
+    snapshot = table.snapshot()
+    matrix, codes = snapshot.vectors[column], snapshot.codes
+    rows = np.flatnonzero(~snapshot.deleted)
+    rng = np.random.default_rng(seed)
+    samples = matrix[np.sort(rng.choice(rows, min(queries, len(rows)), False))]
+    # the noise puts the queries at a ~0.7 similarity of the sampled listings
+    noise = rng.normal(scale=1 / np.sqrt(matrix.shape[1]), size=samples.shape)
+    query_vectors = normalize(samples + noise)
+
+    expected = table.search(column, query_vectors, k, columns=["id"], exact=True)
+    results = table.search(column, query_vectors, k, columns=["id"])
+    found = sum(
+        len({row["id"] for row in rows} & {row["id"] for row in expected_rows})
+        for rows, expected_rows in zip(results, expected)
+    )
+    full_bytes = matrix.shape[1] * matrix.dtype.itemsize
+    report = {
+        "full_bytes_per_listing": full_bytes,
+        "bytes_per_listing": (
+            codes[column][0].code_size if column in codes else full_bytes
+        ),
+        f"recall@{k}": found / max(1, sum(map(len, expected))),
+    }
+    _logger.info(
+        "%s: %d bytes per listing in memory (%d full precision), recall@%d %.3f",
+        column,
+        report["bytes_per_listing"],
+        full_bytes,
+        k,
+        report[f"recall@{k}"],
+    )
+    return report
@@ -1,29 +1,67 @@
+import hashlib
 import logging
+import random
+import threading
+import time
+from array import array
+from dataclasses import dataclass, replace
 from functools import partial
-from typing import List
+from typing import List, Tuple
 
 from langchain_core.documents.base import Document
 from PIL.Image import Image
 
 from config import CONFIG
-from utils.utils import singleton
+from utils import embedd_text
+from utils.utils import singleton, to_bool
 
+from .cache import (
+    SearchCacheStats,
+    SearchResultCache,
+    SemanticCacheStats,
+    SemanticQueryCache,
+)
 from .constants import DEFAULT_VECTOR_DB_ENGINE
+from .filters import ListingFilters
 from .vector_db_managers import get_vectordb_manager
 
 _logger = logging.getLogger(__name__)
 
 
+@dataclass
+class SearchQuery:
+    """arguments of one search of `ListingsService.search_batch`"""
+
+    text: str | None = None
+    image: Image | None = None
+    text_vector: List[float] | None = None
+    amenities: List[str] | None = None
+    filters: ListingFilters | None = None
+
+
 @singleton(init_once=True)
 class ListingsService(object):
 
     class InvalidSearchArgsException(Exception):
         pass
 
+    # seconds the known neighborhoods are cached
+    _neighborhoods_ttl = 300
+
     def __init__(self, engine=None) -> None:
         engine = engine or CONFIG.vector_db_engine or DEFAULT_VECTOR_DB_ENGINE
         self._db_manager = get_vectordb_manager(engine=engine)
         self._db_manager.init()
+        self._neighborhoods: Tuple[float, List[str]] | None = None
+        self._neighborhoods_lock = threading.Lock()
+        self._cache = SearchResultCache(
+            max_entries=int(CONFIG.search_cache_max_entries),
+            max_size=int(float(CONFIG.search_cache_max_mb) * 1024 * 1024),
+        )
+        self._semantic_cache = SemanticQueryCache(
+            max_entries=int(CONFIG.semantic_cache_max_entries),
+            threshold=float(CONFIG.semantic_cache_threshold),
+        )
 
     def search(
         self,
@@ -32,24 +70,250 @@ class ListingsService(object):
         text_field: str = None,
         limit: int = 3,
         columns: List[str] | None = None,
+        text_vector: List[float] | None = None,
+        amenities: List[str] | None = None,
+        filters: ListingFilters | None = None,
     ) -> list[Document]:
+        """
+        :param text_vector: embedding to search with instead of the one of `text`
+        :param amenities: only the listings tagged with all these amenities
+        :param filters: constraints applied before the vector search; when no
+                        listing matches them, the search is run without them.
+
+        The results are cached until the listings table changes, and the text
+        searches are matched to the similar previous ones by the semantic cache.
+        """
+        if text_vector is not None:
+            text = text_vector
         if not (text or image):
             raise self.__class__.InvalidSearchArgsException(
                 "Invalid arguments: at least one of text and image must be provided"
             )
+        if amenities:
+            filters = replace(filters or ListingFilters(), amenities=amenities)
+        if not (self._cache.enabled or self._semantic_cache.enabled):
+            return self._search(text, image, text_field, limit, columns, filters)
+
+        search_args = (text, image, text_field, limit, columns, filters)
+        version = self._db_manager._data_version()
+        key = self._search_key(*search_args) if self._cache.enabled else None
+        if key is None:
+            return self._semantic_search(*search_args, version)
+        documents = self._cache.get(key, version)
+        if documents is None:
+            start = time.perf_counter()
+            documents = self._semantic_search(*search_args, version)
+            self._cache.put(key, version, documents, time.perf_counter() - start)
+        return documents
+
+    def search_batch(
+        self,
+        queries: List[SearchQuery],
+        text_field: str = None,
+        limit: int = 3,
+        columns: List[str] | None = None,
+    ) -> List[list[Document]]:
+        """
+        Results of several searches, in the order of the queries: the texts are
+        embedded together, and the text searches are run as one batched vector
+        search (`_text_search_batch`). The searches with an image are run one by
+        one by `search`.
+
+        The results are cached like the ones of `search`, but the semantic cache
+        is not used.
+        """
+        texts = list(
+            {
+                query.text
+                for query in queries
+                if query.image is None and query.text_vector is None and query.text
+            }
+        )
+        vectors = dict(zip(texts, embedd_text(texts, use_cache=True))) if texts else {}
+        version = self._db_manager._data_version()
+
+        results: List[list[Document] | None] = [None] * len(queries)
+        # (index, vector, filters, cache key) of the queries to search
+        pending = []
+        for index, query in enumerate(queries):
+            filters = query.filters
+            if query.amenities:
+                filters = replace(
+                    filters or ListingFilters(), amenities=query.amenities
+                )
+            if query.image is not None:
+                results[index] = self.search(
+                    text=query.text,
+                    image=query.image,
+                    text_field=text_field,
+                    limit=limit,
+                    columns=columns,
+                    text_vector=query.text_vector,
+                    filters=filters,
+                )
+                continue
+            vector = query.text_vector
+            if vector is None:
+                vector = vectors.get(query.text)
+            if vector is None:
+                raise self.__class__.InvalidSearchArgsException(
+                    f"Invalid query {index}: at least one of text and image "
+                    "must be provided"
+                )
+            key = self._search_key(vector, None, text_field, limit, columns, filters)
+            if self._cache.enabled:
+                results[index] = self._cache.get(key, version)
+            if results[index] is None:
+                pending.append((index, vector, filters, key))
+        if not pending:
+            return results
+
+        start = time.perf_counter()
+        documents = self._db_manager._text_search_batch(
+            [vector for _, vector, _, _ in pending],
+            [filters for _, _, filters, _ in pending],
+            columns=columns,
+            text_field=text_field,
+            limit=limit,
+        )
+        unmatched = [
+            position
+            for position, (_, _, filters, _) in enumerate(pending)
+            if filters and not documents[position]
+        ]
+        if unmatched:
+            _logger.info(
+                "no listing matching the filters of %d queries, "
+                "searching without filters",
+                len(unmatched),
+            )
+            unfiltered = self._db_manager._text_search_batch(
+                [pending[position][1] for position in unmatched],
+                [None] * len(unmatched),
+                columns=columns,
+                text_field=text_field,
+                limit=limit,
+            )
+            for position, query_documents in zip(unmatched, unfiltered):
+                documents[position] = query_documents
+        seconds = (time.perf_counter() - start) / len(pending)
+        for (index, _, _, key), query_documents in zip(pending, documents):
+            results[index] = query_documents
+            if self._cache.enabled:
+                self._cache.put(key, version, query_documents, seconds)
+        return results
+
+    def cache_stats(self) -> SearchCacheStats:
+        return self._cache.stats
+
+    def semantic_cache_stats(self) -> SemanticCacheStats:
+        return self._semantic_cache.stats
+
+    def _semantic_search(
+        self, text, image, text_field, limit, columns, filters, version
+    ) -> list[Document]:
+        """search through the semantic cache (text only searches)"""
+        if image is not None or not self._semantic_cache.enabled:
+            return self._search(text, image, text_field, limit, columns, filters)
+        vector = embedd_text(text, use_cache=True)[0] if isinstance(text, str) else text
+        context = self._search_key(None, None, text_field, limit, columns, filters)
+        entry = self._semantic_cache.lookup(vector, context, version)
+        if entry is None:
+            start = time.perf_counter()
+            documents = self._search(vector, None, text_field, limit, columns, filters)
+            self._semantic_cache.put(
+                vector, context, version, documents, time.perf_counter() - start
+            )
+            return documents
+
+        start = time.perf_counter()
+        documents = entry.documents
+        if to_bool(CONFIG.semantic_cache_rerank) and entry.ids:
+            # exact ranking of the cached listings for this query
+            documents = self._search(
+                vector,
+                None,
+                text_field,
+                limit,
+                columns,
+                replace(filters or ListingFilters(), ids=entry.ids),
+            )
+        self._semantic_cache.record_saving(
+            entry.seconds - (time.perf_counter() - start)
+        )
+        if random.random() < float(CONFIG.semantic_cache_verify_rate):
+            actual = self._search(vector, None, text_field, limit, columns, filters)
+            self._semantic_cache.record_verification(
+                {d.metadata.get("id") for d in actual}
+                != {d.metadata.get("id") for d in documents}
+            )
+        return documents
+
+    def _search(
+        self,
+        text: str | List[float] | None,
+        image: Image | None,
+        text_field: str | None,
+        limit: int,
+        columns: List[str] | None,
+        filters: ListingFilters | None,
+    ) -> list[Document]:
         retrieve_fn = partial(
             self._db_manager._retrieve_documents,
             columns=columns,
             text_field=text_field,
             limit=limit,
         )
-        if text and image:
-            query = self._db_manager._text_image_search(text, image)
-        elif text:
-            query = self._db_manager._text_search(text)
-        elif image:
-            query = self._db_manager._image_search(image)
-        return retrieve_fn(query_result=query)
+
+        def _query():
+            if text and image:
+                return self._db_manager._text_image_search(text, image)
+            elif text:
+                return self._db_manager._text_search(text)
+            return self._db_manager._image_search(image)
+
+        if filters:
+            documents = retrieve_fn(
+                query_result=self._db_manager._apply_filters(_query(), filters)
+            )
+            if documents:
+                return documents
+            _logger.info("no listing matching %s, searching without filters", filters)
+        return retrieve_fn(query_result=_query())
+
+    @staticmethod
+    def _search_key(text, image, text_field, limit, columns, filters) -> str | None:
+        """
+        digest of the search arguments, including the text (or vector) and image,
+        None when the image can't be hashed
+        """
+        digest = hashlib.sha256()
+        if isinstance(text, str):
+            digest.update(text.encode())
+        elif text is not None:
+            digest.update(array("f", text).tobytes())
+        if image is not None:
+            try:
+                digest.update(f"{image.mode}{image.size}".encode())
+                digest.update(image.tobytes())
+            except Exception as e:
+                _logger.debug("search not cached, image not hashable: %s", e)
+                return None
+        digest.update(repr((text_field, limit, columns, filters)).encode())
+        return digest.hexdigest()
+
+    def neighborhoods(self) -> List[str]:
+        """names of the neighborhoods of the listings"""
+        with self._neighborhoods_lock:
+            if (
+                self._neighborhoods is None
+                or time.monotonic() - self._neighborhoods[0] > self._neighborhoods_ttl
+            ):
+                self._neighborhoods = (
+                    time.monotonic(),
+                    sorted(self._db_manager._distinct_values("neighborhood")),
+                )
+            return self._neighborhoods[1]
 
     def get_by_id(
         self,
@@ -71,12 +335,26 @@ def get_relevant_listings(
     columns: list[str] | None = None,
     text_field: str = None,
     limit: int = 3,
+    text_vector: List[float] | None = None,
+    amenities: List[str] | None = None,
+    filters: ListingFilters | None = None,
 ) -> List[Document]:
     return ListingsService().search(
-        text=text, image=image, columns=columns, text_field=text_field, limit=limit
+        text=text,
+        image=image,
+        columns=columns,
+        text_field=text_field,
+        limit=limit,
+        text_vector=text_vector,
+        amenities=amenities,
+        filters=filters,
     )
 
 
+def get_listing_neighborhoods() -> List[str]:
+    return ListingsService().neighborhoods()
+
+
 def get_listing_by_id(
     id: str, columns: list[str] | None = None, text_field: str = None
 ) -> Document:
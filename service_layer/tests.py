@@ -7,6 +7,7 @@ from functools import partial
 from typing import Any
 from unittest import mock
 
+import numpy as np
 import pytest
 from langchain_core.documents.base import Document
 from PIL.Image import Image
@@ -14,8 +15,17 @@ from pydantic import BaseModel
 
 from utils.utils import singleton
 
-from .services import ListingsService
-from .vector_db_managers import AbstractVectorDBManager, LanceDBManager
+from .cache import SearchResultCache, SemanticQueryCache
+from .filters import ListingFilters
+from .numpy_table import NumpyTable
+from .quantization import ProductQuantizer, evaluate_quantization
+from .services import ListingsService, SearchQuery
+from .vector_db_managers import (
+    AbstractVectorDBManager,
+    LanceDBManager,
+    NumpyDBManager,
+    NumpyQuery,
+)
 
 
 class TestAbstractVectorDBManager:
@@ -45,6 +55,21 @@ class TestAbstractVectorDBManager:
             def _get_by_id(self, id: str) -> Any:
                 raise NotImplementedError
 
+            def _append_listings(self, records: list, replace: bool = False) -> int:
+                raise NotImplementedError
+
+            def _delete_listings(self, ids: list) -> None:
+                raise NotImplementedError
+
+            def _apply_filters(self, query_result: Any, filters: Any) -> Any:
+                raise NotImplementedError
+
+            def _distinct_values(self, column: str) -> list:
+                raise NotImplementedError
+
+            def _data_version(self) -> Any:
+                raise NotImplementedError
+
             def _retrieve_documents(
                 self,
                 query_result: mock,
@@ -212,9 +237,322 @@ class TestLanceDBManager:
         manager.init()
         assert manager._get_table("listings").count_rows() == len(sample_data)
 
+        record = sample_data[0]
+        # the filters are added to the id filter of the query
+        documents = manager._retrieve_documents(
+            manager._apply_filters(
+                manager._get_by_id(record["id"]),
+                ListingFilters(max_price=record["price"]),
+            ),
+            ["id"],
+        )
+        assert [document.metadata["id"] for document in documents] == [record["id"]]
+        assert not manager._retrieve_documents(
+            manager._apply_filters(
+                manager._get_by_id(record["id"]),
+                ListingFilters(min_price=record["price"] + 1),
+            )
+        )
+        assert sorted(manager._distinct_values("neighborhood")) == sorted(
+            {data["neighborhood"] for data in sample_data}
+        )
+
+        # batched searches: the same results as the single ones
+        batch_filters = [None, ListingFilters(min_bedrooms=3)] * len(sample_data)
+        batch_vectors = [record["vector"] for record in sample_data for _ in range(2)]
+        results = manager._text_search_batch(
+            batch_vectors, batch_filters, ["id"], limit=3
+        )
+        for vector, query_filters, documents in zip(
+            batch_vectors, batch_filters, results
+        ):
+            query = manager._text_search(vector)
+            if query_filters:
+                query = manager._apply_filters(query, query_filters)
+            assert [document.metadata["id"] for document in documents] == [
+                document.metadata["id"]
+                for document in manager._retrieve_documents(query, ["id"], limit=3)
+            ]
+
         manager._db_connection.drop_database()
 
 
+@mock.patch.object(NumpyDBManager, "_load_listings_data")
+class TestNumpyDBManager:
+
+    def test_singleton(self, mock_load_listing_data):
+        NumpyDBManager.instance = None
+        manager1 = NumpyDBManager()
+        manager2 = NumpyDBManager()
+        assert manager1 is manager2
+
+    @mock.patch("service_layer.vector_db_managers.CONFIG")
+    def test(self, mock_config, mock_load_listing_data, tmp_path):
+        NumpyDBManager.instance = None
+        NumpyDBManager._databases.clear()
+
+        sample_listing_data_file = "./service_layer/tests_data/sample_listing_data.json"
+        if not os.path.exists(sample_listing_data_file):
+            pytest.skip(f"Couldn't find `{sample_listing_data_file}`")
+
+        mock_config.numpy_db_path = str(tmp_path / "numpy.db")
+
+        with open(sample_listing_data_file, "r") as file:
+            sample_data = json.load(file)
+
+        def _load_listing_data(
+            self, model_object: BaseModel, model_name: str, reset: bool
+        ):
+            self._get_table(model_name).add(sample_data)
+
+        manager = NumpyDBManager()
+        mock_load_listing_data.side_effect = partial(_load_listing_data, self=manager)
+        manager.init()
+
+        assert manager._is_table_empty("listings") is False
+        assert manager._get_table("listings").count_rows() == len(sample_data)
+
+        # every listing is the closest one to its own vectors
+        for record in sample_data:
+            for query in (
+                manager._text_search(record["vector"]),
+                NumpyQuery("image_vector", record["image_vector"]),
+            ):
+                documents = manager._retrieve_documents(query, ["id"], limit=2)
+                assert len(documents) == 2
+                assert documents[0].metadata["id"] == record["id"]
+                assert documents[0].page_content == record["listing_summary"]
+
+        # batched searches: the same results as the single ones
+        batch_filters = [None, ListingFilters(min_bedrooms=3)] * len(sample_data)
+        batch_vectors = [record["vector"] for record in sample_data for _ in range(2)]
+        results = manager._text_search_batch(
+            batch_vectors, batch_filters, ["id"], limit=3
+        )
+        for vector, query_filters, documents in zip(
+            batch_vectors, batch_filters, results
+        ):
+            query = manager._text_search(vector)
+            if query_filters:
+                query = manager._apply_filters(query, query_filters)
+            assert documents == manager._retrieve_documents(query, ["id"], limit=3)
+
+        record = sample_data[0]
+        filters = ListingFilters(
+            max_price=record["price"], neighborhoods=[record["neighborhood"]]
+        )
+        documents = manager._retrieve_documents(
+            manager._apply_filters(manager._text_search(record["vector"]), filters),
+            ["id", "price", "neighborhood"],
+            limit=len(sample_data),
+        )
+        assert {document.metadata["id"] for document in documents} == {
+            data["id"]
+            for data in sample_data
+            if data["price"] <= record["price"]
+            and data["neighborhood"] == record["neighborhood"]
+        }
+
+        documents = manager._retrieve_documents(manager._get_by_id(record["id"]))
+        assert len(documents) == 1
+        assert documents[0].metadata["bedrooms"] == record["bedrooms"]
+        assert documents[0].metadata["price"] == record["price"]
+        assert sorted(manager._distinct_values("neighborhood")) == sorted(
+            {data["neighborhood"] for data in sample_data}
+        )
+
+        version = manager._data_version()
+        manager._delete_listings([record["id"]])
+        assert manager._data_version() != version
+        assert manager._get_table("listings").count_rows() == len(sample_data) - 1
+        assert not manager._retrieve_documents(manager._get_by_id(record["id"]))
+
+        # reopened from the saved files, with the vectors memory-mapped
+        NumpyDBManager._databases.clear()
+        manager = NumpyDBManager()
+        manager.init()
+        mock_load_listing_data.assert_called_once()
+        table = manager._get_table("listings")
+        assert table.count_rows() == len(sample_data) - 1
+        blocks = table.snapshot().vectors["vector"].blocks
+        assert all(isinstance(block, np.memmap) for block in blocks)
+        documents = manager._retrieve_documents(
+            manager._text_search(sample_data[1]["vector"]), ["id"], limit=1
+        )
+        assert documents[0].metadata["id"] == sample_data[1]["id"]
+
+        manager.init(reset=True, load_data=False)
+        assert manager._is_table_empty("listings")
+        assert not os.path.exists(mock_config.numpy_db_path)
+
+
+def test_numpy_table_search():
+    table = NumpyTable()
+    table.add(
+        [
+            {"id": str(index), "vector": vector, "price": 100.0 * index}
+            for index, vector in enumerate(np.eye(4).tolist())
+        ]
+    )
+    # no price: out of any price range
+    table.add([{"id": "4", "vector": [1, 1, 1, 1]}])
+    assert table.version == 2
+
+    queries = [[1, 0.5, 0, 0], [0, 0.2, 0.5, 1]]
+    results = table.search("vector", queries, 2, columns=["id"])
+    assert [[row["id"] for row in rows] for rows in results] == [
+        ["0", "4"],
+        ["3", "4"],
+    ]
+    results = table.search(
+        "vector", queries, 2, [ListingFilters(max_price=150)], columns=["id"]
+    )
+    assert [[row["id"] for row in rows] for rows in results] == [
+        ["0", "1"],
+        ["1", "0"],
+    ]
+    assert table.search("vector", queries, 2, [ListingFilters(ids=["x"])]) == [[], []]
+
+    assert table.rows(10, [ListingFilters(ids=["4"])]) == [
+        {"id": "4", "price": None, "vector": [0.5, 0.5, 0.5, 0.5]}
+    ]
+    table.delete(["0", "x"])
+    assert table.version == 3
+    assert [row["id"] for row in table.rows(10, columns=["id"])] == ["1", "2", "3", "4"]
+
+
+def test_numpy_table_interrupted_save(tmp_path):
+    path = str(tmp_path / "listings")
+    table = NumpyTable(path)
+    table.add([{"id": "0", "vector": [1, 0], "price": 100.0}])
+    saved_files = set(os.listdir(path)) - {"table.json"}
+
+    with mock.patch("service_layer.numpy_table.np.save") as mock_save:
+        mock_save.side_effect = [None, OSError("disk full")]
+        with pytest.raises(OSError):
+            table.add([{"id": "1", "vector": [0, 1], "price": 200.0}])
+
+    # the files of the interrupted save are ignored
+    table = NumpyTable(path)
+    assert table.rows(10, columns=["id", "price"]) == [{"id": "0", "price": 100}]
+    table.add([{"id": "1", "vector": [0, 1]}])
+    assert table.count_rows() == 2
+    assert saved_files < set(os.listdir(path))
+
+
+@mock.patch("service_layer.numpy_table._MAX_SEGMENTS", 2)
+def test_numpy_table_segments(tmp_path):
+    path = str(tmp_path / "listings")
+    table = NumpyTable(path)
+    table.add([{"id": str(i), "vector": [1, i]} for i in range(4)])
+    files = {file: os.stat(os.path.join(path, file)) for file in os.listdir(path)}
+
+    # the added rows are written to a new segment, the deleted ones masked
+    table.add([{"id": "4", "vector": [0, 1], "image_vector": [1, 0]}])
+    table.delete(["1"])
+    for file, stat in files.items():
+        if file != "table.json":
+            assert os.stat(os.path.join(path, file)) == stat
+    assert len(table.snapshot().vectors["vector"].blocks) == 2
+
+    table = NumpyTable(path)
+    assert [row["id"] for row in table.rows(10, columns=["id"])] == ["0", "2", "3", "4"]
+    assert table.rows(1, columns=["image_vector"]) == [{"image_vector": [0.0, 0.0]}]
+    results = table.search("vector", [[0, 1], [1, 0]], 2, columns=["id"])
+    assert [[row["id"] for row in rows] for rows in results] == [
+        ["4", "3"],
+        ["0", "2"],
+    ]
+
+    # rewritten in one segment without the deleted rows past 2 segments
+    table.add([{"id": "5", "vector": [1, 1]}])
+    assert len(table.snapshot().vectors["vector"].blocks) == 1
+    assert len(table.snapshot().deleted) == table.count_rows() == 5
+    assert not files.keys() - {"table.json"} & set(os.listdir(path))
+    table = NumpyTable(path)
+    assert [row["id"] for row in table.rows(10, columns=["id"])] == [
+        "0",
+        "2",
+        "3",
+        "4",
+        "5",
+    ]
+
+
+def test_numpy_table_refresh(tmp_path):
+    path = str(tmp_path / "listings")
+    writer = NumpyTable(path)
+    writer.add([{"id": "0", "vector": [1, 0]}])
+    reader = NumpyTable(path)
+
+    # as saved by another process
+    writer.add([{"id": "1", "vector": [0, 1]}])
+    assert reader.count_rows() == 1
+    reader.refresh()
+    assert reader.version == writer.version
+    assert [row["id"] for row in reader.rows(10, columns=["id"])] == ["0", "1"]
+
+    # only the new segment is read, with a new column
+    writer.add([{"id": "2", "vector": [1, 1], "price": 100.0}])
+    writer.delete(["1"])
+    reader.refresh()
+    assert reader.rows(10, columns=["id", "price"]) == [
+        {"id": "0", "price": None},
+        {"id": "2", "price": 100},
+    ]
+
+
+def test_product_quantizer():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(8, 16))
+    vectors = centers[rng.integers(0, 8, 500)] + rng.normal(scale=0.01, size=(500, 16))
+
+    with pytest.raises(ValueError):
+        ProductQuantizer.train(vectors, subspaces=5)
+    quantizer = ProductQuantizer.train(vectors, subspaces=4, clusters=16)
+    assert quantizer.codebooks.shape == (4, 16, 4)
+    assert quantizer.code_size == 4
+
+    codes = quantizer.encode(vectors)
+    assert codes.shape == (500, 4) and codes.dtype == np.uint8
+    queries = rng.normal(size=(3, 16))
+    np.testing.assert_allclose(
+        quantizer.scores(queries, codes), queries @ vectors.T, atol=0.2
+    )
+
+
+def test_numpy_table_quantization(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(1000, 32))
+    table = NumpyTable(str(tmp_path / "listings"), rerank_factor=5)
+    table.add(
+        [{"id": str(index), "vector": vector} for index, vector in enumerate(vectors)]
+    )
+    version = table.version
+    table.quantize("vector", subspaces=8, clusters=32)
+    assert table.version == version
+    report = evaluate_quantization(table, "vector", k=10)
+    assert report["bytes_per_listing"] == 8
+    assert report["full_bytes_per_listing"] == 32 * 4
+    assert report["recall@10"] >= 0.8
+
+    # the new vectors are encoded, and the codes saved
+    table.add([{"id": "new", "vector": vectors[0] * 2}])
+    table = NumpyTable(str(tmp_path / "listings"), rerank_factor=5)
+    quantizer, codes = table.snapshot().codes["vector"]
+    assert len(codes) == table.count_rows() == 1001
+    assert [row["id"] for row in table.search("vector", [vectors[0]], 2)[0]] in (
+        ["0", "new"],
+        ["new", "0"],
+    )
+    table.delete(["new"])
+    assert table.count_rows() == 1000
+    assert table.search("vector", [vectors[0]], 1)[0][0]["id"] == "0"
+
+    table.quantize("vector", 0)
+    assert not NumpyTable(str(tmp_path / "listings")).snapshot().codes
+
+
 @mock.patch("service_layer.services.get_vectordb_manager")
 class TestListingsService:
 
@@ -250,6 +588,21 @@ class TestListingsService:
             def _get_by_id(self, id: str) -> Any:
                 raise NotImplementedError
 
+            def _append_listings(self, records: list, replace: bool = False) -> int:
+                raise NotImplementedError
+
+            def _delete_listings(self, ids: list) -> None:
+                raise NotImplementedError
+
+            def _apply_filters(self, query_result: Any, filters: Any) -> Any:
+                raise NotImplementedError
+
+            def _distinct_values(self, column: str) -> list:
+                raise NotImplementedError
+
+            def _data_version(self) -> Any:
+                return 0
+
             def _retrieve_documents(
                 self,
                 query_result: Any,
@@ -489,3 +842,283 @@ class TestListingsService:
             ),
         ]
         assert result == expected_result
+
+    def test_search_filters(self, mock_get_vectordb_manager, setup):
+        class DummyVectorDBManager(self.getDummyVectorDBManagerClass()):
+            def init(self, reset: bool = False) -> None:
+                pass
+
+            def _text_search(self, text: str) -> Any:
+                return [
+                    dict(id="1", bedrooms=2, amenities=["pool"]),
+                    dict(id="2", bedrooms=3, amenities=["pool", "gym"]),
+                ]
+
+            def _apply_filters(self, query_result: Any, filters: Any) -> Any:
+                return [
+                    r
+                    for r in query_result
+                    if set(filters.amenities) <= set(r["amenities"])
+                    and r["bedrooms"] >= (filters.min_bedrooms or 0)
+                ]
+
+            def _data_version(self) -> Any:
+                return 1
+
+            def _retrieve_documents(
+                self,
+                query_result: Any,
+                columns: list[str] | None = None,
+                text_field: str = None,
+                limit: int = 3,
+            ) -> Document:
+                return [
+                    Document(page_content="", metadata={"id": r["id"]})
+                    for r in query_result[:limit]
+                ]
+
+        def search_ids(**kwargs):
+            return [document.metadata["id"] for document in svc.search(**kwargs)]
+
+        mock_get_vectordb_manager.return_value = DummyVectorDBManager()
+        svc = ListingsService()
+        assert search_ids(text="house") == ["1", "2"]
+        assert search_ids(text="house", amenities=["gym", "pool"]) == ["2"]
+        assert search_ids(text="house", filters=ListingFilters(min_bedrooms=3)) == ["2"]
+        # nothing matches, the filters are dropped
+        assert search_ids(
+            text="house", filters=ListingFilters(min_bedrooms=4), amenities=["gym"]
+        ) == ["1", "2"]
+
+    def test_search_cache(self, mock_get_vectordb_manager, setup):
+        class DummyVectorDBManager(self.getDummyVectorDBManagerClass()):
+            version = 1
+            searches = 0
+
+            def init(self, reset: bool = False) -> None:
+                pass
+
+            def _text_search(self, text: Any) -> Any:
+                DummyVectorDBManager.searches += 1
+                return [dict(id=str(text), listing_summary="summary")]
+
+            def _data_version(self) -> Any:
+                return self.version
+
+            def _retrieve_documents(
+                self,
+                query_result: Any,
+                columns: list[str] | None = None,
+                text_field: str = None,
+                limit: int = 3,
+            ) -> Document:
+                return [
+                    Document(
+                        page_content=r["listing_summary"], metadata=dict(id=r["id"])
+                    )
+                    for r in query_result[:limit]
+                ]
+
+        db_manager = DummyVectorDBManager()
+        mock_get_vectordb_manager.return_value = db_manager
+        svc = ListingsService()
+
+        first = svc.search(text="house")
+        first[0].metadata["id"] = "modified"
+        assert svc.search(text="house") == [
+            Document(page_content="summary", metadata=dict(id="house"))
+        ]
+        svc.search(text_vector=[0.1, 0.2])
+        svc.search(text_vector=[0.1, 0.2])
+        svc.search(text="house", limit=1)
+        assert DummyVectorDBManager.searches == 3
+        assert svc.cache_stats().hits == 2
+        assert svc.cache_stats().hit_rate == 0.4
+
+        # new listings ingested
+        db_manager.version = 2
+        svc.search(text="house")
+        assert DummyVectorDBManager.searches == 4
+        assert svc.cache_stats().invalidations == 1
+
+    @mock.patch("service_layer.services.embedd_text")
+    def test_search_batch(self, mock_embedd_text, mock_get_vectordb_manager, setup):
+        class DummyVectorDBManager(self.getDummyVectorDBManagerClass()):
+            searches = 0
+
+            def init(self, reset: bool = False) -> None:
+                pass
+
+            def _text_search(self, text: Any) -> Any:
+                DummyVectorDBManager.searches += 1
+                # listings "<vector>-<bedrooms>"
+                return [dict(id=f"{text[0]}-{bedrooms}") for bedrooms in (2, 3)]
+
+            def _image_search(self, image: Image, limit: int = 3) -> Any:
+                return [dict(id="image")]
+
+            def _apply_filters(self, query_result: Any, filters: Any) -> Any:
+                return [
+                    r
+                    for r in query_result
+                    if int(r["id"][-1]) >= (filters.min_bedrooms or 0)
+                ]
+
+            def _data_version(self) -> Any:
+                return 1
+
+            def _retrieve_documents(
+                self,
+                query_result: Any,
+                columns: list[str] | None = None,
+                text_field: str = None,
+                limit: int = 3,
+            ) -> Document:
+                return [
+                    Document(page_content="", metadata={"id": r["id"]})
+                    for r in query_result[:limit]
+                ]
+
+        mock_embedd_text.side_effect = lambda texts, use_cache: [
+            [float(len(text))] for text in texts
+        ]
+
+        def search_batch_ids(queries, **kwargs):
+            return [
+                [document.metadata["id"] for document in documents]
+                for documents in svc.search_batch(queries, **kwargs)
+            ]
+
+        mock_get_vectordb_manager.return_value = DummyVectorDBManager()
+        svc = ListingsService()
+
+        assert search_batch_ids(
+            [
+                SearchQuery(text="house"),
+                SearchQuery(text="condo", filters=ListingFilters(min_bedrooms=3)),
+                # nothing matches, the filters are dropped
+                SearchQuery(text_vector=[1.0], filters=ListingFilters(min_bedrooms=4)),
+                SearchQuery(image=mock.MagicMock(spec=Image)),
+                SearchQuery(text="house"),
+            ]
+        ) == [
+            ["5.0-2", "5.0-3"],
+            ["5.0-3"],
+            ["1.0-2", "1.0-3"],
+            ["image"],
+            ["5.0-2", "5.0-3"],
+        ]
+        # the texts are embedded at once
+        mock_embedd_text.assert_called_once()
+        assert sorted(mock_embedd_text.call_args.args[0]) == ["condo", "house"]
+
+        with pytest.raises(ListingsService.InvalidSearchArgsException):
+            svc.search_batch([SearchQuery()])
+
+        svc._cache = SearchResultCache(max_entries=8)
+        DummyVectorDBManager.searches = 0
+        svc.search_batch([SearchQuery(text="house"), SearchQuery(text="condo")])
+        assert search_batch_ids([SearchQuery(text="house")], limit=3) == [
+            ["5.0-2", "5.0-3"]
+        ]
+        assert DummyVectorDBManager.searches == 2
+        assert svc.cache_stats().hits == 1
+
+    @mock.patch("service_layer.services.CONFIG")
+    def test_search_semantic_cache(self, mock_config, mock_get_vectordb_manager, setup):
+        mock_config.search_cache_max_entries = 0
+        mock_config.search_cache_max_mb = 0
+        mock_config.semantic_cache_max_entries = 8
+        mock_config.semantic_cache_threshold = 0.9
+        mock_config.semantic_cache_rerank = True
+        mock_config.semantic_cache_verify_rate = 1
+
+        class DummyVectorDBManager(self.getDummyVectorDBManagerClass()):
+            listings = {"a": [1, 0], "b": [0.8, 0.6], "c": [0, 1]}
+
+            def init(self, reset: bool = False) -> None:
+                pass
+
+            def _data_version(self) -> Any:
+                return 1
+
+            def _text_search(self, text: Any) -> Any:
+                return sorted(
+                    self.listings,
+                    key=lambda id: -sum(a * b for a, b in zip(text, self.listings[id])),
+                )
+
+            def _apply_filters(self, query_result: Any, filters: Any) -> Any:
+                return [id for id in query_result if id in filters.ids]
+
+            def _retrieve_documents(
+                self,
+                query_result: Any,
+                columns: list[str] | None = None,
+                text_field: str = None,
+                limit: int = 3,
+            ) -> Document:
+                return [
+                    Document(page_content=id, metadata=dict(id=id))
+                    for id in query_result[:limit]
+                ]
+
+        mock_get_vectordb_manager.return_value = DummyVectorDBManager()
+        svc = ListingsService()
+
+        def ids(documents):
+            return [document.metadata["id"] for document in documents]
+
+        assert ids(svc.search(text_vector=[1, 0.1], limit=2)) == ["a", "b"]
+        # similar query: the cached listings ranked again for it
+        assert ids(svc.search(text_vector=[0.7, 0.4], limit=2)) == ["b", "a"]
+        # another limit, another search
+        assert ids(svc.search(text_vector=[1, 0.1], limit=1)) == ["a"]
+        stats = svc.semantic_cache_stats()
+        assert (stats.hits, stats.misses) == (1, 2)
+        # the hit was verified: the actual search ranks "b" and "a" first too
+        assert (stats.verified_hits, stats.false_hits) == (1, 0)
+
+
+def test_semantic_query_cache():
+    def documents(id):
+        return [Document(page_content=id, metadata=dict(id=id))]
+
+    cache = SemanticQueryCache(max_entries=2, threshold=0.9)
+    cache.put([1, 0, 0], "limit=3", 1, documents("a"), 0.5)
+    entry = cache.lookup([0.95, 0.1, 0], "limit=3", 1)
+    assert entry.ids == ["a"] and entry.similarity > 0.9
+    assert cache.lookup([0.95, 0.1, 0], "limit=1", 1) is None
+    assert cache.lookup([0, 1, 0], "limit=3", 1) is None
+
+    # the oldest entry replaced
+    cache.put([0, 1, 0], "limit=3", 1, documents("b"), 0.5)
+    cache.put([0, 0, 1], "limit=3", 1, documents("c"), 0.5)
+    assert cache.lookup([1, 0, 0], "limit=3", 1) is None
+    assert cache.lookup([0, 0, 1], "limit=3", 1).ids == ["c"]
+    # new listings version
+    assert cache.lookup([0, 0, 1], "limit=3", 2) is None
+    assert cache.stats.hits == 2 and cache.stats.misses == 4
+
+
+def test_search_result_cache():
+    def documents(size):
+        return [Document(page_content="x" * size, metadata={})]
+
+    metadata_size = len(repr({}))
+    cache = SearchResultCache(max_entries=2, max_size=100 + 2 * metadata_size)
+    cache.put("a", 1, documents(10), 0.5)
+    cache.put("b", 1, documents(10), 0.5)
+    assert cache.get("a", 1) is not None
+    # least recently used evicted
+    cache.put("c", 1, documents(10), 0.5)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is not None
+    # evicted to fit in the size
+    cache.put("d", 1, documents(90), 0.5)
+    assert cache.get("c", 1) is None and cache.get("a", 1) is not None
+    # too big to be cached
+    cache.put("e", 1, documents(500), 0.5)
+    assert cache.get("e", 1) is None
+    assert cache.stats.saved_seconds == 1.5
+    assert cache.get("c", 2) is None and cache.stats.entries == 0
@@ -3,11 +3,15 @@ import logging
 import os
 import shutil
 import uuid
+import weakref
 from abc import ABC
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
 from functools import partial
-from typing import Any
+from typing import Any, Dict, List, Tuple
 
 import lancedb
+import numpy as np
 import pandas as pd
 import PIL
 import torch
@@ -20,9 +24,20 @@ from pydantic import BaseModel
 from transformers import CLIPModel, CLIPProcessor
 
 from config import CONFIG
-from models.listings import Listing, get_listing_summary
-from utils import embedd_image, embedd_text, singleton
+from models.listings import Listing, get_listing_summary, picture_listing_id
+from utils import (
+    embedd_image,
+    embedd_text,
+    parse_tag_vocabulary,
+    singleton,
+    zero_shot_tags,
+)
 from utils.images import pil_to_bytes
+from utils.tagging import BASELINE_TAG_PROMPT
+
+from .filters import RANGE_COLUMNS, ListingFilters
+from .numpy_table import VECTOR_COLUMNS, NumpyTable
+from .quantization import evaluate_quantization
 
 _logger = logging.getLogger(__name__)
 
@@ -31,19 +46,28 @@ class AbstractVectorDBManager(ABC):
     models = [
         ("listings", Listing),
     ]
+    # loaded on first use, kept across the re-initializations of the singletons
+    _clip_model: CLIPModel | None = None
+    _clip_processor: CLIPProcessor | None = None
+    # tags, embeddings of their prompts (then of the baseline prompt), logit scale
+    _amenity_tags: Tuple[List[str], np.ndarray, float] | None = None
+
+    class Exception(Exception):
+        pass
 
     def __init__(self) -> None:
         self._db_connection = None
 
-    def init(self, reset: bool = False) -> None:
+    def init(self, reset: bool = False, load_data: bool = True) -> None:
+        """:param load_data: load the data files into the tables left empty"""
         self._init_db(reset)
-        self._init_models(reset)
+        self._init_models(reset, load_data)
 
     @abc.abstractmethod
     def _init_db(self, reset: bool = False) -> None:
         raise NotImplementedError()
 
-    def _init_models(self, reset: bool = False) -> None:
+    def _init_models(self, reset: bool = False, load_data: bool = True) -> None:
 
         def _build_default_meth(method_name):
             def _no_implemented(
@@ -63,7 +87,7 @@ class AbstractVectorDBManager(ABC):
             )
             init_method(model_object=model_object, model_name=model_name, reset=reset)
 
-            if reset or self._is_table_empty(model_name):
+            if load_data and (reset or self._is_table_empty(model_name)):
                 # execute _load_{model_name}_data
                 load_method_name = f"_load_{model_name}_data"
                 load_method = getattr(
@@ -82,7 +106,8 @@ class AbstractVectorDBManager(ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def _text_search(self, text: str) -> Any:
+    def _text_search(self, text: str | List[float]) -> Any:
+        """search with `text` or with its already computed embedding"""
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -93,6 +118,34 @@ class AbstractVectorDBManager(ABC):
     def _get_by_id(self, id: str) -> Any:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def _append_listings(self, records: List[dict], replace: bool = False) -> int:
+        """
+        Embed the listings records and add them, return the number added.
+
+        :param replace: delete the listings with the same ids, once the records
+                        are embedded.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _delete_listings(self, ids: List[str]) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _apply_filters(self, query_result: Any, filters: ListingFilters) -> Any:
+        """restrict a search to the listings matching `filters`"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _distinct_values(self, column: str) -> List[Any]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _data_version(self) -> Any:
+        """changes every time the listings are modified"""
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def _retrieve_documents(
         self,
@@ -103,6 +156,145 @@ class AbstractVectorDBManager(ABC):
     ) -> Document:
         raise NotImplementedError()
 
+    def _text_search_batch(
+        self,
+        vectors: List[List[float]],
+        filters: List[ListingFilters | None],
+        columns: list[str] | None = None,
+        text_field: str = None,
+        limit: int = 3,
+    ) -> List[List[Document]]:
+        """documents of several text vector searches, run one by one by default"""
+        documents = []
+        for vector, query_filters in zip(vectors, filters):
+            query_result = self._text_search(vector)
+            if query_filters:
+                query_result = self._apply_filters(query_result, query_filters)
+            documents.append(
+                self._retrieve_documents(
+                    query_result, columns=columns, text_field=text_field, limit=limit
+                )
+            )
+        return documents
+
+    @staticmethod
+    def _group_by_filters(
+        filters: List[ListingFilters | None],
+    ) -> Dict[str, List[int]]:
+        """indices of the queries, by filters"""
+        groups: Dict[str, List[int]] = defaultdict(list)
+        for index, query_filters in enumerate(filters):
+            groups[repr(query_filters) if query_filters else ""].append(index)
+        return groups
+
+    def _read_listings_file(self, model_object: BaseModel) -> List[BaseModel]:
+        """embedded listings of the LISTING_FILE"""
+        listing_file = CONFIG.LISTING_FILE
+        if not os.path.exists(listing_file):
+            raise self.__class__.Exception(
+                f"Listings files non-existant: {listing_file}"
+            )
+
+        def _load_listings(**kwargs):
+            df = pd.read_csv(listing_file)
+            if "id" not in df and "picture_file" in df:
+                # the ids the pipeline and the watcher give to the picture listings
+                df["id"] = df["picture_file"].map(picture_listing_id)
+            yield from df.to_dict("records")
+
+        def _process_dataset(batch: LazyBatch) -> LazyBatch:
+            return self._embed_listings(batch, list(batch.keys_to_format))
+
+        # trick to avoid caching the generator. more info bellow
+        # https://discuss.huggingface.co/t/is-from-generator-caching-how-to-stop-it/70013/2
+        gen_kwargs = dict(dummy_key=uuid.uuid4())
+        listings_dataset = Dataset.from_generator(
+            generator=_load_listings, gen_kwargs=gen_kwargs
+        )
+        processed_ds = listings_dataset.map(
+            _process_dataset, batched=True, batch_size=10
+        )
+
+        return list(map(lambda record: model_object(**record), processed_ds.to_list()))
+
+    def _build_listings(self, records: List[dict]) -> List[Listing]:
+        """embedded listings of the generated listings records"""
+        if not records:
+            return []
+        keys = list(records[0].keys())
+        batch = self._embed_listings(
+            {key: [record.get(key) for record in records] for key in keys}, keys
+        )
+        return [
+            Listing(**dict(zip(batch.keys(), values)))
+            for values in zip(*batch.values())
+        ]
+
+    def _embed_listings(self, batch, keys: List[str]):
+        """
+        Add the summary, picture and embeddings columns to a batch of listings
+        (a mapping of the columns values)
+        """
+        clip_model, clip_processor = self._get_clip_model()
+        listing_summaries = [
+            get_listing_summary(dict(zip(keys, data)))
+            for data in zip(*[batch[k] for k in keys])
+        ]
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        batch["image"] = list(map(PIL.Image.open, batch["picture_file"]))
+        image = clip_processor(text=None, images=batch["image"], return_tensors="pt")[
+            "pixel_values"
+        ]
+        image.to(device)
+        batch["image"] = list(map(pil_to_bytes, batch["image"]))
+        image_features = (
+            clip_model.to(device).get_image_features(image).detach().cpu().numpy()
+        )
+        batch["image_vector"] = image_features.tolist()
+        batch["amenities"] = self._tag_amenities(image_features)
+        batch["listing_summary"] = listing_summaries
+        batch["vector"] = embedd_text(listing_summaries)
+        return batch
+
+    def _get_clip_model(self) -> Tuple[CLIPModel, CLIPProcessor]:
+        if self._clip_model is None:
+            clip_model_name = "openai/clip-vit-base-patch32"
+            self._clip_model = CLIPModel.from_pretrained(clip_model_name)
+            self._clip_processor = CLIPProcessor.from_pretrained(clip_model_name)
+        return self._clip_model, self._clip_processor
+
+    def _tag_amenities(self, image_features: np.ndarray) -> List[List[str]]:
+        """zero-shot tagging of the pictures with the AMENITY_TAGS vocabulary"""
+        tags, tag_features, logit_scale = self._get_amenity_tags()
+        if not tags:
+            return [[] for _ in image_features]
+        return zero_shot_tags(
+            image_features,
+            tag_features,
+            tags,
+            logit_scale=logit_scale,
+            threshold=float(CONFIG.amenity_tag_threshold),
+        )
+
+    def _get_amenity_tags(self) -> Tuple[List[str], np.ndarray, float]:
+        vocabulary = parse_tag_vocabulary(CONFIG.amenity_tags or "")
+        if self._amenity_tags is None or self._amenity_tags[0] != list(vocabulary):
+            clip_model, clip_processor = self._get_clip_model()
+            prompts = [
+                CONFIG.amenity_tag_prompt.format(prompt)
+                for prompt in vocabulary.values()
+            ] + [BASELINE_TAG_PROMPT]
+            inputs = clip_processor(text=prompts, return_tensors="pt", padding=True)
+            inputs = {key: value.to(clip_model.device) for key, value in inputs.items()}
+            with torch.no_grad():
+                tag_features = clip_model.get_text_features(**inputs)
+            self._amenity_tags = (
+                list(vocabulary),
+                tag_features.cpu().numpy(),
+                clip_model.logit_scale.exp().item(),
+            )
+        return self._amenity_tags
+
 
 @singleton()
 class LanceDBManager(AbstractVectorDBManager):
@@ -115,6 +307,8 @@ class LanceDBManager(AbstractVectorDBManager):
 
     def __init__(self) -> None:
         super().__init__()
+        # filter set on a query by the manager, `where` replacing it
+        self._query_filters: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 
     def _init_db(self, reset: bool) -> None:
         if reset and os.path.exists(CONFIG.VECTOR_DB_URI):
@@ -144,69 +338,43 @@ class LanceDBManager(AbstractVectorDBManager):
         self, model_object: BaseModel, model_name: str, reset: bool
     ) -> None:
         table = self._db_connection.open_table(model_name)
-        listing_file = CONFIG.LISTING_FILE
-        if not os.path.exists(listing_file):
-            raise self.__class__.Exception(
-                f"Listings files non-existant: {listing_file}"
-            )
-
-        def _load_listings(**kwargs):
-            df = pd.read_csv(listing_file)
-            yield from df.to_dict("records")
-
-        clip_model_name = "openai/clip-vit-base-patch32"
-        clip_model = CLIPModel.from_pretrained(clip_model_name)
-        clip_processor = CLIPProcessor.from_pretrained(clip_model_name)
-
-        def _process_dataset(batch: LazyBatch) -> LazyBatch:
-            keys = list(batch.keys_to_format)
-            listing_summaries = [
-                get_listing_summary(dict(zip(keys, data)))
-                for data in zip(*[batch[k] for k in keys])
-            ]
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            batch["image"] = list(map(PIL.Image.open, batch["picture_file"]))
-            image = clip_processor(
-                text=None, images=batch["image"], return_tensors="pt"
-            )["pixel_values"]
-            image.to(device)
-            batch["image"] = list(map(pil_to_bytes, batch["image"]))
-            batch["image_vector"] = (
-                clip_model.to(device).get_image_features(image).cpu()
-            )
-            batch["listing_summary"] = listing_summaries
-            batch["vector"] = embedd_text(listing_summaries)
-            return batch
-
-        # trick to avoid caching the generator. more info bellow
-        # https://discuss.huggingface.co/t/is-from-generator-caching-how-to-stop-it/70013/2
-        gen_kwargs = dict(dummy_key=uuid.uuid4())
-        listings_dataset = Dataset.from_generator(
-            generator=_load_listings, gen_kwargs=gen_kwargs
-        )
-        processed_ds = listings_dataset.map(
-            _process_dataset, batched=True, batch_size=10
-        )
-
-        table.add(
-            list(map(lambda record: model_object(**record), processed_ds.to_list()))
-        )
+        table.add(self._read_listings_file(model_object))
         _logger.info("Vector db sucessfully initialized")
         _logger.info("Listing table: %s record(s)", table.count_rows())
 
+    def _append_listings(self, records: List[dict], replace: bool = False) -> int:
+        listings = self._build_listings(records)
+        if replace:
+            self._delete_listings([listing.id for listing in listings])
+        if listings:
+            self._get_table(self._table_name).add(listings)
+        return len(listings)
+
+    def _delete_listings(self, ids: List[str]) -> None:
+        if not ids:
+            return
+        quoted_ids = ", ".join(f"'{id}'" for id in ids)
+        self._get_table(self._table_name).delete(f"id IN ({quoted_ids})")
+
     def _text_image_search(
         self, text: str, image: Image, limit: int = 3
     ) -> LanceQueryBuilder:
         # first search for the ids of listings matching the text
-        text_matching_ids = self._text_search(text).select(["id"]).limit(limit)
+        text_matching_ids = [
+            record["id"]
+            for record in self._text_search(text).select(["id"]).limit(limit).to_list()
+        ]
         # then search in the subset of listings those whose picture resemble most to input
-        return self._image_search(image, limit=limit).where(
-            f"id in f{text_matching_ids}", prefilter=True
+        return self._where(
+            self._image_search(image),
+            f"id IN ({', '.join(map(self._quote, text_matching_ids)) or 'NULL'})",
         )
 
-    def _text_search(self, text: str) -> LanceQueryBuilder:
+    def _text_search(self, text: str | List[float]) -> LanceQueryBuilder:
+        if isinstance(text, str):
+            text = embedd_text(text, use_cache=True)[0]
         return self._get_table(self._table_name).search(
-            query=embedd_text(text)[0],
+            query=text,
             vector_column_name=self._text_vector_column,
         )
 
@@ -217,12 +385,54 @@ class LanceDBManager(AbstractVectorDBManager):
         )
 
     def _get_by_id(self, id: str) -> LanceQueryBuilder:
-        return (
-            self._get_table(self._table_name)
-            .search()
-            .where(f"id='{id}'", prefilter=True)
+        return self._where(
+            self._get_table(self._table_name).search(), f"id={self._quote(id)}"
         )
 
+    def _where(self, query: LanceQueryBuilder, clause: str) -> LanceQueryBuilder:
+        """`query` prefiltered with `clause`, kept by `_apply_filters`"""
+        query = query.where(clause, prefilter=True)
+        self._query_filters[query] = clause
+        return query
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        return "'{}'".format(value.replace("'", "''"))
+
+    def _apply_filters(
+        self, query_result: LanceQueryBuilder, filters: ListingFilters
+    ) -> LanceQueryBuilder:
+        clauses = []
+        for column in RANGE_COLUMNS:
+            low = getattr(filters, f"min_{column}")
+            high = getattr(filters, f"max_{column}")
+            if low is not None:
+                clauses.append(f"{column} >= {low}")
+            if high is not None:
+                clauses.append(f"{column} <= {high}")
+        if filters.neighborhoods:
+            neighborhoods = ", ".join(map(self._quote, filters.neighborhoods))
+            clauses.append(f"neighborhood IN ({neighborhoods})")
+        if filters.amenities:
+            tags = ", ".join(map(self._quote, filters.amenities))
+            clauses.append(f"array_has_all(amenities, [{tags}])")
+        if filters.ids:
+            clauses.append(f"id IN ({', '.join(map(self._quote, filters.ids))})")
+        if not clauses:
+            return query_result
+        # `where` replaces the filter already set on the query
+        if query_result in self._query_filters:
+            clauses.insert(0, f"({self._query_filters[query_result]})")
+        return self._where(query_result, " AND ".join(clauses))
+
+    def _data_version(self) -> int:
+        return self._get_table(self._table_name).version
+
+    def _distinct_values(self, column: str) -> List[Any]:
+        table = self._get_table(self._table_name)
+        values = table.search().select([column]).limit(None).to_arrow().column(column)
+        return values.unique().to_pylist()
+
     def _retrieve_documents(
         self,
         query_result: LanceQueryBuilder,
@@ -248,10 +458,226 @@ class LanceDBManager(AbstractVectorDBManager):
             map(_process_record, query_result.select(columns).limit(limit).to_list())
         )
 
+    def _text_search_batch(
+        self,
+        vectors: List[List[float]],
+        filters: List[ListingFilters | None],
+        columns: list[str] | None = None,
+        text_field: str = None,
+        limit: int = 3,
+    ) -> List[List[Document]]:
+        """the queries with the same filters are run as one multi-vector search"""
+        documents = [[] for _ in vectors]
+        for indices in self._group_by_filters(filters).values():
+            query_result = self._text_search([vectors[index] for index in indices])
+            if filters[indices[0]]:
+                query_result = self._apply_filters(query_result, filters[indices[0]])
+            for document in self._retrieve_documents(
+                query_result, columns=columns, text_field=text_field, limit=limit
+            ):
+                # the limit applies to every query
+                query_index = document.metadata.pop("query_index", 0)
+                documents[indices[query_index]].append(document)
+        return documents
+
+
+@dataclass
+class NumpyQuery:
+    """lazy search on a NumpyTable, run by `_retrieve_documents`"""
+
+    vector_column: str | None = None
+    vector: List[float] | None = None
+    filters: List[ListingFilters] = field(default_factory=list)
+
+
+@singleton()
+class NumpyDBManager(AbstractVectorDBManager):
+    """
+    In process vector db keeping the listings in NumPy arrays (see NumpyTable),
+    searched exhaustively. Saved under NUMPY_DB_PATH when set, in memory only
+    otherwise.
+    """
+
+    _table_name: str = "listings"
+    _text_vector_column: str = "vector"
+    _image_vector_column: str = "image_vector"
+    # tables by name, by path: kept across the re-initializations of the singleton
+    _databases: Dict[str, Dict[str, NumpyTable]] = {}
+
+    class Exception(Exception):
+        pass
+
+    def __init__(self) -> None:
+        super().__init__()
+
+    def _init_db(self, reset: bool) -> None:
+        path = CONFIG.numpy_db_path or ""
+        if reset:
+            self._databases.pop(path, None)
+            if path and os.path.exists(path):
+                shutil.rmtree(path)
+        self._db_connection = self._databases.setdefault(path, {})
+
+    def _is_table_empty(self, model_name: str) -> bool:
+        return not self._get_table(model_name).count_rows()
+
+    def _get_table(self, model_name: str) -> NumpyTable:
+        if model_name not in self._db_connection:
+            path = CONFIG.numpy_db_path
+            self._db_connection[model_name] = NumpyTable(
+                os.path.join(path, model_name) if path else None,
+                rerank_factor=int(CONFIG.numpy_db_rerank_factor),
+            )
+        table = self._db_connection[model_name]
+        # the listings saved by another process (watch, pipeline)
+        table.refresh()
+        return table
+
+    def quantize(self, column: str, subspaces: int | None = None) -> Dict[str, float]:
+        """
+        Product quantize the `column` vectors of the listings table (see
+        NumpyTable.quantize), and report the memory per listing and the recall@10
+        of the searches.
+        """
+        table = self._get_table(self._table_name)
+        table.quantize(column, subspaces)
+        return evaluate_quantization(table, column, k=10)
+
+    def _init_listings(
+        self, model_object: BaseModel, model_name: str, reset: bool
+    ) -> None:
+        self._get_table(model_name)
+
+    def _load_listings_data(
+        self, model_object: BaseModel, model_name: str, reset: bool
+    ) -> None:
+        table = self._get_table(model_name)
+        table.add(
+            [listing.model_dump() for listing in self._read_listings_file(model_object)]
+        )
+        _logger.info("Vector db sucessfully initialized")
+        _logger.info("Listing table: %s record(s)", table.count_rows())
+
+    def _append_listings(self, records: List[dict], replace: bool = False) -> int:
+        listings = self._build_listings(records)
+        if replace:
+            self._delete_listings([listing.id for listing in listings])
+        self._get_table(self._table_name).add(
+            [listing.model_dump() for listing in listings]
+        )
+        return len(listings)
+
+    def _delete_listings(self, ids: List[str]) -> None:
+        self._get_table(self._table_name).delete(ids)
+
+    def _text_image_search(self, text: str, image: Image, limit: int = 3) -> NumpyQuery:
+        # first search for the ids of listings matching the text
+        text_query = self._text_search(text)
+        text_matching_ids = [
+            row["id"]
+            for row in self._get_table(self._table_name).search(
+                text_query.vector_column, [text_query.vector], limit, columns=["id"]
+            )[0]
+        ]
+        # then search in the subset of listings those whose picture resemble most to input
+        return self._apply_filters(
+            self._image_search(image), ListingFilters(ids=text_matching_ids)
+        )
+
+    def _text_search(self, text: str | List[float]) -> NumpyQuery:
+        if isinstance(text, str):
+            text = embedd_text(text, use_cache=True)[0]
+        return NumpyQuery(self._text_vector_column, text)
+
+    def _image_search(self, image: Image) -> NumpyQuery:
+        return NumpyQuery(self._image_vector_column, embedd_image(image)[0])
+
+    def _get_by_id(self, id: str) -> NumpyQuery:
+        return NumpyQuery(filters=[ListingFilters(ids=[id])])
+
+    def _apply_filters(
+        self, query_result: NumpyQuery, filters: ListingFilters
+    ) -> NumpyQuery:
+        if not filters:
+            return query_result
+        return replace(query_result, filters=[*query_result.filters, filters])
+
+    def _data_version(self) -> int:
+        return self._get_table(self._table_name).version
+
+    def _distinct_values(self, column: str) -> List[Any]:
+        return self._get_table(self._table_name).distinct(column)
+
+    def _retrieve_documents(
+        self,
+        query_result: NumpyQuery,
+        columns: list[str] | None = None,
+        text_field: str = None,
+        limit: int = 3,
+    ) -> Document:
+        columns, text_field = self._document_columns(columns, text_field)
+        table = self._get_table(self._table_name)
+        if query_result.vector is None:
+            records = table.rows(limit, query_result.filters, columns)
+        else:
+            records = table.search(
+                query_result.vector_column,
+                [query_result.vector],
+                limit,
+                query_result.filters,
+                columns,
+            )[0]
+        return [self._to_document(record, text_field) for record in records]
+
+    def _text_search_batch(
+        self,
+        vectors: List[List[float]],
+        filters: List[ListingFilters | None],
+        columns: list[str] | None = None,
+        text_field: str = None,
+        limit: int = 3,
+    ) -> List[List[Document]]:
+        """the queries with the same filters are scored with one matrix product"""
+        columns, text_field = self._document_columns(columns, text_field)
+        table = self._get_table(self._table_name)
+        documents = [None] * len(vectors)
+        for indices in self._group_by_filters(filters).values():
+            query_filters = filters[indices[0]]
+            records = table.search(
+                self._text_vector_column,
+                [vectors[index] for index in indices],
+                limit,
+                [query_filters] if query_filters else [],
+                columns,
+            )
+            for index, query_records in zip(indices, records):
+                documents[index] = [
+                    self._to_document(record, text_field) for record in query_records
+                ]
+        return documents
+
+    @staticmethod
+    def _document_columns(
+        columns: list[str] | None, text_field: str | None
+    ) -> Tuple[List[str], str]:
+        columns = list(columns or set(Listing.field_names()) - set(VECTOR_COLUMNS))
+        text_field = text_field or "listing_summary"
+        if text_field not in columns:
+            columns.append(text_field)
+        if "id" not in columns:
+            columns.append("id")
+        return columns, text_field
+
+    @staticmethod
+    def _to_document(record: dict, text_field: str) -> Document:
+        page_context = record.pop(text_field)
+        return Document(page_content=page_context, metadata=record)
+
 
 def get_vectordb_manager(engine: str) -> AbstractVectorDBManager:
     _manager_map = {
-        "lancedb": LanceDBManager(),
+        "lancedb": LanceDBManager,
+        "numpy": NumpyDBManager,
         "chromadb": None,  # TODO:
     }
-    return _manager_map[engine]
+    return _manager_map[engine]()
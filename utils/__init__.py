@@ -1,5 +1,7 @@
 # flake8: noqa
 
+from .clients import get_chat_model, get_http_client, get_openai_embeddings
+from .concurrency import BoundedThreadPool
 from .embeddings import (
     ClipImageEmbedding,
     NoEmbedderForDocumentTypeException,
@@ -7,6 +9,12 @@ from .embeddings import (
     embedd_text,
     get_embedder,
 )
+from .hedging import DeadlineExceededException, LatencyTracker, hedged_call
 from .images import b64encode_image, local_image_to_data_url, open_image, pil_to_bytes
+from .json_stream import JsonArrayStreamParser
 from .lists import split_in_chunks
-from .utils import singleton
+from .llm_cache import LLMCacheMissException, LLMResponseCache, init_llm_cache
+from .tagging import parse_tag_vocabulary, zero_shot_tags
+from .tokens import count_tokens, truncate_tokens
+from .utils import singleton, to_bool
+from .vectors import compose_vectors, normalize
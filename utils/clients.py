@@ -0,0 +1,47 @@
+import functools
+import importlib.util
+import logging
+
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from .utils import to_bool
+
+_logger = logging.getLogger(__name__)
+
+
+def _http_settings() -> dict:
+    # imported here, config itself depends on the utils package
+    from config import CONFIG
+
+    http2 = to_bool(CONFIG.http2)
+    if http2 and importlib.util.find_spec("h2") is None:
+        _logger.warning("HTTP2 disabled: the `h2` package is not installed")
+        http2 = False
+    return dict(
+        limits=httpx.Limits(
+            max_connections=int(CONFIG.http_max_connections),
+            max_keepalive_connections=int(CONFIG.http_max_keepalive_connections),
+            keepalive_expiry=float(CONFIG.http_keepalive_expiry),
+        ),
+        timeout=httpx.Timeout(
+            float(CONFIG.http_timeout), connect=float(CONFIG.http_connect_timeout)
+        ),
+        http2=http2,
+    )
+
+
+@functools.cache
+def get_http_client() -> httpx.Client:
+    """process wide http client, its connections are kept alive and reused"""
+    return httpx.Client(**_http_settings())
+
+
+@functools.cache
+def get_chat_model(**kwargs) -> ChatOpenAI:
+    """chat model sharing the process wide http client, one per set of parameters"""
+    return ChatOpenAI(http_client=get_http_client(), **kwargs)
+
+
+def get_openai_embeddings(**kwargs) -> OpenAIEmbeddings:
+    return OpenAIEmbeddings(http_client=get_http_client(), **kwargs)
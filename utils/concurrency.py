@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class BoundedThreadPool(object):
+    """
+    Thread pool for offloading blocking work (search, llm calls...) out of the
+    gradio workers, with a bounded number of threads.
+    The backlog itself is bounded upstream, by the gradio queue `max_size`.
+
+    :param max_workers: number of threads running the submitted work.
+    """
+
+    def __init__(self, max_workers: int, name: str = "homematch") -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """number of submitted but unfinished tasks"""
+        return self._pending
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self._pending += 1
+
+        def _run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._release()
+
+        try:
+            future = self._executor.submit(_run)
+        except Exception:
+            self._release()
+            raise
+        # cancelled tasks never run, release them here
+        future.add_done_callback(lambda f: f.cancelled() and self._release())
+        return future
+
+    def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """submit `fn` and wait for its result"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._pending -= 1
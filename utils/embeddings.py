@@ -1,20 +1,20 @@
+import threading
 from typing import Any, List, Union
 
 import torch
 from langchain.embeddings import CacheBackedEmbeddings
 from langchain.storage import LocalFileStore
 from langchain_core.embeddings import Embeddings
-from langchain_openai import OpenAIEmbeddings
 from PIL.Image import Image
 from transformers import CLIPModel, CLIPProcessor
 
+from .clients import get_openai_embeddings
+
 __text_embedding_store = LocalFileStore("./embedding_cache/text/")
-__openai_text_embedder = OpenAIEmbeddings()
-__cached_openai_text_embedder = CacheBackedEmbeddings.from_bytes_store(
-    __openai_text_embedder,
-    __text_embedding_store,
-    namespace=__openai_text_embedder.model,
-)
+# built on first use, with the shared http client (see `_init_text_embedders`)
+__openai_text_embedder = None
+__cached_openai_text_embedder = None
+__text_embedders_lock = threading.Lock()
 
 __clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 __clip_processor = CLIPProcessor.from_pretrained(
@@ -84,8 +84,22 @@ class NoEmbedderForDocumentTypeException(Exception):
     pass
 
 
+def _init_text_embedders() -> None:
+    global __openai_text_embedder, __cached_openai_text_embedder
+    with __text_embedders_lock:
+        if __openai_text_embedder is None:
+            __openai_text_embedder = get_openai_embeddings()
+        if __cached_openai_text_embedder is None:
+            __cached_openai_text_embedder = CacheBackedEmbeddings.from_bytes_store(
+                __openai_text_embedder,
+                __text_embedding_store,
+                namespace=__openai_text_embedder.model,
+            )
+
+
 def get_embedder(document_type: str, use_cache: bool = False) -> Embeddings:
     if document_type == "text":
+        _init_text_embedders()
         return __cached_openai_text_embedder if use_cache else __openai_text_embedder
     if document_type == "image":
         return __cached_clip_image_embedder if use_cache else __clip_image_embedder
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Any, Callable
+
+import numpy as np
+
+
+class DeadlineExceededException(Exception):
+    pass
+
+
+class LatencyTracker(object):
+    """rolling window of the latest call durations"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        self._durations = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._durations.append(seconds)
+
+    def percentile(self, percent: float, default: float | None = None) -> float | None:
+        """`default` until enough durations were recorded"""
+        with self._lock:
+            if len(self._durations) < self._min_samples:
+                return default
+            return float(np.percentile(self._durations, percent))
+
+
+def hedged_call(
+    fn: Callable[[], Any],
+    executor: Executor,
+    deadline: float,
+    hedge_after: float | None = None,
+) -> Any:
+    """
+    Call `fn` and return its result within `deadline` seconds.
+
+    :param hedge_after: when `fn` did not answer after this many seconds, call
+                        it a second time and return the first answer received.
+    :raises DeadlineExceededException: when no call answered before the deadline.
+    """
+    start = time.monotonic()
+    futures = [executor.submit(fn)]
+    if hedge_after is not None and hedge_after < deadline:
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures.append(executor.submit(fn))
+
+    error = None
+    while futures:
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        done, pending = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return future.result()
+            error = future.exception()
+        futures = list(pending)
+
+    if futures:
+        for future in futures:
+            future.cancel()
+        raise DeadlineExceededException(f"No answer after {deadline}s")
+    raise error
@@ -1,5 +1,8 @@
 import base64
+import hashlib
 import io
+import os
+import tempfile
 from io import BytesIO
 from mimetypes import guess_type
 from typing import Tuple
@@ -30,9 +33,15 @@ def resize_image(image: Image, size=IMG_SIZE) -> Image:
     return image.resize(size)
 
 
-def local_image_to_data_url(image_path, size: Tuple = IMG_SIZE) -> str:
+def local_image_to_data_url(
+    image_path, size: Tuple = IMG_SIZE, cache_dir: str | None = None
+) -> str:
     """
     Function to encode a local image into data URL
+
+    The data URLs are cached on disk in `cache_dir` (IMAGE_CACHE_DIR by default,
+    an empty value disables the cache), keyed on the file path, modification
+    time and size and on the target size, so a picture is decoded and encoded once.
     """
     mime_type, _ = guess_type(image_path)
     if mime_type is None:
@@ -40,8 +49,56 @@ def local_image_to_data_url(image_path, size: Tuple = IMG_SIZE) -> str:
         raise Exception(f"Could not detect mime type of file `{image_path}`")
     img_format = mime_type.split("/")[-1]
 
+    cache_file = _image_cache_file(image_path, size, cache_dir)
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            return f.read()
+
     image = open_image(image_path)
     if size:
+        # let the jpeg decoder scale down while loading (by a power of 2, to a
+        # size still larger than the target one) instead of decoding it in full
+        image.draft(image.mode, size)
         image = resize_image(image, size=size)
     # Construct the data URL
-    return f"data:{mime_type};base64,{b64encode_image(image, format=img_format)}"
+    data_url = f"data:{mime_type};base64,{b64encode_image(image, format=img_format)}"
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # written aside then renamed, a concurrent reader never sees a partial file
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as f:
+            f.write(data_url)
+        os.replace(tmp_file, cache_file)
+    return data_url
+
+
+def _image_cache_file(image_path, size: Tuple, cache_dir: str | None) -> str | None:
+    if cache_dir is None:
+        # imported here, config itself depends on the utils package
+        from config import CONFIG
+
+        cache_dir = CONFIG.image_cache_dir
+    if not cache_dir or not os.path.isfile(image_path):
+        return None
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest())
+
+
+def dhash(image: Image, hash_size: int = 8) -> int:
+    """
+    Difference hash of an image: one bit per pair of horizontally adjacent
+    pixels of its grayscale `hash_size + 1` x `hash_size` thumbnail, set when
+    the left one is brighter. Near-identical images (resized copies, re-encoded
+    uploads) have hashes within a few bits of each other.
+    """
+    image.draft("L", (hash_size + 1, hash_size))
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size)).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = value << 1 | (left > right)
+    return value
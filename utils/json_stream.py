@@ -0,0 +1,54 @@
+import json
+from typing import Any, List
+
+
+class JsonArrayStreamParser(object):
+    """
+    Incremental parser for a json array of objects received in chunks
+    (e.g. an llm token stream).
+    Every object of the array is returned by `feed` as soon as it is complete.
+    Anything before the opening bracket (like a markdown code fence) is ignored.
+    """
+
+    def __init__(self) -> None:
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._buffer: List[str] = []
+
+    def feed(self, chunk: str) -> List[Any]:
+        objects = []
+        for char in chunk:
+            if self._finished:
+                break
+            if not self._started:
+                self._started = char == "["
+                continue
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == "]":
+                    self._finished = True
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(json.loads("".join(self._buffer)))
+                    self._buffer = []
+        return objects
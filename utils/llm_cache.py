@@ -0,0 +1,140 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Iterator, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps, loads
+
+_logger = logging.getLogger(__name__)
+
+LLM_CACHE_MODES = ("off", "on", "replay")
+
+
+class LLMCacheMissException(Exception):
+    pass
+
+
+class LLMResponseCache(BaseCache):
+    """
+    On disk (sqlite) cache of the llm responses, shared by all the llm calls
+    once installed with `init_llm_cache`.
+
+    The responses are keyed on the hash of the normalized prompt and of the
+    model parameters (model name, temperature, max tokens...) and stored compressed.
+
+    :param ttl: seconds after which a response expires, 0 for no expiration.
+    :param max_entries: maximum number of responses kept, the least recently
+                        used ones are evicted first. 0 for no limit.
+    :param replay: only serve responses from the cache, a miss raises
+                   `LLMCacheMissException` instead of calling the llm.
+    """
+
+    def __init__(
+        self, path: str, ttl: int = 0, max_entries: int = 0, replay: bool = False
+    ) -> None:
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._replay = replay
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+            )
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            row = connection.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self._ttl and row[1] < now - self._ttl:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row:
+                connection.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+        if row:
+            return [loads(generation) for generation in loads(self._decode(row[0]))]
+        if self._replay:
+            raise LLMCacheMissException(f"No cached llm response for key {key}")
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        value = self._encode(dumps([dumps(generation) for generation in return_val]))
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self._max_entries:
+                connection.execute(
+                    "DELETE FROM responses WHERE key NOT IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                    (self._max_entries,),
+                )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock, self._connect() as connection:
+            connection.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self._path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        normalized_prompt = " ".join(prompt.split())
+        return hashlib.sha256(
+            f"{normalized_prompt}\x00{llm_string}".encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def _encode(value: str) -> bytes:
+        return zlib.compress(value.encode("utf-8"))
+
+    @staticmethod
+    def _decode(value: bytes) -> str:
+        return zlib.decompress(value).decode("utf-8")
+
+
+def init_llm_cache(
+    mode: str, path: str, ttl: int = 0, max_entries: int = 0
+) -> LLMResponseCache | None:
+    """install the llm responses cache for every llm call of the process"""
+    if mode not in LLM_CACHE_MODES:
+        raise ValueError(
+            f"Unknown llm cache mode '{mode}', expected one of {LLM_CACHE_MODES}"
+        )
+    if mode == "off":
+        set_llm_cache(None)
+        return None
+    cache = LLMResponseCache(
+        path=path, ttl=ttl, max_entries=max_entries, replay=mode == "replay"
+    )
+    set_llm_cache(cache)
+    _logger.info("llm cache enabled (%s): %s", mode, path)
+    return cache
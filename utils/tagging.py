@@ -0,0 +1,47 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from .vectors import normalize
+
+# prompt every tag prompt is compared to, the image "without" any amenity
+BASELINE_TAG_PROMPT = "a photo of a house"
+
+
+def parse_tag_vocabulary(value: str) -> Dict[str, str]:
+    """
+    Parse a `tag:prompt,tag:prompt` vocabulary, the prompt of a tag given
+    without one being the tag name with its underscores replaced by spaces.
+    """
+    vocabulary = {}
+    for item in value.split(","):
+        tag, _, prompt = item.partition(":")
+        if tag.strip():
+            vocabulary[tag.strip()] = prompt.strip() or tag.strip().replace("_", " ")
+    return vocabulary
+
+
+def zero_shot_tags(
+    image_features: Sequence,
+    tag_features: Sequence,
+    tags: List[str],
+    logit_scale: float = 100.0,
+    threshold: float = 0.5,
+) -> List[List[str]]:
+    """
+    Tag every image with the tags whose prompt it matches better than the
+    baseline prompt, scored all at once with a single matrix multiply.
+
+    :param image_features: one CLIP embedding per image.
+    :param tag_features: the CLIP embeddings of the tags prompts, followed by
+                         the one of the baseline prompt.
+    :param threshold: minimal probability of the tag prompt against the
+                      baseline prompt (sigmoid of their scaled similarities).
+    """
+    similarities = normalize(image_features) @ normalize(tag_features).T
+    logits = logit_scale * (similarities[:, :-1] - similarities[:, -1:])
+    probabilities = 1 / (1 + np.exp(-logits))
+    return [
+        [tag for tag, selected in zip(tags, row) if selected]
+        for row in probabilities >= threshold
+    ]
@@ -1,19 +1,41 @@
+import base64
+import io
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
 from langchain.embeddings import CacheBackedEmbeddings
+from langchain_core.outputs import Generation
 from langchain_openai import OpenAIEmbeddings
+from PIL import Image
 
+from benchmarks.openai_stub import OpenAIStubServer
 from utils import (
+    BoundedThreadPool,
     ClipImageEmbedding,
+    DeadlineExceededException,
+    JsonArrayStreamParser,
+    LatencyTracker,
+    LLMCacheMissException,
+    LLMResponseCache,
     NoEmbedderForDocumentTypeException,
     embedd_image,
     embedd_text,
+    get_chat_model,
     get_embedder,
+    get_openai_embeddings,
+    hedged_call,
+    parse_tag_vocabulary,
     singleton,
+    to_bool,
+    zero_shot_tags,
 )
 
-from .images import local_image_to_data_url
+from .images import IMG_SIZE, local_image_to_data_url
 from .lists import split_in_chunks
 
 
@@ -80,6 +102,33 @@ def test_local_image_to_data_url(open_image_mock, encode_image_mock, guess_type_
     assert local_image_to_data_url("test.img") == expected_result
 
 
+def test_local_image_to_data_url_cache(tmp_path):
+    image_path = tmp_path / "picture.jpg"
+    Image.new("RGB", (1280, 854), color=(200, 100, 50)).save(image_path)
+    cache_dir = tmp_path / "cache"
+
+    data_url = local_image_to_data_url(str(image_path), cache_dir=str(cache_dir))
+    assert data_url.startswith("data:image/jpeg;base64,")
+    encoded = base64.b64decode(data_url.split(",", 1)[1])
+    assert Image.open(io.BytesIO(encoded)).size == IMG_SIZE
+    assert len(os.listdir(cache_dir)) == 1
+
+    with mock.patch("utils.images.open_image") as open_image_mock:
+        assert (
+            local_image_to_data_url(str(image_path), cache_dir=str(cache_dir))
+            == data_url
+        )
+        open_image_mock.assert_not_called()
+
+        # another target size or a modified picture is encoded again
+        local_image_to_data_url(
+            str(image_path), size=(320, 213), cache_dir=str(cache_dir)
+        )
+        os.utime(image_path, ns=(0, 0))
+        local_image_to_data_url(str(image_path), cache_dir=str(cache_dir))
+        assert open_image_mock.call_count == 2
+
+
 @pytest.mark.parametrize(
     "document_type,use_cache,expected_type,undelying_type",
     [
@@ -139,3 +188,156 @@ def test_embedd_image(mock____cached_clip_image_embedder, mock___clip_image_embe
     embedd_image(documents=[image], use_cache=True)
     mock___clip_image_embedder.embed_documents.assert_not_called()
     mock____cached_clip_image_embedder.embed_documents.assert_called_once_with([image])
+
+
+def test_bounded_thread_pool():
+    pool = BoundedThreadPool(max_workers=1)
+    assert pool.run(lambda x, y: x + y, 1, y=2) == 3
+    assert pool.pending == 0
+
+    release = threading.Event()
+    futures = [pool.submit(release.wait), pool.submit(release.wait)]
+    assert pool.pending == 2
+
+    release.set()
+    assert all(future.result() for future in futures)
+    pool.shutdown()
+    assert pool.pending == 0
+
+
+def test_json_array_stream_parser():
+    parser = JsonArrayStreamParser()
+    stream = '```json\n[{"id": "1", "description": "a \\"{quoted}\\" ]"}, {"id": "2", "tags": [{}]}]\n```'
+    parsed = []
+    for i in range(0, len(stream), 4):
+        parsed.append(parser.feed(stream[i : i + 4]))
+
+    assert [obj for objs in parsed for obj in objs] == [
+        {"id": "1", "description": 'a "{quoted}" ]'},
+        {"id": "2", "tags": [{}]},
+    ]
+    # the first object is returned before the end of the stream
+    first_object_index = parsed.index([{"id": "1", "description": 'a "{quoted}" ]'}])
+    assert first_object_index < len(parsed) - 3
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (True, True),
+        (0, False),
+        ("True", True),
+        ("on", True),
+        ("false", False),
+        ("", False),
+    ],
+)
+def test_to_bool(value, expected):
+    assert to_bool(value) is expected
+
+
+@mock.patch("utils.llm_cache.time.time")
+def test_llm_response_cache(mock_time, tmp_path):
+    mock_time.return_value = 1000
+    cache_path = str(tmp_path / "cache.sqlite")
+    cache = LLMResponseCache(path=cache_path, ttl=60, max_entries=2)
+    llm_string = "model=gpt-4o-mini, temperature=0"
+
+    assert cache.lookup("describe  the\nhouse", llm_string) is None
+    cache.update("describe  the\nhouse", llm_string, [Generation(text="a house")])
+    # the prompt is normalized, the model parameters are part of the key
+    assert cache.lookup("describe the house", llm_string) == [
+        Generation(text="a house")
+    ]
+    assert cache.lookup("describe the house", "model=gpt-4o, temperature=0") is None
+
+    # least recently used responses are evicted
+    mock_time.return_value = 1010
+    cache.update("prompt 2", llm_string, [Generation(text="2")])
+    mock_time.return_value = 1020
+    cache.lookup("describe the house", llm_string)
+    cache.update("prompt 3", llm_string, [Generation(text="3")])
+    assert len(cache) == 2
+    assert cache.lookup("prompt 2", llm_string) is None
+
+    # expired responses
+    mock_time.return_value = 1075
+    assert cache.lookup("describe the house", llm_string) is None
+    assert cache.lookup("prompt 3", llm_string) == [Generation(text="3")]
+
+    replay_cache = LLMResponseCache(path=cache_path, replay=True)
+    assert replay_cache.lookup("prompt 3", llm_string) == [Generation(text="3")]
+    with pytest.raises(LLMCacheMissException):
+        replay_cache.lookup("unknown prompt", llm_string)
+
+
+def test_shared_http_client():
+    with OpenAIStubServer(embedding_size=8) as server:
+        params = dict(base_url=server.base_url, api_key="stub")
+        llm = get_chat_model(**params)
+        assert get_chat_model(**params) is llm
+        for _ in range(3):
+            assert llm.invoke("hello").content == "stub answer"
+        embedder = get_openai_embeddings(check_embedding_ctx_length=False, **params)
+        assert len(embedder.embed_query("hello")) == 8
+
+        assert server.requests == 4
+        # every call went through the same kept alive connection
+        assert server.connections == 1
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for seconds in range(5):
+        tracker.record(seconds)
+    assert tracker.percentile(95, default=7) == 7
+    for seconds in range(5, 100):
+        tracker.record(seconds)
+    assert tracker.percentile(95) == pytest.approx(94.05)
+
+
+def test_hedged_call_against_stub_server():
+    # the first request is slow, the following ones are fast
+    request_count = itertools.count()
+    latency = lambda body: 2 if next(request_count) == 0 else 0.05  # noqa: E731
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    with OpenAIStubServer(latency=latency) as server:
+        llm = get_chat_model(base_url=server.base_url, api_key="stub", max_retries=0)
+        start = time.monotonic()
+        response = hedged_call(
+            lambda: llm.invoke("hello").content,
+            executor=executor,
+            deadline=1,
+            hedge_after=0.2,
+        )
+        assert response == "stub answer"
+        assert time.monotonic() - start < 1
+        assert server.requests == 2
+
+        server.latency = 2
+        with pytest.raises(DeadlineExceededException):
+            hedged_call(
+                lambda: llm.invoke("hello").content, executor=executor, deadline=0.3
+            )
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def test_zero_shot_tags():
+    vocabulary = parse_tag_vocabulary("pool:a swimming pool, hardwood_floors ,")
+    assert vocabulary == {
+        "pool": "a swimming pool",
+        "hardwood_floors": "hardwood floors",
+    }
+
+    # pool, hardwood floors, then the baseline prompt
+    tag_features = [[1, 0, 0], [0, 1, 0], [0.6, 0.6, 1]]
+    image_features = [[2, 0.1, 0], [0, 0, 1], [1, 1, 0]]
+    assert zero_shot_tags(image_features, tag_features, list(vocabulary)) == [
+        ["pool"],
+        [],
+        ["pool", "hardwood_floors"],
+    ]
+    assert zero_shot_tags(
+        image_features, tag_features, list(vocabulary), threshold=0.999
+    ) == [["pool"], [], []]
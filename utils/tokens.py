@@ -0,0 +1,29 @@
+import functools
+
+import tiktoken
+
+DEFAULT_ENCODING = "o200k_base"
+
+
+@functools.cache
+def get_encoding(model: str | None = None) -> tiktoken.Encoding:
+    if model:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """count the tokens of `text` locally, with the tokenizer of `model`"""
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str | None = None) -> str:
+    """keep at most the `max_tokens` first tokens of `text`"""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[: max(max_tokens, 0)])
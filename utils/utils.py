@@ -33,3 +33,10 @@ def singleton(init_once: bool = False):
         return klass
 
     return inner
+
+
+def to_bool(value) -> bool:
+    """convert a config value (possibly read as a string from .env) to a bool"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
@@ -0,0 +1,18 @@
+from typing import List, Sequence
+
+import numpy as np
+
+
+def normalize(vectors: Sequence) -> np.ndarray:
+    """L2 normalize a vector or the rows of a matrix"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def compose_vectors(vectors: Sequence, weights: Sequence[float]) -> List[float]:
+    """normalized weighted sum of the normalized vectors"""
+    if len(vectors) != len(weights):
+        raise ValueError(f"Got {len(vectors)} vectors but {len(weights)} weights")
+    weights = np.asarray(weights, dtype=np.float32)[:, np.newaxis]
+    return normalize((weights * normalize(vectors)).sum(axis=0)).tolist()